@@ -1,13 +1,26 @@
 import os
+import sys
 import uuid
-import sqlite3
-import datetime
+import shutil
+import time
+import threading
 import streamlit as st
 from streamlit_option_menu import option_menu
 import pandas as pd
 from PIL import Image
-import numpy as np
-import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from jobs import JobQueue
+from evaluation import evaluation_handler
+from profiling import BatchProfile
+from pdf_ingest import is_pdf, count_pdf_pages, page_ref, split_page_ref
+from memory_budget import MemoryBudget
+from thumbnails import get_thumbnail, get_overlay
+from answer_key import invalidate_answer_key
+from export import EXPORT_FORMATS, export_results
+from item_analysis import analyze_version
+from db import (DB_PATH, init_db, data_revision, search_results, count_results, fetch_dashboard_stats,
+                fetch_key_versions, fetch_class_batches, save_answer_key)
 
 # --- PAGE CONFIG ---
 st.set_page_config(page_title="Automated OMR Evaluation", layout="wide")
@@ -38,50 +51,50 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- DATABASE CONFIG ---
-DB_PATH = "omr_results.db"
 UPLOAD_DIR = "uploads"
 KEY_DIR = os.path.join(UPLOAD_DIR, "keys")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(KEY_DIR, exist_ok=True)
-
-def init_db():
-    """Create results table if it doesn't exist."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS results (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_name TEXT,
-        student_roll TEXT,
-        class_batch TEXT,
-        email TEXT,
-        file_name TEXT,
-        file_path TEXT,
-        version TEXT,
-        subject1 INTEGER DEFAULT 0,
-        subject2 INTEGER DEFAULT 0,
-        subject3 INTEGER DEFAULT 0,
-        subject4 INTEGER DEFAULT 0,
-        subject5 INTEGER DEFAULT 0,
-        total_score INTEGER DEFAULT 0,
-        flagged INTEGER DEFAULT 0,
-        flag_reason TEXT,
-        created_at TEXT
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS answer_keys (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        version INTEGER,
-        file_name TEXT,
-        file_path TEXT,
-        uploaded_at TEXT
-    )
-    """)
-    conn.commit()
-    conn.close()
+EXPORT_DIR = os.path.join(UPLOAD_DIR, "exports")
+EVAL_WORKERS = int(os.environ.get("OMR_EVAL_WORKERS", "2"))
+# Uploads are streamed to disk in pieces of this size instead of copied whole
+UPLOAD_CHUNK_BYTES = 1 << 20
+# Cached reads are keyed on data_revision(), so new results and keys show up on the
+# next rerun; the TTL only bounds staleness from edits made outside the app.
+QUERY_CACHE_TTL = 300
+
+@st.cache_resource
+def setup_storage():
+    """Create upload folders and database tables once per server process."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    os.makedirs(KEY_DIR, exist_ok=True)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    init_db()
 
-init_db()
+setup_storage()
+results_revision, keys_revision = data_revision()
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False)
+def cached_dashboard_stats(revision):
+    return fetch_dashboard_stats()
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False)
+def cached_key_versions(revision):
+    return fetch_key_versions()
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False)
+def cached_class_batches(revision):
+    return fetch_class_batches()
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False)
+def cached_count_results(query, flagged, revision):
+    return count_results(query, flagged=flagged)
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False, max_entries=200)
+def cached_search_results(query, flagged, limit, offset, revision):
+    """One page of search_results plus its selectbox labels, built column-wise."""
+    page = search_results(query, flagged=flagged, limit=limit, offset=offset)
+    labels = (page["student_name"].astype(str) + " | " + page["student_roll"].astype(str) + " | "
+              + page["version"].astype(str) + " | " + page["created_at"].astype(str)).tolist()
+    return page, labels
 
 def save_uploaded_file(uploaded_file, subdir=UPLOAD_DIR, prefix=None):
     """Save a Streamlit uploaded file to disk and return the saved path."""
@@ -92,143 +105,96 @@ def save_uploaded_file(uploaded_file, subdir=UPLOAD_DIR, prefix=None):
     dest_path = os.path.join(dest_folder, unique)
     uploaded_file.seek(0)
     with open(dest_path, "wb") as f:
-        f.write(uploaded_file.read())
+        shutil.copyfileobj(uploaded_file, f, UPLOAD_CHUNK_BYTES)
     return dest_path, unique
 
-def insert_result(row: dict):
-    """Insert a result row into DB. `row` should contain keys matching columns."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO results
-        (student_name, student_roll, class_batch, email, file_name, file_path, version,
-         subject1, subject2, subject3, subject4, subject5, total_score, flagged, flag_reason, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        row.get("Student Name"),
-        row.get("Student ID"),
-        row.get("Class"),
-        row.get("Email"),
-        row.get("File Name"),
-        row.get("File Path"),
-        row.get("Version"),
-        row.get("Subject 1", 0),
-        row.get("Subject 2", 0),
-        row.get("Subject 3", 0),
-        row.get("Subject 4", 0),
-        row.get("Subject 5", 0),
-        row.get("Total Score", 0),
-        row.get("Flagged", 0),
-        row.get("Flag Reason"),
-        row.get("Created At", datetime.datetime.now().isoformat())
-    ))
-    conn.commit()
-    conn.close()
-
-def fetch_all_results_df(limit=1000):
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query("SELECT * FROM results ORDER BY created_at DESC LIMIT ?", conn, params=(limit,))
-    conn.close()
-    return df
-
-def load_answer_key(version: int):
+def preview_sheet(file_path, file_name, key):
     """
-    Fetches the file path for a given answer key version.
-    Returns the file path or None if not found.
+    Show a cached thumbnail of an uploaded sheet; the full-size image with the
+    detected bubbles outlined is only rendered when the reviewer asks for it.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT file_path FROM answer_keys WHERE version=? ORDER BY uploaded_at DESC LIMIT 1", (version,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        return result[0]
-    return None
-
-def evaluate_omr(sheet_path, version):
+    _, page = split_page_ref(file_name)
+    st.image(get_thumbnail(file_path, page), caption=file_name)
+    if st.checkbox("Show full size with detected bubbles", key=f"overlay_{key}"):
+        with st.spinner("Rendering sheet..."):
+            st.image(get_overlay(file_path, page), caption=file_name, use_column_width=True)
+
+def pagination_controls(total_rows, key):
+    """Page size / page number widgets; returns (limit, offset) for search_results."""
+    col1, col2 = st.columns(2)
+    with col1:
+        page_size = st.selectbox("Rows per page", [25, 50, 100, 250], index=1, key=f"{key}_page_size")
+    pages = max(1, -(-total_rows // page_size))
+    with col2:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, step=1, key=f"{key}_page")
+    return page_size, (page - 1) * page_size
+
+def export_controls(key, search_query, flagged=None):
     """
-    Evaluates an OMR sheet against a saved answer key.
-    
-    NOTE: This function contains placeholder logic. You will need to implement
-    the actual computer vision and data processing logic to make it fully functional.
+    Filters and format for a full export of the results table. The file is
+    streamed to EXPORT_DIR in chunks by export.export_results and then offered
+    for download.
     """
-    key_path = load_answer_key(version)
-    if not key_path:
-        return {
-            "Total Score": 0,
-            "Flagged": 1,
-            "Flag Reason": f"No answer key found for Version {version}",
-        }
-
-    answer_key = {}
-    try:
-        if key_path.lower().endswith(('.xlsx', '.xls', '.csv')):
-            df_key = pd.read_csv(key_path, header=None)
-            df_key = df_key.iloc[1:].reset_index(drop=True)
-            for _, row in df_key.iterrows():
-                for cell in row:
-                    if pd.notna(cell) and ' - ' in str(cell):
-                        parts = str(cell).split(' - ')
-                        question = parts[0].strip()
-                        answer = parts[1].strip()
-                        if question.endswith('.'):
-                            question = question[:-1]
-                        if question.isdigit():
-                            answer_key[int(question)] = answer
-        else:
-            answer_key = {i: "a" for i in range(1, 101)}
+    with st.expander("⬇️ Export results"):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            fmt = st.selectbox("Format", EXPORT_FORMATS, key=f"{key}_export_format")
+        with col2:
+            version = st.selectbox("Version", ["All"] + [str(v) for v in cached_key_versions(keys_revision)],
+                                   key=f"{key}_export_version")
+        with col3:
+            class_batch = st.selectbox("Class / Batch", ["All"] + cached_class_batches(results_revision),
+                                       key=f"{key}_export_class")
+        dates = st.date_input("Evaluated between", value=(), key=f"{key}_export_dates")
+        if st.button("Prepare export", key=f"{key}_export"):
+            path = os.path.join(EXPORT_DIR, f"{key}_{uuid.uuid4().hex}.{fmt}")
+            try:
+                with st.spinner("Exporting..."):
+                    rows = export_results(path, fmt, None if version == "All" else version,
+                                          None if class_batch == "All" else class_batch,
+                                          dates[0] if len(dates) > 0 else None,
+                                          dates[-1] if len(dates) > 0 else None,
+                                          flagged, search_query)
+                with open(path, "rb") as f:
+                    st.download_button(f"⬇️ Download {rows} results ({fmt.upper()})", f,
+                                       file_name=f"{key}.{fmt}", key=f"{key}_download")
+            except Exception as e:
+                st.error(f"Export failed: {e}")
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
 
-        if not answer_key:
-            raise ValueError("Could not parse answer key data. Check format.")
+@st.cache_resource
+def get_pipeline_profile():
+    """Rolling per-stage timings of the last 500 sheets evaluated by this server."""
+    return BatchProfile(max_sheets=500)
 
-    except Exception as e:
-        return {
-            "Total Score": 0,
-            "Flagged": 1,
-            "Flag Reason": f"Error parsing answer key: {e}",
-        }
+@st.cache_resource
+def get_job_queue():
+    """
+    One background evaluation queue per server process, shared by all sessions. Its
+    workers share one memory budget (OMR_MEMORY_BUDGET_MB), so a burst of large
+    photos is decoded a few at a time instead of all at once.
+    """
+    handler = evaluation_handler(DB_PATH, profile_sink=get_pipeline_profile(), budget=MemoryBudget())
+    return JobQueue(DB_PATH, handler, workers=EVAL_WORKERS).start()
 
-    try:
-        # Replace this with your computer vision logic to detect filled bubbles
-        student_answers = {
-            1: 'a', 2: 'b', 3: 'c', 4: 'd', 5: 'c', 
-            6: 'a', 7: 'c', 8: 'c', 9: 'b', 10: 'c'
-        }
-        
-    except Exception as e:
-        return {
-            "Total Score": 0,
-            "Flagged": 1,
-            "Flag Reason": f"Evaluation failed: {e}",
-        }
+@st.cache_resource
+def get_item_analyses():
+    """Per-version ItemAnalysis shared by all sessions, topped up with newly stored sheets on each view."""
+    return {}, threading.Lock()
 
-    correct_count = 0
-    total_questions = len(answer_key)
-    
-    for question, correct_answer in answer_key.items():
-        if student_answers.get(question) == correct_answer:
-            correct_count += 1
-            
-    total_score = correct_count
-    
-    flagged = 0
-    flag_reason = None
-    if total_questions > 0 and len(student_answers) < total_questions:
-        flagged = 1
-        flag_reason = "Incomplete sheet detected."
-
-    return {
-        "Total Score": total_score,
-        "Flagged": flagged,
-        "Flag Reason": flag_reason,
-        "Subject 1": total_score,
-    }
+def item_analysis_for(version):
+    analyses, lock = get_item_analyses()
+    with lock:
+        analyses[version] = analyze_version(version, analysis=analyses.get(version))
+        return analyses[version]
 
 # --- NAVBAR ---
 selected = option_menu(
     menu_title=None,
-    options=["Home", "Upload Sheets", "Results", "Flagged Sheets", "Admin Panel"],
-    icons=["house", "cloud-upload", "table", "exclamation-triangle", "gear"],
+    options=["Home", "Upload Sheets", "Results", "Flagged Sheets", "Item Analysis", "Admin Panel"],
+    icons=["house", "cloud-upload", "table", "exclamation-triangle", "bar-chart", "gear"],
     menu_icon="cast",
     default_index=0,
     orientation="horizontal",
@@ -243,15 +209,7 @@ if selected == "Home":
         Upload OMR sheets, evaluate automatically, and view results instantly.
     """)
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM results")
-    total = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM results WHERE flagged=0")
-    processed = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM results WHERE flagged=1")
-    flagged = cursor.fetchone()[0]
-    conn.close()
+    total, processed, flagged = cached_dashboard_stats(results_revision)
 
     st.subheader("Dashboard Overview")
     col1, col2, col3 = st.columns(3)
@@ -284,63 +242,78 @@ elif selected == "Upload Sheets":
         accept_multiple_files=True
     )
 
-    conn = sqlite3.connect(DB_PATH)
-    versions_df = pd.read_sql_query("SELECT DISTINCT version FROM answer_keys", conn)
-    conn.close()
-    
-    version_options = [str(v) for v in versions_df['version'].tolist()] if not versions_df.empty else ["No key available"]
+    versions = cached_key_versions(keys_revision)
+    version_options = [str(v) for v in versions] if versions else ["No key available"]
     version = st.selectbox("Select Sheet Version", version_options)
     
+    job_queue = get_job_queue()
     if st.button("🚀 Start Evaluation"):
         if uploaded_files and student_name and student_id and version != "No key available":
-            st.success(f"{len(uploaded_files)} sheets uploaded for evaluation (Version: {version})")
-            progress = st.progress(0)
-            total_files = len(uploaded_files)
-            for idx, file in enumerate(uploaded_files):
+            details = {
+                "Student Name": student_name,
+                "Student ID": student_id,
+                "Class": student_class,
+                "Email": student_email,
+                "Version": version,
+            }
+            items = []
+            for file in uploaded_files:
                 saved_path, saved_filename = save_uploaded_file(file, subdir=UPLOAD_DIR, prefix=student_id)
-                
-                scores = evaluate_omr(saved_path, int(version))
-                
-                row = {
-                    "Student Name": student_name,
-                    "Student ID": student_id,
-                    "Class": student_class,
-                    "Email": student_email,
-                    "File Name": saved_filename,
-                    "File Path": saved_path,
-                    "Version": version,
-                    "Subject 1": scores.get("Subject 1", 0),
-                    "Subject 2": scores.get("Subject 2", 0),
-                    "Subject 3": scores.get("Subject 3", 0),
-                    "Subject 4": scores.get("Subject 4", 0),
-                    "Subject 5": scores.get("Subject 5", 0),
-                    "Total Score": scores.get("Total Score", 0),
-                    "Flagged": scores.get("Flagged", 0),
-                    "Flag Reason": scores.get("Flag Reason"),
-                    "Created At": datetime.datetime.now().isoformat()
-                }
-                insert_result(row)
-                st.success(f"✅ {file.name} saved & evaluated for {student_name} ({student_id})")
-                progress.progress(int(((idx+1)/total_files) * 100))
+                if is_pdf(saved_path):
+                    # One job per page: workers rasterize their own page, so a whole
+                    # classroom scan is never decoded into memory at once
+                    try:
+                        pages = count_pdf_pages(saved_path)
+                    except Exception as e:
+                        st.error(f"Could not read {file.name}: {e}")
+                        continue
+                    items += [(page_ref(saved_filename, n), saved_path, dict(details, Page=n))
+                              for n in range(1, pages + 1)]
+                else:
+                    items.append((saved_filename, saved_path, details))
+            if items:
+                batch_id = uuid.uuid4().hex
+                job_queue.submit_many(batch_id, items)
+                st.success(f"{len(items)} sheets queued for evaluation (Version: {version}). "
+                           "You can keep uploading while they are processed.")
         else:
             st.error("⚠️ Please fill student details, upload files, and select a valid answer key version.")
 
+    st.subheader("⏱️ Evaluation Progress")
+    batches = job_queue.recent_batches(limit=10)
+    if batches:
+        pending = False
+        for batch in batches:
+            label = f"{batch['payload'].get('Student Name')} ({batch['payload'].get('Student ID')}) — {batch['created_at'][:19]}"
+            st.progress(int(batch["finished"] / batch["total"] * 100),
+                        text=f"{label}: {batch['finished']}/{batch['total']} evaluated"
+                             + (f", {batch['failed']} failed" if batch["failed"] else ""))
+            if batch["failed"]:
+                with st.expander(f"Failed files for {label}"):
+                    for file_name, error in job_queue.batch_failures(batch["batch_id"]):
+                        st.write(f"❌ {file_name}: {error}")
+            pending = pending or batch["finished"] < batch["total"]
+        if pending and st.checkbox("Auto-refresh while sheets are being evaluated", value=True):
+            time.sleep(2)
+            st.rerun()
+    else:
+        st.info("No evaluations queued yet.")
+
 # --- RESULTS PAGE ---
 elif selected == "Results":
     st.header("📊 Evaluation Results")
-    results_df = fetch_all_results_df(limit=5000)
-    
-    if not results_df.empty:
-        # Enhanced search bar
-        search_query = st.text_input("🔍 Search by student name or roll number...", placeholder="Type here to filter results...")
-        if search_query:
-            results_df = results_df[results_df["student_name"].str.contains(search_query, case=False) |
-                                    results_df["student_roll"].str.contains(search_query, case=False)]
+    # Enhanced search bar
+    search_query = st.text_input("🔍 Search by student name or roll number...", placeholder="Type here to filter results...")
+    total_rows = cached_count_results(search_query, None, results_revision)
+
+    if total_rows:
+        limit, offset = pagination_controls(total_rows, "results")
+        results_df, selector_options = cached_search_results(search_query, None, limit, offset, results_revision)
+        st.caption(f"Showing {offset + 1}–{offset + len(results_df)} of {total_rows} results")
 
         st.dataframe(results_df.drop(columns=["file_path"]), use_container_width=True)
         
         # Selectbox to show detailed results
-        selector_options = results_df.apply(lambda r: f"{r['student_name']} | {r['student_roll']} | {r['version']} | {r['created_at']}", axis=1).tolist()
         if selector_options:
             selector = st.selectbox("Select a result for details", selector_options)
             sel_idx = selector_options.index(selector)
@@ -349,10 +322,7 @@ elif selected == "Results":
             st.info(f"Showing OMR sheet for **{selected_row['student_name']} ({selected_row['student_roll']})**")
             
             try:
-                if selected_row['file_path'].lower().endswith(('.png', '.jpg', '.jpeg')):
-                    st.image(Image.open(selected_row['file_path']), caption=f"{selected_row['file_name']}", use_column_width=True)
-                else:
-                    st.warning("Preview not available (file may be PDF).")
+                preview_sheet(selected_row['file_path'], selected_row['file_name'], "results")
             except Exception as e:
                 st.error(f"Could not preview file: {e}")
             
@@ -371,20 +341,21 @@ elif selected == "Results":
                 "Total Score": int(selected_row["total_score"])
             })
         
-        st.download_button("⬇️ Download Results (CSV)", results_df.to_csv(index=False), file_name="results.csv")
+        export_controls("results", search_query)
+    elif search_query:
+        st.info("ℹ️ No results match your search.")
     else:
         st.info("ℹ️ No results available yet.")
 
 # --- FLAGGED SHEETS PAGE ---
 elif selected == "Flagged Sheets":
     st.header("⚠️ Flagged / Ambiguous Sheets")
-    conn = sqlite3.connect(DB_PATH)
-    flagged_df = pd.read_sql_query("SELECT * FROM results WHERE flagged=1 ORDER BY created_at DESC", conn)
-    conn.close()
-
     search_query = st.text_input("🔍 Search student", placeholder="Type a name to filter...")
-    if search_query:
-        flagged_df = flagged_df[flagged_df["student_name"].str.contains(search_query, case=False)]
+    total_flagged = cached_count_results(search_query, True, results_revision)
+    flagged_df = pd.DataFrame()
+    if total_flagged:
+        limit, offset = pagination_controls(total_flagged, "flagged")
+        flagged_df, _ = cached_search_results(search_query, True, limit, offset, results_revision)
 
     if not flagged_df.empty:
         st.dataframe(flagged_df, use_container_width=True)
@@ -392,13 +363,46 @@ elif selected == "Flagged Sheets":
         row = flagged_df[flagged_df["student_name"] == choice].iloc[0]
         st.warning(f"Reviewing sheet for **{choice}** — Reason: {row['flag_reason']}")
         try:
-            st.image(Image.open(row['file_path']), caption=f"{row['file_name']}", use_column_width=True)
+            preview_sheet(row['file_path'], row['file_name'], "flagged")
         except:
             st.info("Preview not available.")
-        st.download_button("⬇️ Download Flagged Sheets (CSV)", flagged_df.to_csv(index=False), file_name="flagged_sheets.csv")
+        export_controls("flagged_sheets", search_query, flagged=True)
     else:
         st.info("No flagged sheets to display.")
 
+# --- ITEM ANALYSIS PAGE ---
+elif selected == "Item Analysis":
+    st.header("📈 Item Analysis")
+    versions = cached_key_versions(keys_revision)
+    if versions:
+        version = st.selectbox("Answer Key Version", [str(v) for v in versions])
+        try:
+            analysis = item_analysis_for(version)
+        except Exception as e:
+            st.error(f"Could not analyse Version {version}: {e}")
+            analysis = None
+        if analysis is not None and len(analysis):
+            items = analysis.items()
+            st.caption(f"Based on {len(analysis)} evaluated sheets. Difficulty is the share of students "
+                       "answering correctly; discrimination is the item's correlation with the rest of the test.")
+
+            st.subheader("Subject Scores")
+            st.dataframe(analysis.subject_scores().round(2), use_container_width=True)
+
+            st.subheader("Questions")
+            review = items[(items["discrimination"] < 0.2) | (items["difficulty"] < 0.2) | (items["difficulty"] > 0.95)]
+            if not review.empty:
+                st.warning(f"{len(review)} questions are very hard, very easy or discriminate poorly: "
+                           + ", ".join(f"Q{q}" for q in review["question"]))
+            st.bar_chart(items.set_index("question")[["difficulty", "discrimination"]])
+            st.dataframe(items.round(3), use_container_width=True)
+            st.download_button("⬇️ Item Analysis (CSV)", items.to_csv(index=False),
+                               file_name=f"item_analysis_v{version}.csv")
+        elif analysis is not None:
+            st.info(f"No evaluated sheets stored for Version {version} yet.")
+    else:
+        st.info("Upload an answer key to analyse its exam.")
+
 # --- ADMIN PANEL PAGE ---
 elif selected == "Admin Panel":
     st.header("⚙️ Admin Panel")
@@ -413,20 +417,30 @@ elif selected == "Admin Panel":
     if st.button("💾 Save Answer Key"):
         if key_file:
             saved_path, saved_filename = save_uploaded_file(key_file, subdir=KEY_DIR, prefix=f"key_v{key_version}")
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO answer_keys (version, file_name, file_path, uploaded_at)
-                VALUES (?, ?, ?, ?)
-            """, (key_version, saved_filename, saved_path, datetime.datetime.now().isoformat()))
-            conn.commit()
-            conn.close()
+            save_answer_key(key_version, saved_filename, saved_path)
+            invalidate_answer_key(int(key_version))
             st.success(f"✅ Answer key uploaded for **Version {key_version}** and is ready for use.")
             if saved_path.lower().endswith(('.png', '.jpg', '.jpeg')):
                 st.image(Image.open(saved_path), caption=f"Answer Key (Version {key_version})", use_column_width=True)
         else:
             st.error("⚠️ Please upload a key file before saving.")
 
+    st.subheader("⏱️ Pipeline Performance")
+    pipeline_profile = get_pipeline_profile()
+    if len(pipeline_profile):
+        stage_summary = pd.DataFrame.from_dict(pipeline_profile.summary(), orient="index")
+        st.caption(f"Per-stage timings of the last {len(pipeline_profile)} evaluated sheets")
+        st.dataframe(stage_summary.round(2), use_container_width=True)
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("⬇️ Stage Summary (JSON)", stage_summary.to_json(orient="index", indent=2),
+                               file_name="pipeline_profile.json")
+        with col2:
+            st.download_button("⬇️ Raw Timings (CSV)", pd.DataFrame(pipeline_profile.records()).to_csv(index=False),
+                               file_name="pipeline_profile.csv")
+    else:
+        st.info("No sheets evaluated since the server started.")
+
 # --- FOOTER ---
 st.markdown("""
     <div class="footer">
@@ -0,0 +1,97 @@
+import os
+import re
+import csv
+import threading
+import numpy as np
+import pandas as pd
+from omr_to_csv import subjects, questions_per_subject, options
+
+# "1 - a", "81. a", "12 - a,c"
+_ANSWER_CELL = re.compile(r"^\s*(\d+)\s*[-.]\s*([a-dA-D](?:\s*,\s*[a-dA-D])*)\s*$")
+
+# version -> (key_path, mtime_ns, size, AnswerKey)
+_cache = {}
+_cache_lock = threading.Lock()
+
+class AnswerKey:
+    """
+    An answer key compiled once for scoring.
+
+    answers: {question_number: "a"} as parsed from the key file
+    mask: (questions, options) bool array, row q-1 holds the correct option(s) of question q
+    keyed: bool array marking which questions have an answer in the key
+    subject_ranges: [(start, end), ...] row slices of mask per subject
+    """
+
+    def __init__(self, answers):
+        self.answers = answers
+        n_questions = max(len(subjects) * questions_per_subject, max(answers) if answers else 0)
+        self.mask = np.zeros((n_questions, len(options)), dtype=bool)
+        for question, answer in answers.items():
+            for opt in answer.split(","):
+                self.mask[question - 1, options.index(opt.strip())] = True
+        self.keyed = self.mask.any(axis=1)
+        self.subject_ranges = [(i * questions_per_subject, (i + 1) * questions_per_subject)
+                               for i in range(len(subjects))]
+
+    def __len__(self):
+        return len(self.answers)
+
+def parse_answer_key(key_path):
+    """
+    Parse a key file into {question_number: "a"}. Cells look like "1 - a" or "81. a";
+    anything else (titles, headers) is ignored. Non-spreadsheet keys fall back to all "a".
+    """
+    lower = key_path.lower()
+    if lower.endswith('.csv'):
+        # csv.reader copes with the ragged "Table 1" title row that trips up pd.read_csv
+        with open(key_path, newline='', encoding='utf-8-sig') as f:
+            cells = [cell for row in csv.reader(f) for cell in row]
+    elif lower.endswith(('.xlsx', '.xls')):
+        cells = pd.read_excel(key_path, header=None, dtype=str).to_numpy().ravel()
+    else:
+        return {i: "a" for i in range(1, len(subjects) * questions_per_subject + 1)}
+
+    answer_key = {}
+    for cell in cells:
+        if isinstance(cell, str):
+            match = _ANSWER_CELL.match(cell)
+            if match:
+                answer_key[int(match.group(1))] = ",".join(
+                    part.strip().lower() for part in match.group(2).split(","))
+    if not answer_key:
+        raise ValueError("Could not parse answer key data. Check format.")
+    return answer_key
+
+def get_answer_key(version, key_path_lookup):
+    """
+    Return the compiled AnswerKey for `version`, or None if no key is registered.
+
+    key_path_lookup(version) -> path runs on every call (one indexed query), so a
+    key saved by another process is picked up on its next lookup. The compiled key
+    is reused while the version still points at the same file with the same mtime
+    and size, so scoring a batch parses the key once.
+    """
+    key_path = key_path_lookup(version)
+    if not key_path:
+        with _cache_lock:
+            _cache.pop(version, None)
+        return None
+    stat = os.stat(key_path)
+    with _cache_lock:
+        entry = _cache.get(version)
+    if entry is not None and entry[:3] == (key_path, stat.st_mtime_ns, stat.st_size):
+        return entry[3]
+
+    answer_key = AnswerKey(parse_answer_key(key_path))
+    with _cache_lock:
+        _cache[version] = (key_path, stat.st_mtime_ns, stat.st_size, answer_key)
+    return answer_key
+
+def invalidate_answer_key(version=None):
+    """Forget the cached key for `version` (or every version) so the next lookup re-reads it."""
+    with _cache_lock:
+        if version is None:
+            _cache.clear()
+        else:
+            _cache.pop(version, None)
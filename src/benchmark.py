@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import datetime
+import platform
+import subprocess
+import tempfile
+import cv2
+import numpy as np
+
+from extract_multiple_answers import BUBBLE_DETECTORS, process_image, list_image_tasks
+from omr_to_csv import extract_answers_from_image, answers_to_marks, load_answers_csv
+from pipeline import process_sheet_file, read_sheet_file
+from answer_key import AnswerKey, parse_answer_key
+from scoring import stack_marks, score_batch
+from profiling import SheetProfile, BatchProfile, print_profile
+
+VARIANTS = ["original", "scaled", "rotated", "dark"]
+# "components" is the single-pass pipeline with the connected-component bubble detector
+MODES = ["two_pass", "pipeline", "components"]
+
+def make_variant(image, variant):
+    """Synthetic stress variants of a real scan: 1.5x upscale, 3 degree skew, 45% exposure."""
+    if variant == "scaled":
+        return cv2.resize(image, None, fx=1.5, fy=1.5, interpolation=cv2.INTER_CUBIC)
+    if variant == "rotated":
+        h, w = image.shape[:2]
+        M = cv2.getRotationMatrix2D((w / 2, h / 2), 3, 1.0)
+        return cv2.warpAffine(image, M, (w, h), borderMode=cv2.BORDER_REPLICATE)
+    if variant == "dark":
+        return cv2.convertScaleAbs(image, alpha=0.45)
+    return image
+
+def prepare_variant(input_dir, work_dir, variant):
+    """
+    Return [(sheet_path, set_name, sheet_name)] for a variant. Originals are used
+    in place; other variants are written losslessly (PNG) under work_dir.
+    """
+    sheets = []
+    for image_path, _ in list_image_tasks(input_dir, work_dir):
+        set_name = os.path.basename(os.path.dirname(image_path))
+        sheet_name = os.path.splitext(os.path.basename(image_path))[0]
+        if variant != "original":
+            image = cv2.imread(image_path)
+            if image is None:
+                continue
+            variant_path = os.path.join(work_dir, variant, set_name, sheet_name + ".png")
+            os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+            cv2.imwrite(variant_path, make_variant(image, variant))
+            image_path = variant_path
+        sheets.append((image_path, set_name, sheet_name))
+    return sheets
+
+def _prefixed(profile, prefix):
+    return [dict(record, stage=prefix + record["stage"]) for record in profile.to_records()]
+
+def run_sheet(image_path, mode, work_dir):
+    """Evaluate one sheet with `mode`; returns (answers_data or None, stage records)."""
+    if mode in ("pipeline", "components"):
+        profile = SheetProfile(image_path)
+        answers = process_sheet_file(image_path, profile=profile,
+                                     detector="components" if mode == "components" else "contours")
+        return answers, profile.to_records()
+
+    # two_pass: highlight with extract_multiple_answers, then read the highlighted image back
+    highlighted_path = os.path.join(work_dir, "highlighted", os.path.basename(os.path.dirname(image_path)),
+                                    os.path.basename(image_path))
+    detect, extract = SheetProfile(image_path), SheetProfile(image_path)
+    process_image(image_path, highlighted_path, detect)
+    result = extract_answers_from_image(highlighted_path, extract)
+    return result[0] if result is not None else None, _prefixed(detect, "detect_") + _prefixed(extract, "extract_")
+
+def accuracy(predicted, truth):
+    """(question accuracy, bubble accuracy) of (N, Q, options) mark arrays."""
+    if not len(truth):
+        return None, None
+    return float((predicted == truth).all(axis=2).mean()), float((predicted == truth).mean())
+
+def benchmark_run(sheets, mode, work_dir, truth_dir, key_dir, repeat=1):
+    """
+    Time one (variant, mode) combination over `sheets` and compare its answers with
+    the hand-verified reference CSVs in truth_dir/<set>/<sheet>.csv. Throughput is the
+    median over `repeat` passes; accuracy and stage timings come from every pass.
+    A sheet that raises counts as failed and its error is kept in the report.
+    """
+    profile = BatchProfile()
+    elapsed, answers, errors = [], {}, {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for image_path, set_name, sheet_name in sheets:
+            try:
+                sheet_answers, records = run_sheet(image_path, mode, work_dir)
+            except Exception as e:
+                print(f"Error reading {image_path}: {type(e).__name__}: {e}")
+                errors[f"{set_name}/{sheet_name}"] = f"{type(e).__name__}: {e}"
+                sheet_answers, records = None, []
+            profile.add_records(records)
+            answers[(set_name, sheet_name)] = sheet_answers
+        elapsed.append(time.perf_counter() - start)
+    failed = sum(1 for a in answers.values() if a is None)
+
+    predicted, truth, by_set = [], [], {}
+    for (set_name, sheet_name), sheet_answers in answers.items():
+        truth_path = os.path.join(truth_dir, set_name, sheet_name + ".csv")
+        if not os.path.exists(truth_path):
+            continue
+        truth.append(answers_to_marks(load_answers_csv(truth_path)))
+        predicted.append(answers_to_marks(sheet_answers) if sheet_answers else np.zeros_like(truth[-1]))
+        by_set.setdefault(set_name, []).append(len(predicted) - 1)
+    predicted, truth = np.array(predicted), np.array(truth)
+    question_accuracy, bubble_accuracy = accuracy(predicted, truth)
+
+    # Score drift against the reference answers for every set that has a key
+    score_errors = []
+    for set_name, rows in by_set.items():
+        key_path = os.path.join(key_dir, set_name + ".csv")
+        if os.path.exists(key_path):
+            answer_key = AnswerKey(parse_answer_key(key_path))
+            n_questions = answer_key.mask.shape[0]
+            pred_total = score_batch(stack_marks(list(predicted[rows]), n_questions), answer_key)["total"]
+            true_total = score_batch(stack_marks(list(truth[rows]), n_questions), answer_key)["total"]
+            score_errors.extend(np.abs(pred_total - true_total).tolist())
+
+    stages = profile.summary()
+    median_elapsed = float(np.median(elapsed))
+    return {
+        "sheets": len(sheets),
+        "failed": failed,
+        "elapsed_s": median_elapsed,
+        "sheets_per_sec": len(sheets) / median_elapsed if median_elapsed > 0 else 0.0,
+        "peak_rss_mb": max((s["max_rss_mb"] for s in stages.values()), default=0.0),
+        "question_accuracy": question_accuracy,
+        "bubble_accuracy": bubble_accuracy,
+        "score_mae": float(np.mean(score_errors)) if score_errors else None,
+        "errors": errors,
+        "stages": stages,
+    }
+
+def detector_agreement(sheets):
+    """
+    How closely the connected-component detector reproduces the contour detector's
+    marks on `sheets`: the share of sheets and of questions read identically. A sheet
+    either detector raises on counts as failed and its error is kept in the report.
+    """
+    same_sheets, same_questions, questions = 0, 0, 0
+    errors = {}
+    for image_path, set_name, sheet_name in sheets:
+        results = []
+        for detector in BUBBLE_DETECTORS:
+            try:
+                results.append(read_sheet_file(image_path, detector=detector))
+            except Exception as e:
+                print(f"Error reading {image_path} with {detector}: {type(e).__name__}: {e}")
+                errors[f"{set_name}/{sheet_name}"] = f"{detector}: {type(e).__name__}: {e}"
+                break
+        else:
+            marks = [result[0] if result is not None else np.zeros((0, 4), dtype=bool) for result in results]
+            n = max(len(m) for m in marks)
+            marks = stack_marks(marks, n)
+            same = (marks[0] == marks[1]).all(axis=1)
+            same_sheets += bool(same.all())
+            same_questions += int(same.sum())
+            questions += n
+    return {"sheets": len(sheets), "same_sheets": same_sheets, "failed": len(errors),
+            "question_agreement": same_questions / questions if questions else None, "errors": errors}
+
+def benchmark_scoring(truth_dir, key_dir, n_sheets=10000):
+    """Throughput of score_batch on reference marks tiled up to n_sheets."""
+    results = {}
+    for key_path in sorted(glob.glob(os.path.join(key_dir, "*.csv"))):
+        set_name = os.path.splitext(os.path.basename(key_path))[0]
+        csv_files = sorted(glob.glob(os.path.join(truth_dir, set_name, "*.csv")))
+        if not csv_files:
+            continue
+        answer_key = AnswerKey(parse_answer_key(key_path))
+        marks = stack_marks([answers_to_marks(load_answers_csv(f)) for f in csv_files], answer_key.mask.shape[0])
+        marks = np.resize(marks, (n_sheets,) + marks.shape[1:])
+        start = time.perf_counter()
+        score_batch(marks, answer_key)
+        elapsed = time.perf_counter() - start
+        results[set_name] = {"sheets": n_sheets, "sheets_per_sec": n_sheets / elapsed if elapsed > 0 else 0.0}
+    return results
+
+def run_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created_at": datetime.datetime.now().isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+    }
+
+def run_benchmark(input_dir="data/input", truth_dir="data/reference", key_dir="data/input/keys",
+                  variants=VARIANTS, modes=MODES, repeat=1, work_dir=None):
+    """Run every (variant, mode) combination plus the scoring benchmark and return the report dict."""
+    own_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="omr_bench_")
+    # Stage timings are per sheet; keep OpenCV on one thread so runs are comparable across machines
+    cv2.setNumThreads(1)
+    report = {"meta": run_metadata(), "runs": []}
+    try:
+        for variant in variants:
+            sheets = prepare_variant(input_dir, work_dir, variant)
+            for mode in modes:
+                print(f"Benchmarking {variant}/{mode} ({len(sheets)} sheets)...")
+                result = benchmark_run(sheets, mode, work_dir, truth_dir, key_dir, repeat)
+                report["runs"].append(dict(variant=variant, mode=mode, **result))
+            if "components" in modes:
+                report.setdefault("detector_agreement", {})[variant] = detector_agreement(sheets)
+        report["scoring"] = benchmark_scoring(truth_dir, key_dir)
+    finally:
+        if own_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+def _fmt(value, spec):
+    return format(value, spec) if value is not None else "-"
+
+def print_report(report):
+    print(f"{'variant':<10}{'mode':<12}{'sheets/s':>10}{'failed':>8}{'q acc':>8}{'bubble acc':>12}"
+          f"{'score mae':>11}{'rss MB':>9}")
+    for run in report["runs"]:
+        print(f"{run['variant']:<10}{run['mode']:<12}{run['sheets_per_sec']:>10.2f}{run['failed']:>8}"
+              f"{_fmt(run['question_accuracy'], '.1%'):>8}{_fmt(run['bubble_accuracy'], '.1%'):>12}"
+              f"{_fmt(run['score_mae'], '.2f'):>11}{run['peak_rss_mb']:>9.0f}")
+    for run in report["runs"]:
+        for sheet, error in run.get("errors", {}).items():
+            print(f"failed {run['variant']}/{run['mode']} {sheet}: {error}")
+    for variant, a in report.get("detector_agreement", {}).items():
+        print(f"components vs contours {variant}: {a['same_sheets']}/{a['sheets']} sheets identical, "
+              f"{_fmt(a['question_agreement'], '.2%')} of questions, {a.get('failed', 0)} failed")
+        for sheet, error in a.get("errors", {}).items():
+            print(f"failed agreement {variant} {sheet}: {error}")
+    for set_name, s in report.get("scoring", {}).items():
+        print(f"score_batch {set_name}: {s['sheets_per_sec']:.0f} sheets/sec")
+
+def compare_reports(baseline, candidate, tolerance=0.10, accuracy_tolerance=0.001):
+    """
+    Print per-run deltas between two reports and return the list of regressions:
+    throughput down by more than `tolerance` (fraction) or accuracy down by more
+    than `accuracy_tolerance`.
+    """
+    old_runs = {(r["variant"], r["mode"]): r for r in baseline["runs"]}
+    regressions = []
+    print(f"{'variant':<10}{'mode':<12}{'sheets/s':>20}{'change':>9}{'q acc':>18}")
+    for run in candidate["runs"]:
+        old = old_runs.get((run["variant"], run["mode"]))
+        if old is None:
+            continue
+        name = f"{run['variant']}/{run['mode']}"
+        change = run["sheets_per_sec"] / old["sheets_per_sec"] - 1 if old["sheets_per_sec"] else 0.0
+        print(f"{run['variant']:<10}{run['mode']:<12}{old['sheets_per_sec']:>9.2f} -> {run['sheets_per_sec']:<7.2f}"
+              f"{change:>+9.1%}{_fmt(old['question_accuracy'], '.1%'):>9} -> {_fmt(run['question_accuracy'], '.1%')}")
+        if change < -tolerance:
+            regressions.append(f"{name}: throughput {change:+.1%}")
+        if old["question_accuracy"] is not None and run["question_accuracy"] is not None and \
+                run["question_accuracy"] < old["question_accuracy"] - accuracy_tolerance:
+            regressions.append(f"{name}: question accuracy {old['question_accuracy']:.2%} -> "
+                               f"{run['question_accuracy']:.2%}")
+        for stage_name, s in run["stages"].items():
+            old_stage = old["stages"].get(stage_name)
+            if old_stage and old_stage["p50_ms"] > 1 and s["p50_ms"] > old_stage["p50_ms"] * (1 + tolerance):
+                print(f"    {stage_name}: p50 {old_stage['p50_ms']:.1f} -> {s['p50_ms']:.1f} ms")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark OMR speed and accuracy over the sample sets.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark and write a JSON report")
+    run_parser.add_argument("--input-dir", default="data/input")
+    run_parser.add_argument("--truth-dir", default="data/reference", help="hand-verified answer CSVs per set")
+    run_parser.add_argument("--key-dir", default="data/input/keys")
+    run_parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=VARIANTS)
+    run_parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    run_parser.add_argument("--repeat", type=int, default=1, help="timed passes per run (median is reported)")
+    run_parser.add_argument("--work-dir", default=None, help="keep generated variants here instead of a temp dir")
+    run_parser.add_argument("--output", default="benchmark.json")
+    run_parser.add_argument("--stages", action="store_true", help="also print per-stage latency tables")
+
+    compare_parser = commands.add_parser("compare", help="compare two reports and fail on regressions")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--tolerance", type=float, default=0.10,
+                                help="allowed throughput drop as a fraction (default 0.10)")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        report = run_benchmark(args.input_dir, args.truth_dir, args.key_dir, args.variants, args.modes,
+                               args.repeat, args.work_dir)
+        print_report(report)
+        if args.stages:
+            for run in report["runs"]:
+                print(f"\n{run['variant']}/{run['mode']}")
+                print_profile(run["stages"])
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved report to {args.output}")
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+        regressions = compare_reports(baseline, candidate, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
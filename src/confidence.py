@@ -0,0 +1,121 @@
+from functools import lru_cache
+import cv2
+import numpy as np
+
+# First pass: a bubble is marked when its mean intensity is below the fill threshold
+# (150 by default) and more than FILL_RATIO of its pixels are at or below it
+FILL_RATIO = 0.35
+# Distance from those thresholds, in grey levels and in share of pixels, at which a
+# decision is certain; confidence falls off linearly towards the threshold
+LEVEL_MARGIN = 30
+RATIO_MARGIN = 0.15
+# Bubbles detection missed are screened by how much darker their inner disc is than the
+# paper in a square ring SURROUND radii out (inside the neighbouring bubbles), as a share
+# of the paper's brightness: marked above CONTRAST_FILL, certainly so CONTRAST_MARGIN away
+SURROUND = (1.15, 1.5)
+CONTRAST_FILL = 0.45
+CONTRAST_MARGIN = 0.35
+# Decisions less confident than this are ambiguous: they get the second pass, and a
+# sheet that still has one afterwards is flagged for review
+AMBIGUOUS_CONFIDENCE = 0.5
+# Second pass: a window this many bubble radii around the bubble is cut out and
+# resampled so the bubble's radius spans RECHECK_RADIUS pixels, and ink is measured
+# inside RECHECK_INNER radii (clear of the printed ring)
+RECHECK_WINDOW = 1.6
+RECHECK_RADIUS = 40
+RECHECK_INNER = 0.7
+# Ink must be this many grey levels darker than the window's paper
+RECHECK_MIN_CONTRAST = 25
+# A bubble is marked when ink covers more than RECHECK_FILL of its inner disc,
+# certainly so RECHECK_MARGIN away from it. Filled bubbles cover nearly all of it;
+# crossed-out or scribbled ones leave paper between the strokes and land in between
+RECHECK_FILL = 0.7
+RECHECK_MARGIN = 0.25
+
+def mark_confidence(fill_level, fill_ratio, fill_threshold=150):
+    """
+    First-pass decision from a bubble's mean intensity and fill ratio (see
+    utils.label_fill_stats). Returns (marked, confidence), confidence in 0-1
+    growing with the distance from the nearer deciding threshold.
+    """
+    level = (fill_threshold - np.asarray(fill_level, dtype=np.float64)) / LEVEL_MARGIN
+    ratio = (np.asarray(fill_ratio, dtype=np.float64) - FILL_RATIO) / RATIO_MARGIN
+    # Marked needs both tests to pass, so the weaker one decides; unmarked needs only
+    # one to fail, so the stronger failure decides: both are the smaller margin
+    margin = np.minimum(level, ratio)
+    return margin > 0, np.clip(np.abs(margin), 0, 1)
+
+def _box_sums(integral, centers, half):
+    """Pixel sums and areas of the squares of half-side `half` around (n, 2) centers, from an integral image."""
+    h, w = integral.shape[0] - 1, integral.shape[1] - 1
+    x0, y0 = (np.clip(np.round(centers - half).astype(int), 0, (w, h))).T
+    x1, y1 = (np.clip(np.round(centers + half).astype(int) + 1, 0, (w, h))).T
+    sums = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return sums, np.maximum((x1 - x0) * (y1 - y0), 1)
+
+def sample_contrast(gray, centers, radius):
+    """
+    Darkness of every bubble at (n, 2) `centers` against the paper around it:
+    1 - inner mean / surround mean, with the inner disc and the surround ring
+    approximated by squares so all of them come from one integral image.
+    Shading darkens both alike, so unlike a fixed threshold this holds in
+    shadows and on dim photos.
+    """
+    integral = cv2.integral(gray)
+    inner, inner_area = _box_sums(integral, centers, RECHECK_INNER * radius / np.sqrt(2))
+    near, near_area = _box_sums(integral, centers, SURROUND[0] * radius)
+    far, far_area = _box_sums(integral, centers, SURROUND[1] * radius)
+    paper = (far - near) / np.maximum(far_area - near_area, 1)
+    return 1 - (inner / inner_area) / np.maximum(paper, 1)
+
+def contrast_confidence(contrast):
+    """First-pass decision from sample_contrast; returns (marked, confidence) like mark_confidence."""
+    margin = (np.asarray(contrast, dtype=np.float64) - CONTRAST_FILL) / CONTRAST_MARGIN
+    return margin > 0, np.clip(np.abs(margin), 0, 1)
+
+@lru_cache(maxsize=4)
+def _disc(size, radius):
+    """uint8 mask of a disc of `radius` at the middle of a size x size window."""
+    disc = np.zeros((size, size), dtype=np.uint8)
+    cv2.circle(disc, (size // 2, size // 2), radius, 255, -1)
+    return disc
+
+def ink_share(gray, center, radius):
+    """
+    Share of a bubble's inner disc covered by ink, judged locally: the window
+    around it is resampled to a fixed size (sub-pixel centered) and split by its
+    own Otsu threshold, so shading, a light pen or a mark off-center doesn't
+    depend on the sheet-wide threshold.
+    """
+    zoom = RECHECK_RADIUS / radius
+    half = RECHECK_WINDOW * radius
+    size = int(round(2 * RECHECK_WINDOW * RECHECK_RADIUS))
+    x, y = center
+    # One warp both cuts the window and resizes it (bicubic)
+    M = np.array([[zoom, 0, zoom * (half - x)],
+                  [0, zoom, zoom * (half - y)]])
+    window = cv2.warpAffine(gray, M, (size, size), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    otsu, bright = cv2.threshold(window, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Otsu always splits the window in two; on plain paper the split is noise, so ink
+    # must also be clearly darker than the paper (the brighter side's mean)
+    paper = cv2.mean(window, mask=bright)[0]
+    inner = _disc(size, int(round(RECHECK_INNER * RECHECK_RADIUS)))
+    ink = cv2.countNonZero(cv2.bitwise_and(inner, cv2.compare(window, min(otsu, paper - RECHECK_MIN_CONTRAST),
+                                                              cv2.CMP_LE)))
+    return ink / max(1, cv2.countNonZero(inner))
+
+def recheck_bubbles(gray, centers, radius):
+    """
+    Second pass for the bubbles at `centers` ((n, 2) image coordinates of `gray`,
+    the sheet before contrast equalization, at the highest resolution available);
+    `radius` is one radius or one per bubble. Much slower per bubble than the
+    first pass, so it is only run on ambiguous ones. Returns (marked, confidence,
+    ink) like mark_confidence, plus the ink share of each inner disc.
+    """
+    radii = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(centers),))
+    ink = np.array([ink_share(gray, c, r) for c, r in zip(centers, radii)])
+    return ink > RECHECK_FILL, np.clip(np.abs(ink - RECHECK_FILL) / RECHECK_MARGIN, 0, 1), ink
+
+def uncertain_questions(confidence):
+    """0-based questions with a decision below AMBIGUOUS_CONFIDENCE in a (questions, options) array."""
+    return np.flatnonzero((confidence < AMBIGUOUS_CONFIDENCE).any(axis=1))
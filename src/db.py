@@ -0,0 +1,282 @@
+import sqlite3
+import datetime
+import threading
+import pandas as pd
+
+DB_PATH = "omr_results.db"
+
+_local = threading.local()
+
+# db_path -> whether the results_fts full-text index could be created
+_fts_enabled = {}
+
+RESULT_COLUMNS = [
+    ("student_name", "Student Name", None),
+    ("student_roll", "Student ID", None),
+    ("class_batch", "Class", None),
+    ("email", "Email", None),
+    ("file_name", "File Name", None),
+    ("file_path", "File Path", None),
+    ("version", "Version", None),
+    ("subject1", "Subject 1", 0),
+    ("subject2", "Subject 2", 0),
+    ("subject3", "Subject 3", 0),
+    ("subject4", "Subject 4", 0),
+    ("subject5", "Subject 5", 0),
+    ("total_score", "Total Score", 0),
+    ("flagged", "Flagged", 0),
+    ("flag_reason", "Flag Reason", None),
+    ("created_at", "Created At", None),
+]
+
+def get_connection(db_path=DB_PATH):
+    """
+    Return this thread's connection to db_path, opening it on first use.
+    Connections run in WAL mode so readers never block the writer, and wait
+    on a busy database instead of failing with "database is locked".
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        connections[db_path] = conn
+    return conn
+
+def init_db(db_path=DB_PATH):
+    """Create results and answer_keys tables if they don't exist."""
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_name TEXT,
+            student_roll TEXT,
+            class_batch TEXT,
+            email TEXT,
+            file_name TEXT,
+            file_path TEXT,
+            version TEXT,
+            subject1 INTEGER DEFAULT 0,
+            subject2 INTEGER DEFAULT 0,
+            subject3 INTEGER DEFAULT 0,
+            subject4 INTEGER DEFAULT 0,
+            subject5 INTEGER DEFAULT 0,
+            total_score INTEGER DEFAULT 0,
+            flagged INTEGER DEFAULT 0,
+            flag_reason TEXT,
+            created_at TEXT
+        )
+        """)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS answer_keys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            version INTEGER,
+            file_name TEXT,
+            file_path TEXT,
+            uploaded_at TEXT
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_created_at ON results(created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_flagged ON results(flagged, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_roll ON results(student_roll)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_version ON results(version)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_keys_version ON answer_keys(version, uploaded_at)")
+    _fts_enabled[db_path] = _init_fts(conn)
+
+def _init_fts(conn):
+    """
+    Keep an FTS5 index over student name/roll in sync with results via triggers.
+    Returns False when this SQLite build has no FTS5; searches then fall back to LIKE.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='results_fts'").fetchone()
+    try:
+        with conn:
+            conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS results_fts
+            USING fts5(student_name, student_roll, content='results', content_rowid='id')
+            """)
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS results_fts_insert AFTER INSERT ON results BEGIN
+                INSERT INTO results_fts(rowid, student_name, student_roll)
+                VALUES (new.id, new.student_name, new.student_roll);
+            END
+            """)
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS results_fts_delete AFTER DELETE ON results BEGIN
+                INSERT INTO results_fts(results_fts, rowid, student_name, student_roll)
+                VALUES ('delete', old.id, old.student_name, old.student_roll);
+            END
+            """)
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS results_fts_update AFTER UPDATE OF student_name, student_roll ON results BEGIN
+                INSERT INTO results_fts(results_fts, rowid, student_name, student_roll)
+                VALUES ('delete', old.id, old.student_name, old.student_roll);
+                INSERT INTO results_fts(rowid, student_name, student_roll)
+                VALUES (new.id, new.student_name, new.student_roll);
+            END
+            """)
+            if not exists:
+                # Index rows that were inserted before the FTS table existed
+                conn.execute("INSERT INTO results_fts(results_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+def _result_values(row):
+    values = []
+    for column, key, default in RESULT_COLUMNS:
+        if column == "created_at":
+            values.append(row.get(key, datetime.datetime.now().isoformat()))
+        else:
+            values.append(row.get(key, default))
+    return values
+
+def insert_results(rows, db_path=DB_PATH):
+    """
+    Insert result rows (dicts keyed like "Student Name", "Subject 1", ...) in a
+    single transaction and return their new ids.
+    """
+    sql = "INSERT INTO results ({}) VALUES ({})".format(
+        ", ".join(column for column, _, _ in RESULT_COLUMNS),
+        ", ".join("?" for _ in RESULT_COLUMNS))
+    conn = get_connection(db_path)
+    ids = []
+    with conn:
+        cursor = conn.cursor()
+        for row in rows:
+            cursor.execute(sql, _result_values(row))
+            ids.append(cursor.lastrowid)
+    return ids
+
+def insert_result(row, db_path=DB_PATH):
+    """Insert a result row into DB and return its id."""
+    return insert_results([row], db_path)[0]
+
+def fetch_all_results_df(limit=1000, db_path=DB_PATH):
+    return pd.read_sql_query("SELECT * FROM results ORDER BY created_at DESC LIMIT ?",
+                             get_connection(db_path), params=(limit,))
+
+def fetch_dashboard_stats(db_path=DB_PATH):
+    """Return (total, processed, flagged) result counts from a single aggregate query."""
+    total, processed, flagged = get_connection(db_path).execute("""
+        SELECT COUNT(*), COALESCE(SUM(flagged = 0), 0), COALESCE(SUM(flagged = 1), 0) FROM results
+    """).fetchone()
+    return total, processed, flagged
+
+def data_revision(db_path=DB_PATH):
+    """
+    (last result id, last answer key id): changes whenever a result or key is
+    added, so callers can cache reads against it. Both lookups use the rowid
+    index and cost the same however many results there are.
+    """
+    return get_connection(db_path).execute(
+        "SELECT (SELECT MAX(id) FROM results), (SELECT MAX(id) FROM answer_keys)").fetchone()
+
+def _fts_query(text):
+    # Each word becomes a quoted prefix term: 'ana 12' -> '"ana"* "12"*'
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in text.split())
+
+def _search_filter(query, flagged, db_path):
+    clauses, params = [], []
+    if query and query.strip():
+        if _fts_enabled.get(db_path):
+            clauses.append("id IN (SELECT rowid FROM results_fts WHERE results_fts MATCH ?)")
+            params.append(_fts_query(query))
+        else:
+            clauses.append("(student_name LIKE ? OR student_roll LIKE ?)")
+            params += [f"%{query.strip()}%"] * 2
+    if flagged is not None:
+        clauses.append("flagged = ?")
+        params.append(1 if flagged else 0)
+    return (f"WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+def count_results(query=None, flagged=None, db_path=DB_PATH):
+    """Number of results matching search_results' filters."""
+    where, params = _search_filter(query, flagged, db_path)
+    return get_connection(db_path).execute(f"SELECT COUNT(*) FROM results {where}", params).fetchone()[0]
+
+def search_results(query=None, flagged=None, limit=50, offset=0, db_path=DB_PATH):
+    """
+    Server-side search and pagination over results, newest first.
+
+    query matches student name or roll (FTS5 prefix match, or a LIKE substring
+    match when FTS5 is unavailable); flagged=True/False restricts to flagged or
+    clean sheets. Returns one page as a DataFrame; see count_results for the total.
+    """
+    where, params = _search_filter(query, flagged, db_path)
+    columns = ", ".join(["id"] + [column for column, _, _ in RESULT_COLUMNS])
+    return pd.read_sql_query(f"SELECT {columns} FROM results {where} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                             get_connection(db_path), params=params + [limit, offset])
+
+def iter_results(chunk_rows=5000, version=None, class_batch=None, date_from=None, date_to=None,
+                 flagged=None, query=None, db_path=DB_PATH):
+    """
+    Yield every result matching the filters as DataFrames of at most chunk_rows
+    rows, oldest first. Rows are pulled from one cursor with fetchmany, so only
+    a single chunk is ever held in memory.
+
+    date_from / date_to are inclusive dates ("2025-09-01" or datetime.date);
+    query and flagged filter as in search_results.
+    """
+    where, params = _search_filter(query, flagged, db_path)
+    clauses = [where[len("WHERE "):]] if where else []
+    if version is not None:
+        clauses.append("version = ?")
+        params.append(str(version))
+    if class_batch:
+        clauses.append("class_batch = ?")
+        params.append(class_batch)
+    if date_from is not None:
+        clauses.append("created_at >= ?")
+        params.append(str(date_from))
+    if date_to is not None:
+        # created_at is an ISO timestamp, so the whole of date_to sorts before the next day
+        clauses.append("created_at < ?")
+        params.append(str(pd.Timestamp(str(date_to)).date() + datetime.timedelta(days=1)))
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    # A private connection keeps the read transaction apart from this thread's writes
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        columns = ", ".join(["id"] + [column for column, _, _ in RESULT_COLUMNS])
+        cursor = conn.execute(f"SELECT {columns} FROM results {where} ORDER BY id", params)
+        columns = [d[0] for d in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=columns)
+    finally:
+        conn.close()
+
+def fetch_class_batches(db_path=DB_PATH):
+    rows = get_connection(db_path).execute(
+        "SELECT DISTINCT class_batch FROM results WHERE class_batch != '' ORDER BY class_batch").fetchall()
+    return [row[0] for row in rows]
+
+def fetch_key_versions(db_path=DB_PATH):
+    rows = get_connection(db_path).execute("SELECT DISTINCT version FROM answer_keys").fetchall()
+    return [row[0] for row in rows]
+
+def load_answer_key(version, db_path=DB_PATH):
+    """
+    Fetches the file path for a given answer key version.
+    Returns the file path or None if not found.
+    """
+    row = get_connection(db_path).execute(
+        "SELECT file_path FROM answer_keys WHERE version=? ORDER BY uploaded_at DESC LIMIT 1",
+        (version,)).fetchone()
+    return row[0] if row else None
+
+def save_answer_key(version, file_name, file_path, db_path=DB_PATH):
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute("""
+            INSERT INTO answer_keys (version, file_name, file_path, uploaded_at)
+            VALUES (?, ?, ?, ?)
+        """, (version, file_name, file_path, datetime.datetime.now().isoformat()))
@@ -0,0 +1,138 @@
+import datetime
+from contextlib import nullcontext
+from pipeline import read_sheet_file, PIPELINE_MODULES
+from pdf_ingest import PDF_DPI
+from result_cache import CACHE_DB_PATH, file_digest, params_digest, lookup, store
+from scoring import score_sheet
+from confidence import uncertain_questions
+from omr_to_csv import grid_misfit
+from answer_key import get_answer_key
+from profiling import SheetProfile
+from thumbnails import get_thumbnail
+from responses import pack_marks, unpack_marks, pack_fill, unpack_fill, store_responses
+from db import DB_PATH, insert_result, load_answer_key
+
+def evaluate_omr(sheet_path, version, page=None, profile=None, db_path=DB_PATH, cache_db=CACHE_DB_PATH):
+    """
+    Evaluates an OMR sheet against a saved answer key.
+    The sheet is run through the in-process OMR pipeline (src/pipeline.py);
+    for a multi-page PDF only `page` is rasterized. Answers are cached by the
+    sheet's content hash in cache_db (see result_cache), so re-uploading the same
+    sheet only re-scores it. The returned scores carry the sheet's "Marks" and "Fill"
+    arrays for the response store (see responses.py); sheets with blank or
+    uncertain answers, or whose bubbles did not fit the question grid, are
+    flagged with the reasons (see flag_reasons).
+    """
+    try:
+        compiled_key = get_answer_key(version, lambda v: load_answer_key(v, db_path))
+    except Exception as e:
+        return {
+            "Total Score": 0,
+            "Flagged": 1,
+            "Flag Reason": f"Error parsing answer key: {e}",
+        }
+    if compiled_key is None:
+        return {
+            "Total Score": 0,
+            "Flagged": 1,
+            "Flag Reason": f"No answer key found for Version {version}",
+        }
+
+    try:
+        content_hash = file_digest(sheet_path, cache_db) + (f"#page={page}" if page else "")
+        params = params_digest(PIPELINE_MODULES, dpi=PDF_DPI)
+        cached = lookup(content_hash, params, "evaluate", cache_db)
+        if cached is not None:
+            questions = cached[1]["questions"]
+            marks = unpack_marks(bytes.fromhex(cached[1]["marks"]), questions)
+            fill = unpack_fill(bytes.fromhex(cached[1]["fill"]), questions)
+            confidence = unpack_fill(bytes.fromhex(cached[1]["confidence"]), questions)
+            grid = cached[1].get("grid")
+        else:
+            result = read_sheet_file(sheet_path, profile=profile, page=page)
+            if result is None:
+                raise ValueError("No bubbles detected on sheet.")
+            marks, fill, confidence, grid = result
+            store(content_hash, params, "evaluate", db_path=cache_db,
+                  answers={"questions": len(marks), "marks": pack_marks(marks).hex(), "fill": pack_fill(fill).hex(),
+                           "confidence": pack_fill(confidence).hex(), "grid": grid})
+
+    except Exception as e:
+        return {
+            "Total Score": 0,
+            "Flagged": 1,
+            "Flag Reason": f"Evaluation failed: {e}",
+        }
+
+    scores = score_sheet(marks, compiled_key)
+
+    flag_reason = flag_reasons(scores, confidence, grid)
+    scores.update({
+        "Marks": marks,
+        "Fill": fill,
+        "Flagged": int(flag_reason is not None),
+        "Flag Reason": flag_reason,
+    })
+    return scores
+
+def flag_reasons(scores, confidence, grid=None):
+    """
+    Why a sheet needs review, or None: bubbles that did not fit the question grid
+    (see omr_to_csv.grid_misfit), blank questions, and marks that stayed ambiguous
+    after the second pass (see confidence.py), by question number.
+    """
+    reasons = []
+    misfit = grid_misfit(grid)
+    if misfit:
+        reasons.append(misfit)
+    if scores["Blank"] > 0:
+        reasons.append("Incomplete sheet detected.")
+    uncertain = uncertain_questions(confidence)
+    if len(uncertain):
+        reasons.append("Uncertain marks on question" + ("s " if len(uncertain) > 1 else " ")
+                       + ", ".join(str(q + 1) for q in uncertain) + ".")
+    return " ".join(reasons) or None
+
+def evaluation_handler(db_path=DB_PATH, profile_sink=None, budget=None):
+    """
+    JobQueue handler that evaluates one queued sheet and stores its result row.
+    Job payloads carry the student details plus "Version" (and "Page" for PDFs);
+    each sheet's SheetProfile is added to profile_sink (a BatchProfile) when given.
+    With a memory_budget.MemoryBudget shared by the queue's workers, a worker
+    waits for its sheet's estimated memory to fit before decoding it.
+    """
+    def run_evaluation_job(job):
+        details = job["payload"]
+        profile = SheetProfile(job["file_path"]) if profile_sink is not None else None
+        reservation = (budget.reserve(budget.cost(job["file_path"], details.get("Page")))
+                       if budget is not None else nullcontext())
+        with reservation:
+            scores = evaluate_omr(job["file_path"], int(details["Version"]), details.get("Page"), profile, db_path)
+            try:
+                # Generate the review thumbnail now so the Results page never touches the original
+                get_thumbnail(job["file_path"], details.get("Page"))
+            except Exception as e:
+                # The result is still stored; the Results page generates the thumbnail on first view instead
+                print(f"Could not generate thumbnail for {job['file_path']}: {type(e).__name__}: {e}")
+        if profile is not None:
+            profile_sink.add(profile)
+        row = dict(details)
+        row.update({
+            "File Name": job["file_name"],
+            "File Path": job["file_path"],
+            "Subject 1": scores.get("Subject 1", 0),
+            "Subject 2": scores.get("Subject 2", 0),
+            "Subject 3": scores.get("Subject 3", 0),
+            "Subject 4": scores.get("Subject 4", 0),
+            "Subject 5": scores.get("Subject 5", 0),
+            "Total Score": scores.get("Total Score", 0),
+            "Flagged": scores.get("Flagged", 0),
+            "Flag Reason": scores.get("Flag Reason"),
+            "Created At": datetime.datetime.now().isoformat()
+        })
+        result_id = insert_result(row, db_path)
+        if "Marks" in scores:
+            store_responses([(result_id, job["file_name"], details["Version"], scores["Marks"], scores["Fill"])],
+                            db_path)
+        return result_id
+    return run_evaluation_job
@@ -0,0 +1,119 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from db import DB_PATH, iter_results
+from omr_to_csv import subjects, questions_per_subject, options
+from responses import load_responses
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_FORMATS = ("csv", "xlsx", "parquet")
+CHUNK_ROWS = 5000
+QUESTION_COLUMNS = [f"Q{i}" for i in range(1, len(subjects) * questions_per_subject + 1)]
+INTEGER_COLUMNS = ("id", "subject1", "subject2", "subject3", "subject4", "subject5", "total_score", "flagged")
+# Answer text for every combination of marked options, indexed by the options' bit pattern
+_OPTION_SETS = np.array([",".join(opt for i, opt in enumerate(options) if code >> i & 1)
+                         for code in range(2 ** len(options))], dtype=object)
+# Excel stops at 1,048,576 rows per worksheet (one is the header)
+XLSX_SHEET_ROWS = 1_048_575
+
+def expand_responses(chunk, db_path=DB_PATH):
+    """Append one column per question (Q1..Qn) with the options marked on each result's sheet."""
+    stored = load_responses(result_ids=chunk["id"].tolist(), db_path=db_path)
+    codes = np.zeros((len(chunk), len(QUESTION_COLUMNS)), dtype=np.intp)
+    marks = stored["marks"][:, :len(QUESTION_COLUMNS)]
+    rows = pd.Index(chunk["id"]).get_indexer(stored["result_id"])
+    codes[rows, :marks.shape[1]] = (marks * (1 << np.arange(len(options)))).sum(axis=2)
+    answers = pd.DataFrame(_OPTION_SETS[codes], columns=QUESTION_COLUMNS, index=chunk.index)
+    return pd.concat([chunk, answers], axis=1)
+
+def _write_csv(chunks, path):
+    rows = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        for chunk in chunks:
+            chunk.to_csv(f, header=rows == 0, index=False)
+            rows += len(chunk)
+    return rows
+
+def _write_xlsx(chunks, path):
+    # openpyxl is only needed for this format
+    from openpyxl import Workbook
+
+    # write_only workbooks stream rows to disk instead of building the sheet in memory
+    workbook = Workbook(write_only=True)
+    sheet, sheet_rows, rows = None, XLSX_SHEET_ROWS, 0
+    for chunk in chunks:
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for record in chunk.itertuples(index=False, name=None):
+            if sheet_rows == XLSX_SHEET_ROWS:
+                sheet = workbook.create_sheet(f"Results {len(workbook.worksheets) + 1}")
+                sheet.append(list(chunk.columns))
+                sheet_rows = 0
+            sheet.append(record)
+            sheet_rows += 1
+        rows += len(chunk)
+    if sheet is None:
+        workbook.create_sheet("Results 1")
+    workbook.save(path)
+    return rows
+
+def _write_parquet(chunks, path):
+    if pyarrow is None:
+        raise ImportError("Parquet export needs pyarrow: pip install pyarrow")
+    writer, rows = None, 0
+    try:
+        for chunk in chunks:
+            if writer is None:
+                # Fixed schema so an all-empty column in one chunk doesn't change its type
+                schema = pyarrow.schema([(c, pyarrow.int64() if c in INTEGER_COLUMNS else pyarrow.string())
+                                         for c in chunk.columns])
+                writer = pyarrow.parquet.ParquetWriter(path, schema)
+            for column in chunk.columns:
+                if column not in INTEGER_COLUMNS:
+                    chunk[column] = chunk[column].astype("string")
+            writer.write_table(pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pyarrow.parquet.write_table(pyarrow.table({}), path)
+    return rows
+
+_WRITERS = {"csv": _write_csv, "xlsx": _write_xlsx, "parquet": _write_parquet}
+
+def export_results(path, fmt=None, version=None, class_batch=None, date_from=None, date_to=None,
+                   flagged=None, query=None, chunk_rows=CHUNK_ROWS, db_path=DB_PATH):
+    """
+    Write every matching result (see db.iter_results for the filters) to path as
+    CSV, XLSX or Parquet, with per-question response columns Q1..Qn. The table is
+    read and written chunk_rows at a time. fmt defaults to path's extension.
+    Returns the number of rows written.
+    """
+    fmt = (fmt or os.path.splitext(path)[1].lstrip(".")).lower()
+    if fmt not in _WRITERS:
+        raise ValueError(f"Unsupported export format {fmt!r}; use one of {', '.join(EXPORT_FORMATS)}")
+    chunks = (expand_responses(chunk, db_path) for chunk in
+              iter_results(chunk_rows, version, class_batch, date_from, date_to, flagged, query, db_path))
+    return _WRITERS[fmt](chunks, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export evaluation results with per-question responses.")
+    parser.add_argument("output", help="output file; the format follows its extension (.csv, .xlsx, .parquet)")
+    parser.add_argument("--format", choices=EXPORT_FORMATS)
+    parser.add_argument("--version")
+    parser.add_argument("--class-batch")
+    parser.add_argument("--from", dest="date_from", help="first day to include (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", help="last day to include (YYYY-MM-DD)")
+    parser.add_argument("--flagged", action="store_true", help="only flagged sheets")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+    rows = export_results(args.output, args.format, args.version, args.class_batch, args.date_from, args.date_to,
+                          True if args.flagged else None, chunk_rows=args.chunk_rows, db_path=args.db)
+    print(f"Exported {rows} results to {args.output}")
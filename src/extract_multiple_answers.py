@@ -1,112 +1,295 @@
 import cv2
 import numpy as np
 import os
+import argparse
 from skimage.filters import threshold_otsu
 import glob
+from utils import (run_tasks, print_batch_summary, bubble_fill_stats, to_working_resolution, scale_contours,
+                   fill_holes, label_contours, label_fill_stats, component_shapes, relabel_components)
+from profiling import SheetProfile, BatchProfile, stage, write_profile_report
+from preprocess import get_preprocessor
+from confidence import mark_confidence
+from memory_budget import MEMORY_BUDGET_MB, MemoryBudget
+from result_cache import CACHE_DB_PATH, file_digest, params_digest, lookup, store_many, restore_output
+
+# Modules whose code determines the highlighted images; see result_cache.params_digest
+HIGHLIGHT_MODULES = ("extract_multiple_answers", "utils", "preprocess", "confidence")
+
+BUBBLE_DETECTORS = ("contours", "components")
+# Bubble tests of the connected-component detector (see get_bubble_components): filled
+# area in pixels and bounding-box aspect ratio (from the native component stats), then
+# ellipse fill and elongation (utils.component_shapes). They stand in for the contour
+# filter's area, circularity and solidity tests and were chosen to agree with it on the
+# sample sets.
+BLOB_AREA = (140, 2600)
+BLOB_MAX_BOX_ASPECT = 2.0
+BLOB_MIN_ELLIPSE_FILL = 0.97
+BLOB_MAX_ELONGATION = 1.8
 
 def adjust_local_brightness_contrast(image):
+    """CLAHE on the Lab lightness of a BGR image, keeping its colour (for display)."""
     lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
     l, a, b = cv2.split(lab)
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-    cl = clahe.apply(l)
+    cl = get_preprocessor().clahe.apply(l)
     limg = cv2.merge((cl, a, b))
     adjusted = cv2.cvtColor(limg, cv2.COLOR_LAB2BGR)
     return adjusted
 
 def adjust_for_dark_image(image):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    mean_intensity = np.mean(gray)
-    if mean_intensity < 80:  # Very dark image threshold
-        # Apply gamma correction to brighten
-        gamma = 1.8  # increase brightness for dark image
-        invGamma = 1.0 / gamma
-        table = np.array([((i / 255.0) ** invGamma) * 255
-                          for i in np.arange(256)]).astype("uint8")
-        brightened = cv2.LUT(image, table)
-        return brightened
+    """Gamma-brighten a very dark BGR image; see Preprocessor.brighten for the grayscale version."""
+    preprocessor = get_preprocessor()
+    if cv2.mean(preprocessor.grayscale(image))[0] < preprocessor.dark_mean:
+        return cv2.LUT(image, preprocessor.gamma_lut)
     return image
 
-def get_bubble_contours(image):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    adjusted = gray if np.mean(gray) > 100 else cv2.cvtColor(adjust_local_brightness_contrast(image), cv2.COLOR_BGR2GRAY)
+def bubble_mask(image, profile=None):
+    """Binary mask of dark marks on an enhanced sheet (grayscale, or BGR), cleaned by a morphological opening."""
+    preprocessor = get_preprocessor()
+    gray = preprocessor.grayscale(image)
+    if cv2.mean(gray)[0] > 100:
+        adjusted = gray
+    else:
+        with stage(profile, "bubble_clahe"):
+            if image.ndim == 2:
+                adjusted = preprocessor.equalize(gray, name="bubble_equalized")
+            else:
+                adjusted = cv2.cvtColor(adjust_local_brightness_contrast(image), cv2.COLOR_BGR2GRAY)
+
+    with stage(profile, "otsu"):
+        thresh_val = threshold_otsu(adjusted)
+        _, binary = cv2.threshold(adjusted, thresh_val-15, 255, cv2.THRESH_BINARY_INV)
 
-    thresh_val = threshold_otsu(adjusted)
-    _, binary = cv2.threshold(adjusted, thresh_val-15, 255, cv2.THRESH_BINARY_INV)
+    with stage(profile, "morphology"):
+        return preprocessor.open(binary)
 
-    kernel = np.ones((5,5), np.uint8)
-    opening = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+def get_bubble_contours(image, profile=None):
+    """Contours of the bubbles on an enhanced sheet (grayscale, or BGR)."""
+    opening = bubble_mask(image, profile)
 
-    contours, _ = cv2.findContours(opening, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    with stage(profile, "find_contours"):
+        contours, _ = cv2.findContours(opening, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     bubble_contours = []
 
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        perimeter = cv2.arcLength(cnt, True)
-        if 120 < area < 2500 and perimeter > 25:  # relaxed thresholds
-            approx = cv2.approxPolyDP(cnt, 0.02*perimeter, True)
-            if len(approx) > 5:
-                circularity = (4 * np.pi * area) / (perimeter * perimeter)
-                if 0.7 < circularity < 1.2:
-                    hull = cv2.convexHull(cnt)
-                    hull_area = cv2.contourArea(hull)
-                    solidity = area / hull_area if hull_area > 0 else 0
-                    if solidity > 0.85:
-                        bubble_contours.append(cnt)
+    with stage(profile, "contour_filter"):
+        for cnt in contours:
+            area = cv2.contourArea(cnt)
+            perimeter = cv2.arcLength(cnt, True)
+            if 120 < area < 2500 and perimeter > 25:  # relaxed thresholds
+                approx = cv2.approxPolyDP(cnt, 0.02*perimeter, True)
+                if len(approx) > 5:
+                    circularity = (4 * np.pi * area) / (perimeter * perimeter)
+                    if 0.7 < circularity < 1.2:
+                        hull = cv2.convexHull(cnt)
+                        hull_area = cv2.contourArea(hull)
+                        solidity = area / hull_area if hull_area > 0 else 0
+                        if solidity > 0.85:
+                            bubble_contours.append(cnt)
     return bubble_contours
 
+def get_bubble_components(image, profile=None):
+    """
+    Connected-component alternative to get_bubble_contours on the same mask: blobs
+    are filled and labelled in native passes (utils.fill_holes), rejected by their
+    native area and bounding box first, and only the survivors are measured for
+    shape (utils.component_shapes). Returns (labels, centroids, areas): an int32
+    image with the n bubbles numbered 1..n (filled, like drawn contours), their
+    (n, 2) centers and pixel counts.
+    """
+    opening = bubble_mask(image, profile)
+
+    with stage(profile, "find_components"):
+        # 16-bit labels are over twice as fast as 32-bit ones; every blob left by the
+        # opening has at least 25 pixels, so only a very large mask could run out of them
+        ltype = cv2.CV_16U if opening.size < 25 * 65535 else cv2.CV_32S
+        _, labels, stats, centroids = cv2.connectedComponentsWithStats(fill_holes(opening), connectivity=8,
+                                                                        ltype=ltype)
+
+    with stage(profile, "component_filter"):
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        width, height = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT]
+        candidates = 1 + np.flatnonzero((BLOB_AREA[0] < areas) & (areas < BLOB_AREA[1])
+                                        & (np.maximum(width, height) < BLOB_MAX_BOX_ASPECT * np.minimum(width, height)))
+        ellipse_fill, elongation = component_shapes(labels, stats, candidates)
+        keep = candidates[(ellipse_fill > BLOB_MIN_ELLIPSE_FILL) & (elongation < BLOB_MAX_ELONGATION)]
+        return relabel_components(labels, stats, keep), centroids[keep], stats[keep, cv2.CC_STAT_AREA]
+
+def component_outlines(labels, filled):
+    """Contours around the bubbles of a label image whose `filled` flag is set, for annotation."""
+    mask = np.concatenate([[0], np.where(filled, 255, 0)]).astype(np.uint8)[labels]
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return list(contours)
+
+def circle_outlines(centers, radius):
+    """Contours of circles of `radius` around (n, 2) centers, to annotate marks found without a contour."""
+    r = max(1, int(round(radius)))
+    return [cv2.ellipse2Poly((int(round(x)), int(round(y))), (r, r), 0, 0, 360, 10).reshape(-1, 1, 2)
+            for x, y in centers]
+
 def analyze_fill_level(image_gray, contour):
-    mask = np.zeros(image_gray.shape, dtype=np.uint8)
-    cv2.drawContours(mask, [contour], -1, 255, -1)
-    mean_val = cv2.mean(image_gray, mask=mask)[0]
-    return mean_val
+    mean_val, _ = bubble_fill_stats(image_gray, [contour], 0)
+    return mean_val[0]
 
-def highlight_filled_bubbles(image, bubble_contours, fill_threshold=150):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    highlighted = image.copy()
-    for cnt in bubble_contours:
-        fill_level = analyze_fill_level(gray, cnt)
-        if fill_level < fill_threshold:  # increased threshold to capture light fill
-            mask = np.zeros(gray.shape, dtype=np.uint8)
-            cv2.drawContours(mask, [cnt], -1, 255, -1)
-            filled_pixels = cv2.countNonZero(cv2.bitwise_and(mask, cv2.inRange(gray, 0, fill_threshold)))
-            total_pixels = cv2.countNonZero(mask)
-            fill_ratio = filled_pixels / total_pixels if total_pixels > 0 else 0
-            if fill_ratio > 0.35:  # allow partial fill detection
-                cv2.drawContours(highlighted, [cnt], -1, (0, 255, 0), 2)
+def measure_filled_bubbles(image, bubble_contours, fill_threshold=150):
+    """
+    Return (filled, fill_ratio, confidence), one entry per contour: filled is True
+    when the bubble is dark and filled enough to count as marked, and confidence
+    (0-1) how clearly it is (see confidence.mark_confidence). image may be grayscale.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return measure_filled_labels(gray, label_contours(gray.shape, bubble_contours), len(bubble_contours),
+                                 fill_threshold)
+
+def measure_filled_labels(image, labels, count, fill_threshold=150):
+    """measure_filled_bubbles for bubbles 1..count of a label image (see get_bubble_components)."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    fill_level, fill_ratio = label_fill_stats(gray, labels, count, fill_threshold)
+    filled, confidence = mark_confidence(fill_level, fill_ratio, fill_threshold)
+    return filled, fill_ratio, confidence
+
+def find_filled_bubbles(image, bubble_contours, fill_threshold=150):
+    """Return one bool per contour: True when the bubble is dark and filled enough to count as marked."""
+    return measure_filled_bubbles(image, bubble_contours, fill_threshold)[0]
+
+def outline_bubbles(highlighted, bubble_contours, filled, thickness=2):
+    """Outline the filled bubbles on a BGR image in place and return it."""
+    marked = [cnt for cnt, is_filled in zip(bubble_contours, filled) if is_filled]
+    cv2.drawContours(highlighted, marked, -1, (0, 255, 0), thickness)
     return highlighted
 
-def process_image(input_path, output_path):
-    image = cv2.imread(input_path)
+def draw_filled_bubbles(image, bubble_contours, filled, thickness=2):
+    highlighted = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+    return outline_bubbles(highlighted, bubble_contours, filled, thickness)
+
+def highlight_filled_bubbles(image, bubble_contours, fill_threshold=150):
+    filled = find_filled_bubbles(image, bubble_contours, fill_threshold)
+    return draw_filled_bubbles(image, bubble_contours, filled)
+
+def draw_full_size(full_shape, enhanced_image, bubble_contours, filled, scale):
+    """
+    Annotate bubbles found at working resolution (see utils.to_working_resolution)
+    on an image of the input's (rows, cols) full_shape. The enhanced image is resized back rather
+    than re-enhanced at full size, and the contours are mapped back onto it with
+    outlines thick enough to survive omr_to_csv resizing the image back down.
+    Only the input's shape is needed, so callers can free the full-size input first.
+    """
+    if scale == 1.0:
+        return draw_filled_bubbles(enhanced_image, bubble_contours, filled)
+    full_size = cv2.resize(enhanced_image, (full_shape[1], full_shape[0]), interpolation=cv2.INTER_LINEAR)
+    if full_size.ndim == 2:
+        full_size = cv2.cvtColor(full_size, cv2.COLOR_GRAY2BGR)
+    # The resized image is a fresh array, so outline it directly rather than a copy of it
+    return outline_bubbles(full_size, scale_contours(bubble_contours, 1 / scale), filled,
+                           thickness=max(2, round(2 / scale)))
+
+def process_image(input_path, output_path, profile=None):
+    with stage(profile, "imread"):
+        image = cv2.imread(input_path)
     if image is None:
-        print(f"Failed to load {input_path}")
-        return
+        raise IOError(f"Failed to load {input_path}")
+
+    # Step 0: Detect and process at the working resolution the thresholds are tuned for
+    with stage(profile, "normalize"):
+        working, scale = to_working_resolution(image)
+    # Only the input's size is needed from here on; drop the full-resolution decode
+    full_shape = image.shape[:2]
+    del image
 
     # Step 1: Brighten if extremely dark
-    image = adjust_for_dark_image(image)
+    with stage(profile, "dark_gamma"):
+        working = adjust_for_dark_image(working)
 
-    # Step 2: Apply local brightness/contrast adjustment
-    enhanced_image = adjust_local_brightness_contrast(image)
+    # Step 2: Apply local brightness/contrast adjustment. This stays on the colour
+    # image: omr_to_csv re-detects bubbles on the written image, so its pixels
+    # must not change (pipeline.py uses the cheaper grayscale-only path)
+    with stage(profile, "clahe"):
+        enhanced_image = adjust_local_brightness_contrast(working)
 
     # Step 3: Detect bubbles
-    bubbles = get_bubble_contours(enhanced_image)
+    bubbles = get_bubble_contours(enhanced_image, profile)
 
-    # Step 4: Highlight filled bubbles
-    highlighted_img = highlight_filled_bubbles(enhanced_image, bubbles)
+    # Step 4: Highlight filled bubbles (mapped back to the input's size)
+    with stage(profile, "fill_analysis"):
+        filled = find_filled_bubbles(enhanced_image, bubbles)
+    with stage(profile, "annotate"):
+        highlighted_img = draw_full_size(full_shape, enhanced_image, bubbles, filled, scale)
 
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    cv2.imwrite(output_path, highlighted_img)
+    with stage(profile, "imwrite"):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        cv2.imwrite(output_path, highlighted_img)
 
 
-def batch_process_images(input_dir='data/input', output_dir='data/output'):
-    for set_folder in os.listdir(input_dir):
+def list_image_tasks(input_dir='data/input', output_dir='data/output'):
+    """
+    Return (input_path, output_path) pairs for every sheet under input_dir/<set>/,
+    sorted so batch results come back in the same order on every run.
+    """
+    tasks = []
+    for set_folder in sorted(os.listdir(input_dir)):
         set_path = os.path.join(input_dir, set_folder)
         if os.path.isdir(set_path):
-            for image_file in glob.glob(os.path.join(set_path, '*.jpeg')):
+            for image_file in sorted(glob.glob(os.path.join(set_path, '*.jpeg'))):
                 rel_path = os.path.relpath(image_file, input_dir)
-                output_path = os.path.join(output_dir, rel_path)
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                process_image(image_file, output_path)
+                tasks.append((image_file, os.path.join(output_dir, rel_path)))
+    return tasks
 
-if __name__ == "__main__":
-    batch_process_images()
 
+def _process_image_task(task):
+    input_path, output_path, profiled = task
+    profile = SheetProfile(input_path) if profiled else None
+    process_image(input_path, output_path, profile)
+    return profile.to_records() if profile else None
+
+
+def batch_process_images(input_dir='data/input', output_dir='data/output', workers=1, profile=False,
+                         incremental=True, cache_db=CACHE_DB_PATH, memory_mb=MEMORY_BUDGET_MB):
+    """
+    Process every sheet under input_dir and write annotated images to output_dir.
+
+    With workers > 1 the sheets are fanned out over a process pool; see
+    utils.run_tasks for the returned summary. With profile=True the summary
+    also carries a BatchProfile of per-stage timings under "profile".
+    With incremental=True sheets whose content and pipeline code are unchanged
+    since their last run (see result_cache) are skipped and listed under "skipped".
+    Parallel workers only start a sheet while the estimated memory of the sheets
+    in flight stays under memory_mb (see memory_budget; 0 = half of physical memory).
+    """
+    tasks, skipped, digests = [], [], {}
+    params = params_digest(HIGHLIGHT_MODULES) if incremental else None
+    for input_path, output_path in list_image_tasks(input_dir, output_dir):
+        if incremental:
+            digests[input_path] = file_digest(input_path, cache_db)
+            if restore_output(lookup(digests[input_path], params, "highlight", cache_db), output_path):
+                skipped.append(input_path)
+                continue
+        tasks.append((input_path, output_path, profile))
+    summary = run_tasks(_process_image_task, tasks, workers, MemoryBudget(memory_mb))
+    summary["skipped"] = skipped
+    if incremental:
+        outputs = {task[0]: os.path.abspath(task[1]) for task in tasks}
+        store_many([(digests[path], outputs[path], None) for path in summary["processed"]],
+                   params, "highlight", cache_db)
+    if profile:
+        summary["profile"] = BatchProfile()
+        for records in summary["results"]:
+            summary["profile"].add_records(records)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Highlight filled bubbles on every input sheet.")
+    parser.add_argument("--input-dir", default="data/input")
+    parser.add_argument("--output-dir", default="data/output")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (0 = one per CPU core)")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="record per-stage timings and write them to REPORT (.json summary or .csv records)")
+    parser.add_argument("--force", action="store_true", help="reprocess sheets even if their output is up to date")
+    parser.add_argument("--memory-mb", type=int, default=MEMORY_BUDGET_MB,
+                        help="memory budget for sheets processed at once (0 = half of physical memory)")
+    args = parser.parse_args()
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+    summary = batch_process_images(args.input_dir, args.output_dir, workers=workers, profile=bool(args.profile),
+                                   incremental=not args.force, memory_mb=args.memory_mb)
+    print_batch_summary(summary)
+    if args.profile:
+        write_profile_report(summary, args.profile)
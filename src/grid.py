@@ -0,0 +1,271 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Rotations searched when deskewing (beyond 45 degrees rows and columns swap),
+# and the profile bin in neighbour distances
+MAX_SKEW_DEGREES = 45
+SKEW_BIN = 0.25
+# Bubbles within this fraction of the typical neighbour distance share a row/column
+CLUSTER_GAP = 0.4
+# Pairs up to this many neighbour distances apart measure how rows and columns lean;
+# short pairs first, so strongly leaning lines are mostly straight before longer pairs are used
+LEAN_REACHES = (2, 4, 6)
+# ...and count as on the same line when this close across it (in neighbour distances)
+LEAN_TOLERANCE = 0.25
+# Matching clusters to rows/columns: cost of leaving a line empty, of dropping a
+# cluster (per bubble in it), and how many clusters may be dropped in a row
+SKIP_COST = 0.5
+DROP_COST = 1.0
+MAX_DROPPED = 2
+# A bubble further than this fraction of the pitch from its row/column line is off the grid
+CELL_TOLERANCE = 0.5
+# Steps between matched lines this close (in pitches) to the printed spacing count as fitting
+STEP_TOLERANCE = 0.5
+# Bubbles needed to place the cells with a quadratic map (with fewer, an affine one)
+QUADRATIC_MIN_POINTS = 12
+
+def _sharpness(values, bin_width):
+    """How tightly values pile up: the sum of squared histogram counts."""
+    counts = np.bincount(((values - values.min()) / bin_width).astype(int))
+    return np.dot(counts, counts)
+
+def estimate_skew(points, spacing):
+    """
+    Rotation of the bubble rows in radians: the angle at which the points,
+    projected across the rows, pile up into the sharpest peaks (a coarse search
+    with wide bins, refined around the best angle with narrow ones). Uses only
+    positions, so it works whether the sheet shows all bubbles or only the
+    marked ones.
+    """
+    best = 0.0
+    for step, span, bin_size in ((1.0, MAX_SKEW_DEGREES, 2 * SKEW_BIN), (0.1, 1.0, SKEW_BIN)):
+        angles = best + np.radians(np.arange(-span, span + step / 2, step))
+        down = np.outer(points[:, 1], np.cos(angles)) - np.outer(points[:, 0], np.sin(angles))
+        bins = ((down - down.min(axis=0)) / (bin_size * spacing)).astype(int)
+        # One histogram per angle, side by side in a single bincount
+        n_bins = bins.max() + 1
+        counts = np.bincount((bins + n_bins * np.arange(len(angles))).ravel(),
+                             minlength=n_bins * len(angles)).reshape(len(angles), n_bins)
+        # Sparse marks on a square grid line up almost as well along its diagonals; favour upright
+        best = angles[np.argmax((counts * counts).sum(axis=1) * np.cos(angles) ** 2)]
+    return float(best)
+
+def straighten(a, b, pairs, tol):
+    """
+    Undo the tilt left along coordinate `a` after rotation. Photographed sheets
+    are wider at the end nearer the camera, so lines further from the middle lean
+    more: the lean per unit of `b` is fitted as a linear function of `a` from
+    point pairs on the same line (close in `a`, apart in `b`), and each point is
+    moved to where its line crosses the median `b`. A fit that doesn't make the
+    lines sharper (too few or mismatched pairs) is not applied.
+    """
+    i, j = pairs[:, 0], pairs[:, 1]
+    da, db = a[j] - a[i], b[j] - b[i]
+    same_line = (np.abs(da) < tol) & (np.abs(db) > 2 * tol)
+    if np.count_nonzero(same_line) < 3:
+        return a
+    lean, at = da[same_line] / db[same_line], (a[i] + a[j])[same_line] / 2
+    coef = np.polyfit(at, lean, 1)
+    # Refit without pairs that straddle two lines
+    residual = np.abs(lean - np.polyval(coef, at))
+    inliers = residual <= 3 * np.median(residual)
+    if np.count_nonzero(inliers) >= 3:
+        coef = np.polyfit(at[inliers], lean[inliers], 1)
+    straight = a - np.polyval(coef, a) * (b - np.median(b))
+    return straight if _sharpness(straight, tol) > _sharpness(a, tol) else a
+
+def _fit_slots(positions, support, count, group):
+    """
+    Match sorted cluster positions to `count` evenly pitched slots laid out in groups
+    of `group`, with a wider step between groups. A dynamic program over (cluster,
+    slot) scores each step between matched clusters by how far its length is from
+    the slots' spacing; leaving a slot empty costs SKIP_COST and dropping a cluster
+    DROP_COST per point in it, so stray marks are dropped and empty lines skipped.
+    Returns (slot of every cluster or -1, pitch, nominal offset of every slot from the
+    first, fit): fit is the share of steps between matched clusters that are within
+    STEP_TOLERANCE pitches of the printed spacing (1 with fewer than two matched).
+    """
+    m = len(positions)
+    diffs = np.diff(positions)
+    pitch = float(np.median(diffs[diffs < 1.5 * np.percentile(diffs, 25)])) if m > 1 else 1.0
+    # Steps between groups: wider than a pitch, narrower than a whole empty group
+    wide = np.sort(diffs[(diffs > 1.5 * pitch) & (diffs < (group + 1) * pitch)])[::-1][:count // group - 1]
+    boundary = float(np.median(wide)) if len(wide) else pitch
+    steps = np.where((np.arange(count - 1) + 1) % group == 0, boundary, pitch)
+    offsets = np.concatenate([[0.0], np.cumsum(steps)])
+    # Dropping clusters i..j-1 costs dropped[j] - dropped[i]
+    dropped = np.concatenate([[0.0], np.cumsum(support)]) * DROP_COST
+
+    # skips[s, t]: slots passed over going from slot s to slot t; span[s, t]: their distance
+    skips = np.arange(count)[None, :] - np.arange(count)[:, None] - 1
+    span = offsets[None, :] - offsets[:, None]
+    step_cost = np.where(skips >= 0, SKIP_COST * skips, np.inf)
+
+    # cost[i, t]: cheapest way to put cluster i on slot t; starting there skips slots 0..t-1
+    cost = dropped[:m, None] + SKIP_COST * np.arange(count)[None, :]
+    back = np.full((m, count, 2), -1)
+    for i in range(1, m):
+        prev = np.arange(max(0, i - MAX_DROPPED - 1), i)
+        d = positions[i] - positions[prev]
+        # via[p, s, t]: cluster prev[p] on slot s, then cluster i on slot t
+        via = (cost[prev][:, :, None] + step_cost[None] + np.abs(d[:, None, None] - span[None]) / pitch
+               + (dropped[i] - dropped[prev + 1])[:, None, None])
+        flat = via.reshape(-1, count)
+        best = np.argmin(flat, axis=0)
+        better = flat[best, np.arange(count)] < cost[i]
+        cost[i, better] = flat[best, np.arange(count)][better]
+        back[i, better, 0] = prev[best[better] // count]
+        back[i, better, 1] = best[better] % count
+
+    total = cost + (dropped[m] - dropped[1:, None]) + SKIP_COST * (count - 1 - np.arange(count))[None, :]
+    i, t = np.unravel_index(np.argmin(total), total.shape)
+    slots = np.full(m, -1)
+    while i >= 0:
+        slots[i] = t
+        i, t = back[i, t]
+    found = slots >= 0
+    misfit = np.abs(np.diff(positions[found]) - np.diff(offsets[slots[found]])) / pitch
+    fit = float(np.mean(misfit < STEP_TOLERANCE)) if len(misfit) else 1.0
+    return slots, pitch, offsets, fit
+
+def _axis_slots(coords, count, group, max_gap, group_centers=None):
+    """
+    Cluster one projected coordinate into `count` lines (rows or columns) laid out in
+    groups of `group`. Returns (slot of every point or -1, position of every slot, pitch,
+    fit; see _fit_slots). Lines without a cluster are placed from their neighbours' spacing.
+    Spacing alone can't tell which groups are present when whole groups are empty
+    (a blank subject); given the rough expected center of each group, the matched
+    lines are shifted by whole groups to sit closest to them.
+    """
+    order = np.argsort(coords)
+    ordered = coords[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(ordered) > max_gap) + 1])
+    sizes = np.diff(np.append(starts, len(coords)))
+    if len(starts) < 2:
+        return np.full(len(coords), -1), np.zeros(count), max_gap, 0.0
+    # Each cluster is a run of the sorted coordinates, so its median is read off directly
+    positions = (ordered[starts + (sizes - 1) // 2] + ordered[starts + sizes // 2]) / 2
+    slots, pitch, offsets, fit = _fit_slots(positions, sizes, count, group)
+
+    found = slots >= 0
+    if group_centers is not None:
+        groups = slots[found] // group
+        shifts = np.arange(-groups.min(), count // group - groups.max())
+        misfit = np.abs(positions[found][None, :] - group_centers[groups[None, :] + shifts[:, None]]).sum(axis=1)
+        slots[found] += shifts[np.argmin(misfit)] * group
+    # Empty lines go where the printed spacing (wider between groups) puts them
+    slot_positions = np.interp(offsets, offsets[slots[found]], positions[found])
+    first, last = slots[found][0], slots[found][-1]
+    slot_positions[:first] = positions[found][0] + offsets[:first] - offsets[first]
+    slot_positions[last + 1:] = positions[found][-1] + offsets[last + 1:] - offsets[last]
+
+    point_slots = np.empty(len(coords), dtype=int)
+    point_slots[order] = np.repeat(slots, sizes)
+    return point_slots, slot_positions, pitch, fit
+
+def _cell_terms(u, v, quadratic):
+    """Design matrix of the map from grid coordinates to the image (see cell_positions)."""
+    terms = [np.ones_like(u), u, v]
+    if quadratic:
+        terms += [u * u, u * v, v * v]
+    return np.column_stack(terms)
+
+def cell_positions(points, u, v, grid_u, grid_v, spacing):
+    """
+    Image position of every grid cell: points (on the grid, at straightened grid
+    coordinates u, v) are fitted with a least-squares quadratic map back to the
+    image, which takes the rotation and perspective lean back out, and the map is
+    evaluated at every (grid_v, grid_u) line crossing. NaN with under 3 points.
+    """
+    if len(points) < 3:
+        return np.full((len(grid_v), len(grid_u), 2), np.nan)
+    quadratic = len(points) >= QUADRATIC_MIN_POINTS
+    # Center and scale the coordinates so the quadratic terms stay well conditioned
+    u0, v0 = np.median(u), np.median(v)
+    coef = np.linalg.lstsq(_cell_terms((u - u0) / spacing, (v - v0) / spacing, quadratic), points, rcond=None)[0]
+    gu, gv = np.meshgrid((grid_u - u0) / spacing, (grid_v - v0) / spacing)
+    return (_cell_terms(gu.ravel(), gv.ravel(), quadratic) @ coef).reshape(len(grid_v), len(grid_u), 2)
+
+def infer_grid(centers, n_blocks, questions_per_block, n_options, row_group=5, width=None):
+    """
+    Map bubble centers onto a sheet of `n_blocks` side-by-side subject blocks, each
+    `questions_per_block` rows of `n_options` bubbles, with rows spaced in groups of
+    `row_group`.
+
+    The typical bubble spacing comes from a KD-tree nearest-neighbour query,
+    which also finds the point pairs used below. The grid's rotation is
+    estimated first (see estimate_skew), centers are
+    projected onto its axes and the remaining perspective lean is taken out of
+    each axis (see straighten). Each axis is then clustered on its own, so a
+    skewed or photographed sheet still lines up, and empty rows or option columns
+    are filled in from the spacing of the others. Works with every bubble or
+    only the marked ones. With the sheet's `width` (in the centers' pixels),
+    blocks that are blank throughout are told apart by where the others sit.
+
+    Returns (question, option, unassigned, duplicates, cells, fit): question (0-based,
+    block-major) and option for every center, -1 where the bubble is not on the
+    grid; the indices of bubbles that fall outside it; the indices of bubbles
+    dropped because another one sits closer to the same (question, option) cell;
+    the (questions, options, 2) image position of every cell, found or not
+    (see cell_positions); and how well the rows and columns found follow the printed
+    spacing, the lower of the two axes' fit (0-1, see _fit_slots). A sheet forced
+    onto the wrong layout (e.g. turned a quarter) can leave few bubbles off the grid
+    but fits poorly.
+    """
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    question = np.full(len(centers), -1)
+    option = np.full(len(centers), -1)
+    valid = np.flatnonzero(np.isfinite(centers).all(axis=1))
+    cells = np.full((n_blocks * questions_per_block, n_options, 2), np.nan)
+    if len(valid) < 2:
+        return question, option, valid, np.zeros(0, dtype=int), cells, 0.0
+
+    points = centers[valid]
+    # Typical distance to the nearest bubble sets every tolerance below
+    tree = cKDTree(points)
+    spacing = float(np.median(tree.query(points, k=2)[0][:, 1]))
+    angle = estimate_skew(points, spacing)
+    cos, sin = np.cos(angle), np.sin(angle)
+    along = points[:, 0] * cos + points[:, 1] * sin     # across the sheet, rotation removed
+    down = -points[:, 0] * sin + points[:, 1] * cos     # down the sheet
+    for reach in LEAN_REACHES:
+        pairs = tree.query_pairs(reach * spacing, output_type="ndarray")
+        along, down = (straighten(along, down, pairs, LEAN_TOLERANCE * spacing),
+                       straighten(down, along, pairs, LEAN_TOLERANCE * spacing))
+
+    max_gap = CLUSTER_GAP * spacing
+    row, row_pos, row_pitch, row_fit = _axis_slots(down, questions_per_block, row_group, max_gap)
+    # Marks off every row (header samples, stray ink) could bridge two columns; leave them out
+    col = np.full(len(points), -1)
+    on_row = row >= 0
+    block_centers = None
+    if width is not None:
+        # Blocks are printed side by side, each taking an equal share of the sheet's width
+        block_x = (np.arange(n_blocks) + 0.5) * width / n_blocks
+        block_centers = block_x * cos + np.median(points[:, 1]) * sin
+    col[on_row], col_pos, col_pitch, col_fit = _axis_slots(along[on_row], n_blocks * n_options, n_options,
+                                                           max_gap, block_centers)
+
+    on_grid = (col >= 0) & on_row
+    dx = np.abs(along - col_pos[col]) / col_pitch
+    dy = np.abs(down - row_pos[row]) / row_pitch
+    on_grid &= (dx < CELL_TOLERANCE) & (dy < CELL_TOLERANCE)
+
+    # Keep the bubble closest to each cell's center; later ones in the same cell are duplicates
+    cell = np.where(on_grid, (col // n_options) * questions_per_block * n_options + row * n_options
+                    + col % n_options, -1)
+    order = np.lexsort((np.hypot(dx, dy), cell))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = cell[order][1:] != cell[order][:-1]
+    duplicate = np.zeros(len(points), dtype=bool)
+    duplicate[order[~first & (cell[order] >= 0)]] = True
+    kept = on_grid & ~duplicate
+
+    question[valid[kept]] = (col[kept] // n_options) * questions_per_block + row[kept]
+    option[valid[kept]] = col[kept] % n_options
+    unassigned = np.union1d(valid[~on_grid], np.flatnonzero(~np.isfinite(centers).all(axis=1)))
+
+    # Cells are laid out [row, column] block by block; regroup them as [question, option]
+    grid = cell_positions(points[kept], col_pos[col[kept]], row_pos[row[kept]], col_pos, row_pos, spacing)
+    cells = grid.reshape(questions_per_block, n_blocks, n_options, 2).transpose(1, 0, 2, 3).reshape(cells.shape)
+    return question, option, unassigned, valid[duplicate], cells, min(row_fit, col_fit)
@@ -0,0 +1,226 @@
+import os
+import time
+import uuid
+import shutil
+import signal
+import argparse
+import threading
+
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+from db import DB_PATH, init_db
+from jobs import HELD, JobQueue
+from evaluation import evaluation_handler
+from memory_budget import MEMORY_BUDGET_MB, MemoryBudget
+from pdf_ingest import is_pdf, count_pdf_pages, page_ref
+
+SHEET_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".pdf")
+# Scanner/FTP clients write under these names and rename when the file is complete
+PARTIAL_SUFFIXES = (".part", ".partial", ".tmp", ".crdownload", "~")
+# A file that could not be ingested stays in the drop folder and is tried again after this many seconds
+RETRY_DELAY = 30.0
+
+def is_sheet_file(path):
+    name = os.path.basename(path).lower()
+    return (not name.startswith(".") and not name.endswith(PARTIAL_SUFFIXES)
+            and name.endswith(SHEET_EXTENSIONS))
+
+class _DropFolderEvents(FileSystemEventHandler):
+    def __init__(self, ingestor):
+        self.ingestor = ingestor
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.ingestor.touch(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.ingestor.touch(event.src_path)
+
+    def on_moved(self, event):
+        # Completed uploads are often renamed from "sheet.jpg.part" to "sheet.jpg"
+        if not event.is_directory:
+            self.ingestor.touch(event.dest_path)
+
+class DropFolderIngestor:
+    """
+    Watches drop_dir for scanner output and queues each sheet for evaluation.
+
+    Sheets in drop_dir/<version>/ are graded against that answer-key version;
+    files directly in drop_dir use default_version. A file is accepted once its
+    size and mtime have not changed for `settle` seconds; its jobs are then
+    recorded on the durable JobQueue as held, the file is moved to
+    archive_dir/<version>/ and the jobs are released to the worker threads, which
+    write results straight into the results table. A file that fails to be
+    accepted stays in drop_dir and is retried after retry_delay seconds. At
+    start-up, held jobs whose file reached the archive are released (the rest are
+    dropped) and files still in drop_dir are picked up by an initial scan, so a
+    crash neither loses nor regrades a sheet. The workers share a memory budget
+    of memory_mb (see memory_budget), so large scans wait their turn.
+    """
+
+    def __init__(self, drop_dir, archive_dir, db_path=DB_PATH, default_version=1, workers=2,
+                 settle=2.0, poll_interval=0.5, memory_mb=MEMORY_BUDGET_MB, retry_delay=RETRY_DELAY):
+        self.drop_dir = os.path.abspath(drop_dir)
+        self.archive_dir = os.path.abspath(archive_dir)
+        self.db_path = db_path
+        self.default_version = default_version
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._pending = {}  # path -> (size, mtime_ns, last change time)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._thread = None
+        init_db(db_path)
+        self.queue = JobQueue(db_path, evaluation_handler(db_path, budget=MemoryBudget(memory_mb)), workers=workers)
+
+    def touch(self, path):
+        """Note activity on path; it is accepted once it has been quiet for `settle` seconds."""
+        if is_sheet_file(path):
+            with self._lock:
+                self._pending[path] = (None, None, time.monotonic())
+
+    def retry_later(self, path):
+        """Try path again once it has been left alone for retry_delay seconds."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._pending[path] = (stat.st_size, stat.st_mtime_ns, time.monotonic() + self.retry_delay)
+
+    def version_for(self, path):
+        relative = os.path.relpath(os.path.dirname(path), self.drop_dir)
+        top = relative.split(os.sep)[0]
+        return int(top) if top.isdigit() else self.default_version
+
+    def _stable_paths(self):
+        now = time.monotonic()
+        stable = []
+        with self._lock:
+            for path, (size, mtime_ns, changed_at) in list(self._pending.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self._pending[path]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    self._pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+                elif stat.st_size > 0 and now - changed_at >= self.settle:
+                    del self._pending[path]
+                    stable.append(path)
+        return stable
+
+    def accept(self, path):
+        """
+        Queue a settled sheet (one job per PDF page) and move it into the archive.
+        The jobs are held until the move has succeeded; if anything fails the
+        file is left in drop_dir.
+        """
+        version = self.version_for(path)
+        archive_folder = os.path.join(self.archive_dir, str(version))
+        os.makedirs(archive_folder, exist_ok=True)
+        file_name = os.path.basename(path)
+        archived = os.path.join(archive_folder, file_name)
+        if os.path.exists(archived):
+            stem, ext = os.path.splitext(file_name)
+            file_name = f"{stem}_{uuid.uuid4().hex[:8]}{ext}"
+            archived = os.path.join(archive_folder, file_name)
+
+        details = {
+            "Student Name": "",
+            "Student ID": os.path.splitext(os.path.basename(path))[0],
+            "Class": "",
+            "Email": "",
+            "Version": str(version),
+        }
+        if is_pdf(path):
+            items = [(page_ref(file_name, n), archived, dict(details, Page=n))
+                     for n in range(1, count_pdf_pages(path) + 1)]
+        else:
+            items = [(file_name, archived, details)]
+        batch_id = f"ingest-{uuid.uuid4().hex}"
+        self.queue.submit_many(batch_id, items, status=HELD)
+        try:
+            shutil.move(path, archived)
+        except Exception:
+            self.queue.discard(batch_id)
+            raise
+        self.queue.release(batch_id)
+        print(f"Queued {file_name} ({len(items)} sheet{'s' if len(items) != 1 else ''}, version {version})")
+
+    def _recover_held(self):
+        # Jobs are held from submission until their file is in the archive; a batch
+        # still held was interrupted, and its file is in whichever place it got to
+        for batch_id, paths in self.queue.held_batches().items():
+            if all(os.path.exists(p) for p in paths):
+                self.queue.release(batch_id)
+                print(f"Resumed {os.path.basename(paths[0])} from an interrupted ingest")
+            else:
+                self.queue.discard(batch_id)
+
+    def _scan_existing(self):
+        # Accepted sheets leave drop_dir, so anything still here has not been queued yet
+        for root, _, files in os.walk(self.drop_dir):
+            for name in files:
+                self.touch(os.path.join(root, name))
+
+    def _settle_loop(self):
+        while not self._stop.is_set():
+            for path in self._stable_paths():
+                try:
+                    self.accept(path)
+                except Exception as e:
+                    print(f"Could not ingest {path}: {type(e).__name__}: {e}; retrying in {self.retry_delay:g}s")
+                    self.retry_later(path)
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        os.makedirs(self.drop_dir, exist_ok=True)
+        self._recover_held()
+        self.queue.start()
+        self._observer = Observer()
+        self._observer.schedule(_DropFolderEvents(self), self.drop_dir, recursive=True)
+        self._observer.start()
+        self._scan_existing()
+        self._thread = threading.Thread(target=self._settle_loop, name="ingest-settle", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        if self._thread is not None:
+            self._thread.join()
+        self.queue.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch a drop folder and grade scanner output continuously.")
+    parser.add_argument("drop_dir", help="folder the scanners write to; use <drop_dir>/<version>/ per key version")
+    parser.add_argument("--archive-dir", default="archive", help="accepted sheets are moved here")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--version", type=int, default=1,
+                        help="answer-key version for files placed directly in drop_dir")
+    parser.add_argument("--workers", type=int, default=2, help="evaluation worker threads")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="seconds a file must stay unchanged before it is ingested")
+    parser.add_argument("--memory-mb", type=int, default=MEMORY_BUDGET_MB,
+                        help="memory budget for sheets evaluated at once (0 = half of physical memory)")
+    args = parser.parse_args()
+
+    ingestor = DropFolderIngestor(args.drop_dir, args.archive_dir, args.db, args.version, args.workers,
+                                  args.settle, memory_mb=args.memory_mb).start()
+    print(f"Watching {ingestor.drop_dir} (archive: {ingestor.archive_dir}). Press Ctrl+C to stop.")
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    ingestor.stop()
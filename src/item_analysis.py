@@ -0,0 +1,165 @@
+import argparse
+import numpy as np
+import pandas as pd
+from omr_to_csv import subjects, questions_per_subject, options
+from answer_key import AnswerKey, parse_answer_key, get_answer_key
+from responses import load_responses, count_responses
+from scoring import score_batch, stack_marks
+from db import DB_PATH, load_answer_key
+
+class ItemAnalysis:
+    """
+    Classical item statistics for one exam version, kept as running sums so new
+    sheets can be added without re-reading the old ones.
+
+    For every question it tracks how many sheets got it right, chose each
+    option, left it blank or marked several options, and the cross sums needed
+    for the item-rest correlation (discrimination). Subject scores are kept as
+    histograms, so distributions and quantiles need no per-sheet data either.
+    """
+
+    def __init__(self, answer_key):
+        self.answer_key = answer_key
+        n_questions = answer_key.mask.shape[0]
+        self.n = 0
+        self.last_id = 0  # highest sheet_responses id already added
+        self.correct = np.zeros(n_questions, dtype=np.int64)
+        self.option_counts = np.zeros((n_questions, len(options)), dtype=np.int64)
+        self.blank = np.zeros(n_questions, dtype=np.int64)
+        self.multi = np.zeros(n_questions, dtype=np.int64)
+        self.total_sum = 0
+        self.total_sq_sum = 0
+        self.correct_total = np.zeros(n_questions, dtype=np.int64)  # sum of total score over sheets that got q right
+        ranges = answer_key.subject_ranges
+        self.subject_hist = np.zeros((len(ranges), max(end - start for start, end in ranges) + 1), dtype=np.int64)
+
+    def __len__(self):
+        return self.n
+
+    def update(self, marks):
+        """Add a (sheets, questions, options) bool array of marks."""
+        if len(marks) == 0:
+            return self
+        n_questions = self.answer_key.mask.shape[0]
+        if marks.shape[1] != n_questions:
+            marks = stack_marks(list(marks), n_questions)
+        scores = score_batch(marks, self.answer_key)
+        correct = scores["correct"]
+        total = scores["total"].astype(np.int64)
+        n_marked = marks.sum(axis=2)
+
+        self.n += len(marks)
+        self.correct += correct.sum(axis=0)
+        self.option_counts += marks.sum(axis=0)
+        self.blank += (n_marked == 0).sum(axis=0)
+        self.multi += (n_marked > 1).sum(axis=0)
+        self.total_sum += int(total.sum())
+        self.total_sq_sum += int((total ** 2).sum())
+        self.correct_total += total @ correct
+        for s in range(len(self.subject_hist)):
+            self.subject_hist[s] += np.bincount(scores["subject_scores"][:, s],
+                                                minlength=self.subject_hist.shape[1])
+        return self
+
+    def items(self):
+        """
+        One row per keyed question: difficulty (share answering correctly),
+        discrimination (correlation of the item with the total of the other
+        items), blank / multi-mark rates and how often each option was chosen.
+        """
+        n = max(self.n, 1)
+        p = self.correct / n
+        # Item-rest correlation from the running sums: rest = total - item
+        rest_sum = self.total_sum - self.correct
+        rest_sq_sum = self.total_sq_sum - 2 * self.correct_total + self.correct
+        item_rest_sum = self.correct_total - self.correct
+        cov = item_rest_sum / n - p * rest_sum / n
+        var_item = p * (1 - p)
+        var_rest = rest_sq_sum / n - (rest_sum / n) ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            discrimination = np.where((var_item > 0) & (var_rest > 0), cov / np.sqrt(var_item * var_rest), np.nan)
+
+        key = self.answer_key
+        questions = np.arange(1, len(p) + 1)
+        frame = pd.DataFrame({
+            "question": questions,
+            "subject": [subjects[min((q - 1) // questions_per_subject, len(subjects) - 1)] for q in questions],
+            "key": [",".join(o for o, k in zip(options, row) if k) for row in key.mask],
+            "difficulty": p,
+            "discrimination": discrimination,
+            "blank_rate": self.blank / n,
+            "multi_rate": self.multi / n,
+        })
+        for i, opt in enumerate(options):
+            frame[f"chose_{opt}"] = self.option_counts[:, i]
+        return frame[key.keyed].reset_index(drop=True)
+
+    def subject_scores(self):
+        """Per-subject score distribution: mean, standard deviation, range and quartiles."""
+        rows = []
+        for s, hist in enumerate(self.subject_hist):
+            row = {"subject": subjects[s] if s < len(subjects) else f"Subject {s + 1}", "sheets": int(hist.sum())}
+            if row["sheets"]:
+                values = np.arange(len(hist))
+                mean = (values * hist).sum() / row["sheets"]
+                # Quantiles straight from the histogram: first score whose cumulative count reaches q
+                cumulative = np.cumsum(hist)
+                row.update({
+                    "mean": mean,
+                    "std": np.sqrt((((values - mean) ** 2) * hist).sum() / row["sheets"]),
+                    "min": int(values[hist > 0].min()),
+                    "q1": int(np.searchsorted(cumulative, 0.25 * row["sheets"])),
+                    "median": int(np.searchsorted(cumulative, 0.5 * row["sheets"])),
+                    "q3": int(np.searchsorted(cumulative, 0.75 * row["sheets"])),
+                    "max": int(values[hist > 0].max()),
+                })
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+def analyze_version(version, answer_key=None, analysis=None, db_path=DB_PATH):
+    """
+    ItemAnalysis of every stored response for `version` (see responses.py).
+    Pass the previous `analysis` to only add sheets stored since it was built;
+    it is rebuilt when the key changed or stored sheets were replaced.
+    """
+    if answer_key is None:
+        answer_key = get_answer_key(int(version), lambda v: load_answer_key(v, db_path))
+        if answer_key is None:
+            raise ValueError(f"No answer key found for Version {version}")
+    if analysis is None or analysis.answer_key is not answer_key:
+        analysis = ItemAnalysis(answer_key)
+    stored = load_responses(version, after_id=analysis.last_id, db_path=db_path)
+    analysis.update(stored["marks"])
+    if len(stored["id"]):
+        analysis.last_id = int(stored["id"].max())
+    if len(analysis) != count_responses(version, db_path):
+        # Re-stored batch sheets come back under new ids; start over rather than count them twice
+        analysis = ItemAnalysis(answer_key)
+        stored = load_responses(version, db_path=db_path)
+        analysis.update(stored["marks"])
+        analysis.last_id = int(stored["id"].max()) if len(stored["id"]) else 0
+    return analysis
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Item difficulty, discrimination and distractor analysis.")
+    parser.add_argument("version", help="version the responses were stored under (e.g. 1, or setA for batch runs)")
+    parser.add_argument("--key", help="answer key file; defaults to the key registered for the version")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--output", help="write the item table to this CSV")
+    args = parser.parse_args()
+    if not args.key and not args.version.isdigit():
+        # Registered keys are numbered; batch runs store responses under their set folder's name
+        parser.error(f"no answer key is registered for version {args.version!r}; pass --key for batch versions")
+    answer_key = AnswerKey(parse_answer_key(args.key)) if args.key else None
+    try:
+        analysis = analyze_version(args.version, answer_key, db_path=args.db)
+    except ValueError as e:
+        parser.error(str(e))
+    items = analysis.items()
+    print(f"{len(analysis)} sheets, {len(items)} keyed questions")
+    print(analysis.subject_scores().round(2).to_string(index=False))
+    if args.output:
+        items.to_csv(args.output, index=False)
+        print(f"Saved item table to {args.output}")
+    else:
+        print(items.round(3).to_string(index=False))
@@ -0,0 +1,180 @@
+import json
+import datetime
+import threading
+from db import get_connection
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+# Submitted but not yet claimable; see JobQueue.release
+HELD = "held"
+
+def init_jobs_table(db_path):
+    """Create the jobs table used by JobQueue if it doesn't exist."""
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT,
+            file_name TEXT,
+            file_path TEXT,
+            payload TEXT,
+            status TEXT DEFAULT 'queued',
+            error TEXT,
+            result_id INTEGER,
+            created_at TEXT,
+            started_at TEXT,
+            finished_at TEXT
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id)")
+
+class JobQueue:
+    """
+    Durable evaluation queue: jobs live in a SQLite table and a pool of worker
+    threads claims and runs them in the background.
+
+    `handler(job)` receives the job as a dict (payload already decoded) and may
+    return a result id; any exception marks the job as failed with its message.
+    Jobs left 'running' by a previous server process are re-queued on start.
+    """
+
+    def __init__(self, db_path, handler, workers=2, poll_interval=1.0):
+        self.db_path = db_path
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._claim_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        init_jobs_table(db_path)
+
+    def start(self):
+        conn = get_connection(self.db_path)
+        with conn:
+            conn.execute("UPDATE jobs SET status=?, started_at=NULL WHERE status=?", (QUEUED, RUNNING))
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"omr-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, batch_id, file_name, file_path, payload):
+        """Queue one file for evaluation and return its job id."""
+        return self.submit_many(batch_id, [(file_name, file_path, payload)])[0]
+
+    def submit_many(self, batch_id, items, status=QUEUED):
+        """
+        Queue (file_name, file_path, payload) items in one transaction; returns job ids.
+        With status=HELD the jobs are recorded but not run until release(batch_id).
+        """
+        now = datetime.datetime.now().isoformat()
+        conn = get_connection(self.db_path)
+        job_ids = []
+        with conn:
+            cursor = conn.cursor()
+            for file_name, file_path, payload in items:
+                cursor.execute("""
+                    INSERT INTO jobs (batch_id, file_name, file_path, payload, status, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (batch_id, file_name, file_path, json.dumps(payload), status, now))
+                job_ids.append(cursor.lastrowid)
+        self._wake.set()
+        return job_ids
+
+    def release(self, batch_id):
+        """Make a batch's held jobs claimable."""
+        conn = get_connection(self.db_path)
+        with conn:
+            conn.execute("UPDATE jobs SET status=? WHERE batch_id=? AND status=?", (QUEUED, batch_id, HELD))
+        self._wake.set()
+
+    def discard(self, batch_id):
+        """Drop a batch's held jobs."""
+        conn = get_connection(self.db_path)
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE batch_id=? AND status=?", (batch_id, HELD))
+
+    def held_batches(self):
+        """{batch_id: [file_path, ...]} of the jobs still held."""
+        held = {}
+        for batch_id, file_path in get_connection(self.db_path).execute(
+                "SELECT batch_id, file_path FROM jobs WHERE status=? ORDER BY id", (HELD,)):
+            held.setdefault(batch_id, []).append(file_path)
+        return held
+
+    def batch_progress(self, batch_id):
+        """Return {"queued": n, "running": n, "done": n, "failed": n, "total": n} for a batch."""
+        rows = get_connection(self.db_path).execute(
+            "SELECT status, COUNT(*) FROM jobs WHERE batch_id=? GROUP BY status", (batch_id,)).fetchall()
+        progress = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        progress.update(dict(rows))
+        progress["total"] = sum(progress.values())
+        return progress
+
+    def batch_failures(self, batch_id):
+        return get_connection(self.db_path).execute(
+            "SELECT file_name, error FROM jobs WHERE batch_id=? AND status=? ORDER BY id",
+            (batch_id, FAILED)).fetchall()
+
+    def recent_batches(self, limit=10):
+        """Most recent batches with their payload of the first job and job counts."""
+        rows = get_connection(self.db_path).execute("""
+            SELECT batch_id, MIN(payload), MIN(created_at), COUNT(*),
+                   SUM(status IN (?, ?)), SUM(status = ?)
+            FROM jobs GROUP BY batch_id ORDER BY MAX(id) DESC LIMIT ?
+        """, (DONE, FAILED, FAILED, limit)).fetchall()
+        return [{"batch_id": batch_id, "payload": json.loads(payload), "created_at": created_at,
+                 "total": total, "finished": finished, "failed": failed}
+                for batch_id, payload, created_at, total, finished, failed in rows]
+
+    def _claim(self):
+        # The lock serialises threads of this process; BEGIN IMMEDIATE serialises processes.
+        with self._claim_lock:
+            conn = get_connection(self.db_path)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("""
+                    SELECT id, batch_id, file_name, file_path, payload FROM jobs
+                    WHERE status=? ORDER BY id LIMIT 1
+                """, (QUEUED,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE jobs SET status=?, started_at=? WHERE id=?",
+                                 (RUNNING, datetime.datetime.now().isoformat(), row[0]))
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+            if row is None:
+                return None
+        job_id, batch_id, file_name, file_path, payload = row
+        return {"id": job_id, "batch_id": batch_id, "file_name": file_name,
+                "file_path": file_path, "payload": json.loads(payload)}
+
+    def _finish(self, job_id, status, result_id=None, error=None):
+        conn = get_connection(self.db_path)
+        with conn:
+            conn.execute("UPDATE jobs SET status=?, result_id=?, error=?, finished_at=? WHERE id=?",
+                         (status, result_id, error, datetime.datetime.now().isoformat(), job_id))
+
+    def _work(self):
+        while not self._stop.is_set():
+            job = self._claim()
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            try:
+                result_id = self.handler(job)
+            except Exception as e:
+                self._finish(job["id"], FAILED, error=f"{type(e).__name__}: {e}")
+            else:
+                self._finish(job["id"], DONE, result_id=result_id)
@@ -0,0 +1,339 @@
+import os
+import argparse
+import cv2
+import numpy as np
+from preprocess import get_preprocessor
+from omr_to_csv import subjects, questions_per_subject, options, MIN_GRID_FIT, bubble_centers, locate_bubbles
+from extract_multiple_answers import get_bubble_contours
+from utils import label_fill_stats
+from confidence import mark_confidence
+from profiling import stage
+
+LAYOUT_DIR = 'layouts'
+ALIGN_WIDTH = 400          # sheet and template are compared at this width to tell which way up the sheet is
+MATCH_SIGMA = 4            # px at ALIGN_WIDTH; high-pass that keeps printed strokes and drops uneven lighting
+MATCH_MARGIN = 6           # bubble radii around the grid compared (question numbers, column letters, headings)
+MIN_ALIGN_INLIERS = 15
+
+# version -> layout dict; filled from disk on first use in each process
+_layouts = {}
+
+def _find_circles(gray):
+    """
+    Return (x, y, diameter) rows for every circle outline on the sheet, filled or empty.
+    Unlike get_bubble_contours this keeps empty rings, which a template needs.
+    """
+    h, w = gray.shape
+    # Blur first: thin printed rings survive, paper texture does not
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    binary = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV,
+                                   int(w / 40) | 1, 8)
+    contours, _ = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    found = []
+    for cnt in contours:
+        area = cv2.contourArea(cnt)
+        perimeter = cv2.arcLength(cnt, True)
+        if area < 20 or perimeter == 0:
+            continue
+        x, y, bw, bh = cv2.boundingRect(cnt)
+        circularity = (4 * np.pi * area) / (perimeter * perimeter)
+        if circularity > 0.7 and 0.75 < bw / bh < 1.33:
+            found.append((x + bw / 2, y + bh / 2, (bw + bh) / 2))
+    if not found:
+        return np.zeros((0, 3))
+
+    # Rings produce an inner and an outer contour: keep the larger one only
+    found = np.array(found)
+    found = found[np.argsort(-found[:, 2])]
+    kept = []
+    for x, y, d in found:
+        if all((x - kx) ** 2 + (y - ky) ** 2 > (kd / 2) ** 2 for kx, ky, kd in kept):
+            kept.append((x, y, d))
+    kept = np.array(kept)
+
+    # Bubbles share one size; keep the dominant diameter
+    diameters = np.round(kept[:, 2]).astype(int)
+    diameters_hist = np.bincount(diameters[(diameters > w / 80) & (diameters < w / 15)])
+    if not len(diameters_hist):
+        return np.zeros((0, 3))
+    mode = diameters_hist.argmax()
+    return kept[(kept[:, 2] > mode * 0.8) & (kept[:, 2] < mode * 1.25)]
+
+def _split_by_gaps(values, max_gap):
+    """Split sorted 1-D values into runs wherever the gap exceeds max_gap; returns index arrays."""
+    order = np.argsort(values)
+    breaks = np.flatnonzero(np.diff(values[order]) > max_gap) + 1
+    return np.split(order, breaks)
+
+def _longest_regular_run(rows, positions):
+    """Keep the longest run of rows whose spacing stays within 3x the typical row spacing."""
+    if len(rows) < 2:
+        return rows
+    gaps = np.diff(positions)
+    breaks = np.flatnonzero(gaps > 3 * np.median(gaps)) + 1
+    runs = np.split(np.arange(len(rows)), breaks)
+    best = max(runs, key=len)
+    return [rows[i] for i in best]
+
+def _column_chains(circles, diameter):
+    """
+    Group circles into option columns by chaining each one to the bubbles directly
+    above/below it. Chains follow perspective and skew, unlike a global split on x.
+    Returns index arrays sorted left-to-right.
+    """
+    dx = np.abs(circles[None, :, 0] - circles[:, None, 0])
+    dy = np.abs(circles[None, :, 1] - circles[:, None, 1])
+    linked = (dx < 0.4 * diameter) & (dy > 0.5 * diameter) & (dy < 4.5 * diameter)
+
+    parent = list(range(len(circles)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in zip(*np.nonzero(np.triu(linked))):
+        parent[find(i)] = find(j)
+
+    roots = np.array([find(i) for i in range(len(circles))])
+    chains = [np.flatnonzero(roots == r) for r in np.unique(roots)]
+    return sorted(chains, key=lambda c: circles[c, 0].mean())
+
+def detect_grid(gray):
+    """
+    Find the full (questions x options) bubble grid on a reference sheet.
+
+    Circles are chained into option columns and split into question rows by y
+    within each subject; every grid position is the intersection of its fitted
+    column and row lines, so bubbles missed by the detector are filled in.
+    Returns (centers, radius) with centers shaped (questions * options, 2) in
+    question-major order, or raises ValueError if the grid does not match the
+    sheet layout.
+    """
+    circles = _find_circles(gray)
+    n_columns = len(subjects) * len(options)
+    if len(circles) < n_columns:
+        raise ValueError(f"only {len(circles)} bubbles found on reference sheet")
+    diameter = np.median(circles[:, 2])
+
+    # Question numbers and header samples form short chains; real columns span the sheet
+    columns = [c for c in _column_chains(circles, diameter) if len(c) >= questions_per_subject // 2]
+    if len(columns) != n_columns:
+        raise ValueError(f"expected {n_columns} option columns, found {len(columns)}")
+
+    centers = np.zeros((len(subjects) * questions_per_subject, len(options), 2))
+    for subj_idx in range(len(subjects)):
+        subj_cols = columns[subj_idx * len(options):(subj_idx + 1) * len(options)]
+        members = np.concatenate(subj_cols)
+        rows = [members[r] for r in _split_by_gaps(circles[members, 1], 0.6 * diameter)]
+        rows = _longest_regular_run(rows, np.array([circles[r, 1].mean() for r in rows]))
+        if len(rows) != questions_per_subject:
+            raise ValueError(f"expected {questions_per_subject} rows for {subjects[subj_idx]}, found {len(rows)}")
+
+        # Column lines x = a + b*y and row lines y = c + d*x follow the remaining skew/perspective
+        col_lines = []
+        for col in subj_cols:
+            col = col[np.isin(col, np.concatenate(rows))]
+            xs, ys = circles[col, 0], circles[col, 1]
+            col_lines.append(np.polyfit(ys, xs, 1) if len(col) > 1 else (0.0, xs.mean()))
+        for row_idx, row in enumerate(rows):
+            xs, ys = circles[row, 0], circles[row, 1]
+            d, c = np.polyfit(xs, ys, 1) if len(row) > 1 else (0.0, ys.mean())
+            for opt_idx, (b, a) in enumerate(col_lines):
+                # Solve x = a + b*y, y = c + d*x
+                y = (c + d * a) / (1 - d * b)
+                centers[subj_idx * questions_per_subject + row_idx, opt_idx] = (a + b * y, y)
+    return centers.reshape(-1, 2), diameter / 2
+
+def _thumbnail(gray):
+    scale = ALIGN_WIDTH / gray.shape[1]
+    return cv2.resize(gray, (ALIGN_WIDTH, max(1, int(round(gray.shape[0] * scale)))),
+                      interpolation=cv2.INTER_AREA), scale
+
+def register_layout(version, reference_image, layout_dir=LAYOUT_DIR):
+    """
+    Detect the bubble grid on a reference sheet (BGR) for `version` and cache it
+    in memory and as <layout_dir>/<version>.npz.
+    """
+    preprocessor = get_preprocessor()
+    gray = preprocessor.brighten(preprocessor.grayscale(reference_image))
+    centers, radius = detect_grid(gray)
+    thumbnail, thumbnail_scale = _thumbnail(preprocessor.equalize(gray))
+    layout = {
+        "version": str(version),
+        "centers": centers.astype(np.float32),
+        "radius": float(radius),
+        "thumbnail": thumbnail,
+        "thumbnail_scale": float(thumbnail_scale),
+    }
+    os.makedirs(layout_dir, exist_ok=True)
+    np.savez_compressed(os.path.join(layout_dir, f"{version}.npz"), **layout)
+    _layouts[str(version)] = layout
+    return layout
+
+def get_layout(version, layout_dir=LAYOUT_DIR):
+    """
+    Return the cached layout for `version`, loading it from disk once; None if not
+    registered (or only in the older format without a thumbnail, which must be re-registered).
+    """
+    version = str(version)
+    if version not in _layouts:
+        path = os.path.join(layout_dir, f"{version}.npz")
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if "thumbnail" not in data.files:
+                return None
+            layout = {key: data[key] for key in data.files}
+        layout["version"] = version
+        layout["radius"] = float(layout["radius"])
+        layout["thumbnail_scale"] = float(layout["thumbnail_scale"])
+        _layouts[version] = layout
+    return _layouts[version]
+
+def ensure_layout(version, reference_paths, layout_dir=LAYOUT_DIR):
+    """
+    Return the layout for `version`, registering it from the first of
+    reference_paths that yields a complete grid if it is not cached yet.
+    """
+    layout = get_layout(version, layout_dir)
+    if layout is not None:
+        return layout
+    errors = []
+    for path in reference_paths:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        try:
+            return register_layout(version, image, layout_dir)
+        except ValueError as e:
+            errors.append(f"{os.path.basename(path)}: {e}")
+    raise ValueError(f"could not register layout for {version}: " + "; ".join(errors))
+
+def _quarter_turn(centers, shape):
+    """The bubble centers as they would sit on the sheet turned a quarter turn, and that sheet's width."""
+    h = shape[0]
+    return np.column_stack([h - 1 - centers[:, 1], centers[:, 0]]), h
+
+def _high_pass(image):
+    image = image.astype(np.float32)
+    return image - cv2.GaussianBlur(image, (0, 0), MATCH_SIGMA)
+
+def _template_match(sheet, scale, layout, H):
+    """
+    How well the print around the grid matches the template's once warped onto the sheet
+    by H: the correlation of the two high-passed thumbnails near the grid, with the
+    bubbles masked out since their fill differs from sheet to sheet. sheet is the sheet's
+    high-passed thumbnail and scale its size relative to the sheet.
+    """
+    thumbnail = layout["thumbnail"]
+    M = np.diag([scale, scale, 1.0]) @ H @ np.diag([1 / layout["thumbnail_scale"]] * 2 + [1.0])
+    size = (sheet.shape[1], sheet.shape[0])
+    warped = cv2.warpPerspective(thumbnail, M, size)
+    compared = cv2.warpPerspective(np.full_like(thumbnail, 255), M, size, flags=cv2.INTER_NEAREST)
+    centers, radius = map_layout(layout, H)
+    centers, radius = centers * scale, radius * scale
+    near = np.zeros_like(compared)
+    top_left = np.floor(centers.min(axis=0) - MATCH_MARGIN * radius).astype(int)
+    bottom_right = np.ceil(centers.max(axis=0) + MATCH_MARGIN * radius).astype(int)
+    cv2.rectangle(near, tuple(map(int, top_left)), tuple(map(int, bottom_right)), 255, -1)
+    compared = cv2.bitwise_and(compared, near)
+    for x, y in np.round(centers).astype(int):
+        cv2.circle(compared, (int(x), int(y)), int(np.ceil(1.4 * radius)), 0, -1)
+    covered = compared > 0
+    if covered.sum() < 2:
+        return -1.0
+    a, b = _high_pass(warped)[covered], sheet[covered]
+    if a.std() == 0 or b.std() == 0:
+        return -1.0
+    return float(np.corrcoef(a, b)[0, 1])
+
+def align_to_layout(gray, layout, profile=None):
+    """
+    Homography mapping template coordinates onto `gray`, fitted to the bubbles found on
+    the sheet: grid.infer_grid puts each one in its (question, option) cell, whose
+    template center it must land on. The grid alone can't tell which way up the sheet
+    is, so every turn it fits in is tried and the one whose print best matches the
+    template's thumbnail wins (see _template_match).
+
+    Returns (H, grid) with grid the dict read_sheet reports: infer_grid's "off_grid",
+    "duplicates" and "fit" for the chosen turn, plus "residual", how far (in bubble
+    radii) the 90th percentile on-grid bubble sits from its nearest template position.
+    """
+    bubbles = get_bubble_contours(gray, profile)
+    with stage(profile, "align"):
+        if not bubbles:
+            raise ValueError(f"no bubbles found to align to layout {layout['version']}")
+        centers = bubble_centers(bubbles)
+        centers = centers[~np.isnan(centers).any(axis=1)].astype(np.float32)
+        bubble_radius = np.sqrt(np.median([cv2.contourArea(c) for c in bubbles]) / np.pi)
+        template = layout["centers"]
+        turns = [locate_bubbles(centers, gray.shape[1]), locate_bubbles(*_quarter_turn(centers, gray.shape))]
+        best_fit = max(turn[5] for turn in turns)
+        candidates = []
+        for question, option, unassigned, duplicates, _, fit in turns:
+            on_grid = question >= 0
+            if fit < min(best_fit, MIN_GRID_FIT) or on_grid.sum() < MIN_ALIGN_INLIERS:
+                continue
+            grid = {"off_grid": len(unassigned), "duplicates": len(duplicates), "fit": fit}
+            cell = question[on_grid] * len(options) + option[on_grid]
+            # The grid is point-symmetric, so the half turn reads the same cells backwards
+            for cells in (cell, len(template) - 1 - cell):
+                H, inliers = cv2.findHomography(template[cells], centers[on_grid], cv2.RANSAC, bubble_radius)
+                if H is not None and inliers.sum() >= MIN_ALIGN_INLIERS:
+                    candidates.append((H, dict(grid), centers[on_grid]))
+        if not candidates:
+            raise ValueError(f"could not align sheet to layout {layout['version']}")
+        if len(candidates) > 1:
+            small, scale = _thumbnail(gray)
+            sheet = _high_pass(small)
+            candidates.sort(key=lambda candidate: -_template_match(sheet, scale, layout, candidate[0]))
+        H, grid, found = candidates[0]
+
+        mapped, radius = map_layout(layout, H)
+        distances = np.sqrt(((found[:, None] - mapped[None]) ** 2).sum(axis=2)).min(axis=1)
+        grid["residual"] = float(np.percentile(distances, 90) / radius)
+    return H, grid
+
+def map_layout(layout, H):
+    """Bubble centers and radius of the layout in sheet coordinates."""
+    centers = cv2.perspectiveTransform(layout["centers"].reshape(-1, 1, 2), H).reshape(-1, 2)
+    scale = np.sqrt(abs(np.linalg.det(H[:2, :2] / H[2, 2])))
+    return centers, layout["radius"] * scale
+
+def sample_layout(gray, centers, radius, fill_threshold=150):
+    """
+    Mean intensity and fill ratio of the inner disc of every known bubble position,
+    computed in one pass over a label image of the discs.
+    """
+    labels = np.zeros(gray.shape, dtype=np.int32)
+    inner = max(1, int(round(radius * 0.8)))  # stay inside the printed ring
+    for i, (x, y) in enumerate(np.round(centers).astype(int)):
+        cv2.circle(labels, (int(x), int(y)), inner, i + 1, -1)
+    return label_fill_stats(gray, labels, len(centers), fill_threshold)
+
+def read_marks(gray, layout, fill_threshold=150, profile=None):
+    """
+    Align a preprocessed sheet to the layout and return (marks, fill, confidence, centers,
+    radius, grid): marks is a (questions, options) bool array, fill the matching fill ratios,
+    confidence how clear each decision is (see confidence.mark_confidence) and grid the
+    alignment report of align_to_layout.
+    """
+    H, grid = align_to_layout(gray, layout, profile)
+    centers, radius = map_layout(layout, H)
+    with stage(profile, "fill_analysis"):
+        fill_level, fill_ratio = sample_layout(gray, centers, radius, fill_threshold)
+        marks, confidence = mark_confidence(fill_level, fill_ratio, fill_threshold)
+    return (marks.reshape(-1, len(options)), fill_ratio.reshape(-1, len(options)),
+            confidence.reshape(-1, len(options)), centers, radius, grid)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register the bubble layout for a sheet version.")
+    parser.add_argument("version", help="sheet version, e.g. setA")
+    parser.add_argument("reference", help="path to a clean reference sheet of that version")
+    parser.add_argument("--layout-dir", default=LAYOUT_DIR)
+    args = parser.parse_args()
+    image = cv2.imread(args.reference)
+    if image is None:
+        raise SystemExit(f"Failed to load {args.reference}")
+    layout = register_layout(args.version, image, args.layout_dir)
+    print(f"Registered {len(layout['centers'])} bubbles for {args.version} in {args.layout_dir}")
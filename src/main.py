@@ -1,11 +1,41 @@
-import subprocess
+import os
 import sys
+import argparse
 
-def run_all():
-    # Highlight bubbles and save annotated images (Stage 1)
-    subprocess.run([sys.executable, "src/process_input_images.py"], check=True)
-    # Convert highlighted/annotated images to CSV answers (Stage 2)
-    subprocess.run([sys.executable, "src/extract_answers_csv.py"], check=True)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from pipeline import run_pipeline
+from profiling import write_profile_report
+from utils import print_batch_summary
+
+def run_all(workers=1, annotate=False, profile_path=None, force=False, csv_dir="csv_output", response_db=None):
+    # Detect, highlight and extract answers in one in-process pass per sheet.
+    # Answers are written as one CSV per sheet under csv_dir (None skips them);
+    # responses (response_db, see responses.py) and annotated images
+    # (data/output) are only written when asked for.
+    # Sheets already evaluated by the same code are skipped unless force is set.
+    summary = run_pipeline(input_dir="data/input", csv_root=csv_dir,
+                           annotated_dir="data/output" if annotate else None, workers=workers,
+                           profile=bool(profile_path), incremental=not force, response_db=response_db)
+    print_batch_summary(summary)
+    if profile_path:
+        write_profile_report(summary, profile_path)
+    return summary
 
 if __name__ == "__main__":
-    run_all()
+    parser = argparse.ArgumentParser(description="Run the full OMR pipeline over data/input.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (0 = one per CPU core)")
+    parser.add_argument("--annotate", action="store_true",
+                        help="write annotated sheets to data/output")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="write per-stage timings to REPORT (.json summary or .csv records)")
+    parser.add_argument("--force", action="store_true", help="re-evaluate every sheet, ignoring the result cache")
+    parser.add_argument("--csv-dir", default="csv_output", help="write one answers CSV per sheet here")
+    parser.add_argument("--no-csv", action="store_true", help="don't write the per-sheet CSVs")
+    parser.add_argument("--db", default=None,
+                        help="also save every sheet's marks and fill ratios to the response store in this database")
+    args = parser.parse_args()
+    run_all(workers=args.workers if args.workers > 0 else os.cpu_count() or 1, annotate=args.annotate,
+            profile_path=args.profile, force=args.force, csv_dir=None if args.no_csv else args.csv_dir,
+            response_db=args.db)
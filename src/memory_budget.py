@@ -0,0 +1,76 @@
+import os
+import threading
+from contextlib import contextmanager
+from PIL import Image
+from pdf_ingest import PDF_DPI, is_pdf, pdf_page_size, split_page_ref
+
+# Budget for sheets being evaluated at once, in MB; 0 = half of the machine's physical memory
+MEMORY_BUDGET_MB = int(os.environ.get("OMR_MEMORY_BUDGET_MB", "0"))
+# A sheet's peak is about 1.4x its decoded BGR size (the decode plus its grayscale), or
+# 1.7x when annotated (the full-size annotation next to the grayscale pipeline.second_pass
+# samples); the rest is headroom for allocator and OpenCV buffers
+SHEET_MEMORY_FACTOR = 2.0
+# Working-resolution images, labels and contours, whatever the input size
+SHEET_OVERHEAD_MB = 32
+
+def default_budget_mb():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2 // 2**20
+    except (AttributeError, ValueError, OSError):
+        return 2048
+
+def estimate_sheet_bytes(path, page=None, dpi=PDF_DPI):
+    """
+    Estimated peak memory of evaluating one sheet, from its pixel size. Only the
+    image header (or the PDF page box) is read; "scan.pdf#page=3" names a page.
+    Returns None when the size can't be read.
+    """
+    path, ref_page = split_page_ref(path)
+    try:
+        if is_pdf(path):
+            width, height = pdf_page_size(path, page or ref_page or 1, dpi)
+        else:
+            with Image.open(path) as image:
+                width, height = image.size
+    except Exception:
+        return None
+    return int(width * height * 3 * SHEET_MEMORY_FACTOR) + SHEET_OVERHEAD_MB * 2**20
+
+class MemoryBudget:
+    """
+    Limits the sheets in flight by their estimated memory (see
+    estimate_sheet_bytes) instead of by count. acquire() blocks while the
+    reserved total would go over the limit, which holds the submitting side back
+    until running sheets finish. A sheet that alone exceeds the limit, or whose
+    size can't be read, reserves the whole budget and so runs by itself.
+    Thread-safe: share one instance between the workers of a process.
+    """
+
+    def __init__(self, limit_mb=MEMORY_BUDGET_MB):
+        self.limit = int((limit_mb or default_budget_mb()) * 2**20)
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def cost(self, path, page=None, dpi=PDF_DPI):
+        estimate = estimate_sheet_bytes(path, page, dpi)
+        return self.limit if estimate is None else min(estimate, self.limit)
+
+    def acquire(self, nbytes):
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_use == 0 or self.in_use + nbytes <= self.limit)
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+
+    def release(self, nbytes):
+        with self._cond:
+            self.in_use -= nbytes
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
@@ -2,92 +2,159 @@ import cv2
 import numpy as np
 import os
 import glob
+import argparse
 import pandas as pd
+from utils import bubble_fill_stats, to_working_resolution
+from profiling import stage
+from grid import infer_grid
+from result_cache import CACHE_DB_PATH, file_digest, params_digest, lookup, store_many
 
 # Subjects and question mapping
 subjects = ['Python', 'EDA', 'SQL', 'POWER BI', 'Statistics']
 questions_per_subject = 20
 options = ['a', 'b', 'c', 'd']
+questions_per_group = 5  # question rows are printed in blocks of 5
+
+# Sheets whose bubbles fit the question grid worse than this are sent to review: the
+# grid's fit (see grid.infer_grid), and how many bubbles fell off it or onto a taken cell
+MIN_GRID_FIT = 0.75
+MAX_OFF_GRID = 10
+MAX_DUPLICATES = 2
+# ...and, for sheets read with a layout, how far (in bubble radii) the found bubbles sit
+# from the aligned template positions (see layout.align_to_layout)
+MAX_ALIGN_RESIDUAL = 0.5
+
+# Modules whose code determines the extracted answers; see result_cache.params_digest
+ANSWER_MODULES = ("omr_to_csv", "utils", "grid")
+
+def bubble_centers(contours):
+    """(n, 2) float array of contour centroids (cx, cy), indexed like `contours`; NaN where a contour has no area."""
+    centers = np.full((len(contours), 2), np.nan)
+    for idx, c in enumerate(contours):
+        M = cv2.moments(c)
+        if M["m00"] != 0:
+            centers[idx] = (M["m10"] / M["m00"], M["m01"] / M["m00"])
+    return centers
 
-def extract_answers_from_image(image_path):
+def locate_bubbles(centers, img_width=None):
     """
-    Extract answers from a highlighted OMR image.
+    Place bubble centers on this sheet's question/option grid (see grid.infer_grid).
+    Returns (question, option, unassigned, duplicates, cells, fit); question runs 0-99 in subject order.
     """
-    image = cv2.imread(image_path)
-    if image is None:
-        print(f"Failed to load {image_path}")
+    return infer_grid(centers, len(subjects), questions_per_subject, len(options), questions_per_group,
+                      img_width)
+
+def grid_misfit(grid):
+    """
+    Why the bubbles' placement on the question grid can't be trusted, or None. grid is
+    the dict read_sheet returns: "off_grid" and "duplicates" bubble counts and "fit",
+    plus the alignment "residual" for a sheet read with a layout; None passes.
+    """
+    if grid is None:
         return None
+    problems = []
+    if grid["fit"] < MIN_GRID_FIT or grid["off_grid"] > MAX_OFF_GRID or grid["duplicates"] > MAX_DUPLICATES:
+        problems.append(f"Bubble grid did not fit: {grid['fit']:.0%} of row/column steps match the printed "
+                        f"spacing; {grid['off_grid']} off-grid and {grid['duplicates']} duplicate bubbles.")
+    if grid.get("residual", 0) > MAX_ALIGN_RESIDUAL:
+        problems.append(f"Sheet did not align to its layout: bubbles sit {grid['residual']:.1f} radii "
+                        f"from the template positions.")
+    return " ".join(problems) or None
+
+def marks_from_grid(question, option, values, empty=0):
+    """
+    Scatter per-bubble `values` (e.g. filled flags or fill ratios, indexed like the
+    bubbles) into a (questions, options) array at the cells locate_bubbles gave them.
+    Bubbles off the grid (question -1) are dropped; cells without one hold `empty`.
+    """
+    values = np.asarray(values)
+    grid = np.full((len(subjects) * questions_per_subject, len(options)), empty, dtype=values.dtype)
+    on_grid = question >= 0
+    grid[question[on_grid], option[on_grid]] = values[on_grid]
+    return grid
 
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    _, thresh = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY_INV)
+def answers_from_marks(marks):
+    """
+    Turn a (questions, options) bool array, question-major in subject order, into answers_data.
+    """
+    answers_data = {subj: [] for subj in subjects}
+    for q, row in enumerate(marks[:len(subjects) * questions_per_subject]):
+        answers_data[subjects[q // questions_per_subject]].append(
+            ",".join(options[i] for i in range(len(options)) if row[i]))
+    return answers_data
+
+def answers_to_marks(answers_data):
+    """
+    Inverse of answers_from_marks: a (questions, options) bool array from answers_data.
+    """
+    marks = np.zeros((len(subjects) * questions_per_subject, len(options)), dtype=bool)
+    for subj_idx, subj in enumerate(subjects):
+        for i, ans in enumerate(answers_data[subj][:questions_per_subject]):
+            for opt in ans.lower().split(",") if ans else []:
+                if opt.strip() in options:
+                    marks[subj_idx * questions_per_subject + i, options.index(opt.strip())] = True
+    return marks
+
+def answers_to_dict(answers_data):
+    """Flatten answers_data into {question_number: "a,c"} for answered questions only."""
+    answers = {}
+    for subj_idx, subj in enumerate(subjects):
+        for i, ans in enumerate(answers_data[subj][:questions_per_subject]):
+            if ans:
+                answers[i + 1 + (subj_idx * questions_per_subject)] = ans.lower()
+    return answers
+
+def extract_answers(image, profile=None):
+    """
+    Extract answers from an in-memory highlighted OMR image (BGR). Returns
+    (answers_data, problem), problem being why the bubbles' placement on the
+    question grid can't be trusted or None (see grid_misfit); None if no bubbles
+    were found.
+    """
+    with stage(profile, "normalize"):
+        image, _ = to_working_resolution(image)
+
+    with stage(profile, "threshold"):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        _, thresh = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY_INV)
 
     # Detect contours of bubbles
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    with stage(profile, "find_contours"):
+        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     # Filter contours that look like bubbles
-    bubble_contours = []
-    for c in contours:
-        area = cv2.contourArea(c)
-        perimeter = cv2.arcLength(c, True)
-        if area > 180 and perimeter > 35:
-            bubble_contours.append(c)
-
-    # Map bubbles to their centers
-    bubble_centers = []
-    for c in bubble_contours:
-        M = cv2.moments(c)
-        if M["m00"] == 0:
-            continue
-        cx = int(M["m10"]/M["m00"])
-        cy = int(M["m01"]/M["m00"])
-        bubble_centers.append((cx, cy, c))
-
-    if not bubble_centers:
+    with stage(profile, "contour_filter"):
+        bubble_contours = []
+        for c in contours:
+            area = cv2.contourArea(c)
+            perimeter = cv2.arcLength(c, True)
+            if area > 180 and perimeter > 35:
+                bubble_contours.append(c)
+    if not bubble_contours:
         return None
 
-    # Sort bubbles top-to-bottom
-    bubble_centers.sort(key=lambda x: x[1])
+    # thresh marks pixels <= 150, so its fill ratio is the share of those pixels per bubble
+    with stage(profile, "fill_analysis"):
+        _, fill_ratio = bubble_fill_stats(gray, bubble_contours, 150)
+        filled = fill_ratio > 0.5  # adjust threshold if needed
 
-    # Determine approximate column widths
-    img_width = image.shape[1]
-    col_width = img_width / len(subjects)
-    subject_buckets = {subj: [] for subj in subjects}
+    with stage(profile, "group_answers"):
+        question, option, unassigned, duplicates, _, fit = locate_bubbles(bubble_centers(bubble_contours),
+                                                                          image.shape[1])
+        problem = grid_misfit({"off_grid": len(unassigned), "duplicates": len(duplicates), "fit": fit})
+        return answers_from_marks(marks_from_grid(question, option, filled)), problem
 
-    for cx, cy, c in bubble_centers:
-        col_idx = min(int(cx // col_width), len(subjects)-1)
-        subject_buckets[subjects[col_idx]].append((cx, cy, c))
-
-    # Extract answers
-    answers_data = {subj: [] for subj in subjects}
-
-    for subj in subjects:
-        # Sort bubbles in this column top-to-bottom
-        col_bubbles = sorted(subject_buckets[subj], key=lambda x: x[1])
-        # Process in groups of 4 (A-D)
-        for i in range(0, len(col_bubbles), 4):
-            group = col_bubbles[i:i+4]
-            group = sorted(group, key=lambda x: x[0])  # left-to-right
-
-            bubbled_options = []
-            for idx, (cx, cy, c) in enumerate(group):
-                mask = np.zeros(gray.shape, dtype=np.uint8)
-                cv2.drawContours(mask, [c], -1, 255, -1)
-                filled_pixels = cv2.countNonZero(cv2.bitwise_and(thresh, mask))
-                total_pixels = cv2.countNonZero(mask)
-                fill_ratio = filled_pixels / total_pixels if total_pixels > 0 else 0
-                if fill_ratio > 0.5:  # adjust threshold if needed
-                    bubbled_options.append(options[idx])
-
-            if bubbled_options:
-                answers_data[subj].append(",".join(bubbled_options))
-            else:
-                answers_data[subj].append('')
-
-        # Pad to 20 questions if less
-        while len(answers_data[subj]) < questions_per_subject:
-            answers_data[subj].append('')
-
-    return answers_data
+def extract_answers_from_image(image_path, profile=None):
+    """
+    Extract answers from a highlighted OMR image: extract_answers' (answers_data,
+    problem), or None if the image can't be read or has no bubbles.
+    """
+    with stage(profile, "imread"):
+        image = cv2.imread(image_path)
+    if image is None:
+        print(f"Failed to load {image_path}")
+        return None
+    return extract_answers(image, profile)
 
 def save_answers_to_csv(answers_data, output_csv_path):
     """
@@ -107,20 +174,63 @@ def save_answers_to_csv(answers_data, output_csv_path):
     df.to_csv(output_csv_path, index=False)
     print(f"Saved CSV to {output_csv_path}")
 
-def process_all_images(input_root='data/output', csv_root='csv_output'):
+def load_answers_csv(csv_path):
+    """
+    Read a CSV written by save_answers_to_csv back into answers_data.
+    """
+    df = pd.read_csv(csv_path, dtype=str).fillna('')
+    answers_data = {subj: [] for subj in subjects}
+    for subj_idx, subj in enumerate(subjects):
+        column = df.iloc[:, subj_idx] if subj_idx < df.shape[1] else []
+        for cell in column:
+            # "23 - a,c" -> "a,c"; "23 -" -> ""
+            answers_data[subj].append(cell.split('-', 1)[1].strip() if '-' in cell else '')
+        while len(answers_data[subj]) < questions_per_subject:
+            answers_data[subj].append('')
+    return answers_data
+
+def process_all_images(input_root='data/output', csv_root='csv_output', incremental=True, cache_db=CACHE_DB_PATH):
+    """
+    Extract answers from every highlighted image under input_root/<set>/ into
+    csv_root/<set>/<sheet>.csv. With incremental=True images already extracted
+    by the same code are skipped (or their cached answers written to a new path).
+    """
+    params = params_digest(ANSWER_MODULES) if incremental else None
+    extracted = []
     for set_folder in os.listdir(input_root):
         set_path = os.path.join(input_root, set_folder)
         if not os.path.isdir(set_path):
             continue
         for img_file in sorted(glob.glob(os.path.join(set_path, '*.jpeg'))):
-            answers = extract_answers_from_image(img_file)
+            rel_path = os.path.relpath(img_file, input_root)
+            csv_folder = os.path.join(csv_root, os.path.dirname(rel_path))
+            output_csv_path = os.path.join(csv_folder, os.path.splitext(os.path.basename(img_file))[0] + '.csv')
+            if incremental:
+                digest = file_digest(img_file, cache_db)
+                hit = lookup(digest, params, "answers", cache_db)
+                if hit is not None and os.path.abspath(output_csv_path) == hit[0] and os.path.exists(hit[0]):
+                    continue
+                if hit is not None and hit[1]:
+                    save_answers_to_csv(hit[1], output_csv_path)
+                    extracted.append((digest, os.path.abspath(output_csv_path), hit[1]))
+                    continue
+            result = extract_answers_from_image(img_file)
+            answers, problem = result if result is not None else (None, None)
+            if problem:
+                print(f"Check {img_file}: {problem}")
             if answers:
-                rel_path = os.path.relpath(img_file, input_root)
-                csv_folder = os.path.join(csv_root, os.path.dirname(rel_path))
                 os.makedirs(csv_folder, exist_ok=True)
-                output_csv_path = os.path.join(csv_folder, os.path.splitext(os.path.basename(img_file))[0] + '.csv')
                 save_answers_to_csv(answers, output_csv_path)
                 print(f"Processed {img_file}")
+                if incremental:
+                    extracted.append((digest, os.path.abspath(output_csv_path), answers))
+    if incremental:
+        store_many(extracted, params, "answers", cache_db)
 
 if __name__ == "__main__":
-    process_all_images()
+    parser = argparse.ArgumentParser(description="Extract answers from highlighted sheets into CSVs.")
+    parser.add_argument("--input-root", default="data/output")
+    parser.add_argument("--csv-root", default="csv_output")
+    parser.add_argument("--force", action="store_true", help="re-extract images even if their CSV is up to date")
+    args = parser.parse_args()
+    process_all_images(args.input_root, args.csv_root, incremental=not args.force)
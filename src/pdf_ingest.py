@@ -0,0 +1,105 @@
+import os
+import queue
+import threading
+import numpy as np
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+PDF_DPI = int(os.environ.get("OMR_PDF_DPI", "200"))
+
+# "scan.pdf#page=3" names page 3 of scan.pdf (the PDF open-parameters fragment)
+PAGE_FRAGMENT = "#page="
+
+def is_pdf(path):
+    return path.lower().endswith(".pdf")
+
+def _open(pdf_path):
+    if pymupdf is None:
+        raise ImportError("PDF ingestion needs PyMuPDF: pip install pymupdf")
+    return pymupdf.open(pdf_path)
+
+def count_pdf_pages(pdf_path):
+    """Number of pages, read from the document's page tree without rendering anything."""
+    with _open(pdf_path) as doc:
+        return doc.page_count
+
+def _render(page, dpi):
+    # Render straight to RGB without alpha, then copy out of the pixmap buffer as BGR
+    pix = page.get_pixmap(dpi=dpi, colorspace=pymupdf.csRGB, alpha=False)
+    image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width * 3]
+    return image.reshape(pix.height, pix.width, 3)[:, :, ::-1].copy()
+
+def render_pdf_page(pdf_path, page_number, dpi=PDF_DPI):
+    """Rasterize a single page (1-based) of a PDF into a BGR image."""
+    with _open(pdf_path) as doc:
+        if not 1 <= page_number <= doc.page_count:
+            raise ValueError(f"{pdf_path} has no page {page_number} ({doc.page_count} pages)")
+        return _render(doc[page_number - 1], dpi)
+
+def pdf_page_size(pdf_path, page_number, dpi=PDF_DPI):
+    """(width, height) in pixels page_number would rasterize to at `dpi`, read without rendering."""
+    with _open(pdf_path) as doc:
+        rect = doc[page_number - 1].rect
+        return round(rect.width * dpi / 72), round(rect.height * dpi / 72)
+
+def iter_pdf_pages(pdf_path, dpi=PDF_DPI, first_page=1, last_page=None):
+    """
+    Yield (page_number, BGR image) one page at a time. Only the page being
+    yielded is rasterized, so memory stays flat however long the document is.
+    """
+    with _open(pdf_path) as doc:
+        last_page = min(last_page or doc.page_count, doc.page_count)
+        for page_number in range(first_page, last_page + 1):
+            yield page_number, _render(doc[page_number - 1], dpi)
+
+def prefetch(iterable, depth=2):
+    """
+    Iterate `iterable` on a background thread, keeping at most `depth` items
+    decoded ahead of the consumer. Lets the next pages render while the current
+    one is being evaluated; exceptions are re-raised in the consuming thread.
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    thread = threading.Thread(target=produce, name="pdf-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join(timeout=1)
+
+def page_ref(file_name, page_number):
+    return f"{file_name}{PAGE_FRAGMENT}{page_number}"
+
+def split_page_ref(file_name):
+    """'scan.pdf#page=3' -> ('scan.pdf', 3); names without a page give (file_name, None)."""
+    name, sep, page = file_name.rpartition(PAGE_FRAGMENT)
+    if sep and page.isdigit():
+        return name, int(page)
+    return file_name, None
@@ -0,0 +1,374 @@
+import os
+import time
+import argparse
+import cv2
+import numpy as np
+from extract_multiple_answers import (BUBBLE_DETECTORS, get_bubble_contours, get_bubble_components,
+                                      measure_filled_bubbles, measure_filled_labels, component_outlines,
+                                      circle_outlines, draw_full_size, list_image_tasks)
+from omr_to_csv import (bubble_centers, locate_bubbles, grid_misfit, marks_from_grid, answers_from_marks,
+                        save_answers_to_csv)
+from layout import LAYOUT_DIR, get_layout, ensure_layout, read_marks
+from confidence import AMBIGUOUS_CONFIDENCE, sample_contrast, contrast_confidence, recheck_bubbles
+from utils import run_tasks, print_batch_summary, to_working_resolution
+from profiling import SheetProfile, BatchProfile, stage, write_profile_report
+from preprocess import get_preprocessor
+from memory_budget import MEMORY_BUDGET_MB, MemoryBudget
+from pdf_ingest import PDF_DPI, is_pdf, iter_pdf_pages, render_pdf_page, prefetch, page_ref
+from result_cache import CACHE_DB_PATH, file_digest, params_digest, lookup, store_many
+from responses import store_responses, store_answers, batch_sheets
+
+# Modules whose code determines process_sheet's answers; see result_cache.params_digest
+PIPELINE_MODULES = ("pipeline", "extract_multiple_answers", "omr_to_csv", "grid", "confidence", "utils", "layout",
+                    "pdf_ingest", "preprocess")
+
+def read_sheet(image, annotated_path=None, layout=None, profile=None, detector="contours"):
+    """
+    Run preprocessing, bubble detection and mark extraction on an in-memory
+    BGR image in a single pass. The annotated image is only written when
+    annotated_path is given. With a registered `layout` (see layout.py) the sheet
+    is aligned to the template by its detected bubbles and every known bubble
+    position is sampled, found or not. Otherwise `detector` picks the bubble search:
+    "contours" (get_bubble_contours) or "components" (get_bubble_components,
+    connected-component statistics). Detection runs at the working resolution (see
+    utils.to_working_resolution) and annotations are drawn at the input's size;
+    detected bubbles are placed on the question grid by omr_to_csv.locate_bubbles.
+    Fill decisions the first pass isn't sure of get a slower second look (see
+    second_pass).
+    Per-stage timings go to `profile` (a SheetProfile) when given.
+    Returns (marks, fill, confidence, grid): a (questions, options) bool array of
+    marked bubbles, their fill ratios, how certain each decision is (0-1, see
+    confidence.py) and how the detected bubbles fitted the question grid (a dict of
+    the "off_grid" and "duplicates" bubble counts and the grid's "fit", see
+    grid.infer_grid; with a layout also the alignment "residual", see
+    layout.align_to_layout), or None if no bubbles were found.
+    """
+    # Step 0: Work at the resolution the detection thresholds are tuned for
+    with stage(profile, "normalize"):
+        working, scale = to_working_resolution(image)
+        full_gray = get_preprocessor().grayscale(image) if scale != 1.0 else None
+    return _read_working(working, scale, image.shape[:2], annotated_path, layout, profile, detector, full_gray)
+
+def _read_working(working, scale, full_shape, annotated_path=None, layout=None, profile=None, detector="contours",
+                  full_gray=None):
+    """
+    read_sheet from step 1 on; full_shape is the input's (rows, cols), used for
+    annotations. A sheet read at reduced size passes its full_gray (the input's
+    grayscale at full size) for the second pass to sample.
+    """
+    # Step 1: Brighten if extremely dark (grayscale only; colour is never needed)
+    preprocessor = get_preprocessor()
+    with stage(profile, "grayscale"):
+        gray = preprocessor.grayscale(working)
+    with stage(profile, "dark_gamma"):
+        gray = preprocessor.brighten(gray)
+
+    # Step 2: Apply local brightness/contrast adjustment
+    with stage(profile, "clahe"):
+        enhanced_image = preprocessor.equalize(gray)
+
+    if layout is not None:
+        # Step 3: Sample the template's bubble positions on the aligned sheet
+        marks, fill, confidence, centers, radius, grid = read_marks(enhanced_image, layout, profile=profile)
+        # Step 4: Second pass on the decisions the first one left open
+        second_pass(gray, marks, fill, confidence, centers.reshape(marks.shape + (2,)), radius,
+                    full_gray=full_gray, scale=scale, profile=profile)
+        if annotated_path:
+            with stage(profile, "annotate"):
+                if scale == 1.0:
+                    highlighted = cv2.cvtColor(enhanced_image, cv2.COLOR_GRAY2BGR)
+                else:
+                    highlighted = cv2.cvtColor(cv2.resize(enhanced_image, (full_shape[1], full_shape[0])),
+                                               cv2.COLOR_GRAY2BGR)
+                    centers, radius = centers / scale, radius / scale
+                for x, y in centers[marks.ravel()]:
+                    cv2.circle(highlighted, (int(round(x)), int(round(y))), int(round(radius)), (0, 255, 0), 2)
+            with stage(profile, "imwrite"):
+                os.makedirs(os.path.dirname(annotated_path), exist_ok=True)
+                cv2.imwrite(annotated_path, highlighted)
+        return marks, fill, confidence, grid
+
+    # Step 3: Detect bubbles and decide which ones are filled
+    if detector == "components":
+        labels, centers, areas = get_bubble_components(enhanced_image, profile)
+        with stage(profile, "fill_analysis"):
+            filled, fill_ratio, bubble_confidence = measure_filled_labels(enhanced_image, labels, len(centers))
+    elif detector == "contours":
+        bubbles = get_bubble_contours(enhanced_image, profile)
+        with stage(profile, "fill_analysis"):
+            filled, fill_ratio, bubble_confidence = measure_filled_bubbles(enhanced_image, bubbles)
+            areas = np.array([cv2.contourArea(c) for c in bubbles])
+    else:
+        raise ValueError(f"Unknown bubble detector {detector!r}; expected one of {BUBBLE_DETECTORS}")
+
+    result, found = None, []
+    if len(filled):
+        # Step 4: Map the detected bubbles straight to questions (no re-detection on the annotated image)
+        with stage(profile, "group_answers"):
+            if detector == "contours":
+                centers = bubble_centers(bubbles)
+            question, option, unassigned, duplicates, cells, fit = locate_bubbles(centers, enhanced_image.shape[1])
+            on_grid = question >= 0
+            marks = marks_from_grid(question, option, filled)
+            fill = marks_from_grid(question, option, fill_ratio.astype(np.float32))
+            confidence = marks_from_grid(question, option, bubble_confidence.astype(np.float32), empty=1)
+            detected = marks_from_grid(question, option, np.ones(len(centers), dtype=bool))
+            # Cells are sampled where their bubble was found, elsewhere where the grid puts them
+            positions = cells.copy()
+            positions[question[on_grid], option[on_grid]] = centers[on_grid]
+            radius = float(np.sqrt(np.median(areas) / np.pi))
+
+        # Step 5: Second pass on the decisions the first one left open
+        second_pass(gray, marks, fill, confidence, positions, radius, detected, full_gray, scale, profile)
+        filled[on_grid] = marks[question[on_grid], option[on_grid]]
+        found = circle_outlines(positions[marks & ~detected], radius)
+        result = marks, fill, confidence, {"off_grid": len(unassigned), "duplicates": len(duplicates), "fit": fit}
+
+    if annotated_path:
+        with stage(profile, "annotate"):
+            if detector == "components":
+                outlines = component_outlines(labels, filled) + found
+                highlighted = draw_full_size(full_shape, enhanced_image, outlines, [True] * len(outlines), scale)
+            else:
+                highlighted = draw_full_size(full_shape, enhanced_image, list(bubbles) + found,
+                                             list(filled) + [True] * len(found), scale)
+        with stage(profile, "imwrite"):
+            os.makedirs(os.path.dirname(annotated_path), exist_ok=True)
+            cv2.imwrite(annotated_path, highlighted)
+    return result
+
+def second_pass(gray, marks, fill, confidence, positions, radius, detected=None, full_gray=None, scale=1.0,
+                profile=None):
+    """
+    Settle what the first pass left open, updating the (questions, options) marks,
+    fill and confidence arrays in place. positions ((questions, options, 2)) and
+    radius place every cell on `gray`, the working-resolution sheet before
+    equalization. With `detected` (the cells a bubble was found on), the cells
+    detection missed are screened first, since a faint, shaded or scribbled-over
+    bubble may not survive the sheet-wide threshold: against the paper around
+    them (confidence.sample_contrast), their darkness standing in for the fill.
+    Then every decision below confidence.AMBIGUOUS_CONFIDENCE is re-checked
+    (confidence.recheck_bubbles) on full_gray when the sheet was read at reduced
+    `scale`, else on gray; clear ones are left alone.
+    """
+    with stage(profile, "recheck"):
+        if detected is not None:
+            q, o = np.nonzero(~detected & np.isfinite(positions).all(axis=2))
+            if len(q):
+                contrast = sample_contrast(gray, positions[q, o], radius)
+                marks[q, o], confidence[q, o] = contrast_confidence(contrast)
+                fill[q, o] = np.clip(contrast, 0, 1)
+        q, o = np.nonzero((confidence < AMBIGUOUS_CONFIDENCE) & np.isfinite(positions).all(axis=2))
+        if len(q):
+            if full_gray is not None:
+                # Brightened like the working copy, so the contrast test reads the same
+                gray, positions, radius = get_preprocessor().brighten(full_gray), positions / scale, radius / scale
+            marks[q, o], confidence[q, o], fill[q, o] = recheck_bubbles(gray, positions[q, o], radius)
+
+def process_sheet(image, annotated_path=None, layout=None, profile=None, detector="contours"):
+    """read_sheet returning answers_data (or None if no bubbles were found)."""
+    result = read_sheet(image, annotated_path, layout, profile, detector)
+    return answers_from_marks(result[0]) if result is not None else None
+
+def load_sheet(image_path, page=None, dpi=PDF_DPI):
+    """
+    Load a sheet as a BGR image. PDFs are rasterized one page at a time at `dpi`
+    (page is 1-based and defaults to the first page).
+    """
+    if is_pdf(image_path):
+        return render_pdf_page(image_path, page or 1, dpi)
+    image = cv2.imread(image_path)
+    if image is None:
+        raise IOError(f"Failed to load {image_path}")
+    return image
+
+def read_sheet_file(image_path, annotated_path=None, layout=None, profile=None, page=None, dpi=PDF_DPI,
+                    detector="contours"):
+    """
+    Load a sheet (an image, or one page of a PDF) from disk and run read_sheet on it.
+    The full-resolution decode is released as soon as the working-resolution copy
+    (and, for a sheet read at reduced size, its full-size grayscale) exists.
+    """
+    with stage(profile, "imread"):
+        image = load_sheet(image_path, page, dpi)
+    with stage(profile, "normalize"):
+        working, scale = to_working_resolution(image)
+        full_gray = get_preprocessor().grayscale(image) if scale != 1.0 else None
+    full_shape = image.shape[:2]
+    del image
+    return _read_working(working, scale, full_shape, annotated_path, layout, profile, detector, full_gray)
+
+def process_sheet_file(image_path, csv_path=None, annotated_path=None, layout=None, profile=None,
+                       page=None, dpi=PDF_DPI, detector="contours"):
+    """
+    Load a sheet from disk and run process_sheet on it, optionally saving the answers CSV.
+    """
+    result = read_sheet_file(image_path, annotated_path, layout, profile, page, dpi, detector)
+    answers = answers_from_marks(result[0]) if result is not None else None
+    if answers and csv_path:
+        with stage(profile, "save_csv"):
+            save_answers_to_csv(answers, csv_path)
+    return answers
+
+def _process_sheet_task(task):
+    image_path, csv_path, annotated_path, version, layout_dir, profiled, detector = task
+    layout = get_layout(version, layout_dir) if version else None
+    profile = SheetProfile(image_path) if profiled else None
+    result = read_sheet_file(image_path, annotated_path, layout, profile, detector=detector)
+    if result is None:
+        raise ValueError("no bubbles detected")
+    marks, fill, _, grid = result
+    answers = answers_from_marks(marks)
+    if csv_path:
+        with stage(profile, "save_csv"):
+            save_answers_to_csv(answers, csv_path)
+    return answers, marks, fill, grid_misfit(grid), profile.to_records() if profile else None
+
+def _batch_sheet(path, input_dir):
+    """(sheet, version) a batch run stores a sheet's response under: its relative path and set folder."""
+    return os.path.relpath(path, input_dir), os.path.basename(os.path.dirname(path))
+
+def run_pipeline(input_dir='data/input', csv_root='csv_output', annotated_dir=None, workers=1,
+                 use_layouts=False, layout_dir=LAYOUT_DIR, profile=False, incremental=True, cache_db=CACHE_DB_PATH,
+                 response_db=None, memory_mb=MEMORY_BUDGET_MB, detector="contours"):
+    """
+    Evaluate every sheet under input_dir/<set>/ and save its marks (and fill
+    ratios) to the response store in response_db (see responses.py), under its
+    path relative to input_dir and its set folder, when response_db is given.
+    A CSV per sheet is written to csv_root/<set>/<sheet>.csv unless csv_root is
+    None, and annotated images to annotated_dir/<set>/ only when it is given.
+    With use_layouts, each set folder is treated as a sheet version whose layout
+    is registered once (from the first sheet that yields a complete grid) and reused.
+    With profile=True the summary carries a BatchProfile under "profile".
+    With incremental=True sheets already evaluated by the same code (see
+    result_cache) are skipped; their cached answers fill in a missing CSV or
+    response, and they are listed under "skipped". Evaluated sheets whose bubbles
+    did not fit the question grid are listed under "review" as (sheet, reason)
+    (see omr_to_csv.grid_misfit).
+    Parallel workers only start a sheet while the estimated memory of the sheets
+    in flight stays under memory_mb (see memory_budget; 0 = half of physical memory).
+    `detector` picks the bubble search for sheets without a layout (see read_sheet).
+    """
+    params = params_digest(PIPELINE_MODULES, use_layouts=use_layouts, detector=detector) if incremental else None
+    tasks, skipped, digests, restored, restored_paths = [], [], {}, [], []
+    for image_path, csv_path in list_image_tasks(input_dir, csv_root or input_dir):
+        csv_path = os.path.splitext(csv_path)[0] + '.csv' if csv_root else None
+        annotated_path = os.path.join(annotated_dir, os.path.relpath(image_path, input_dir)) if annotated_dir else None
+        if incremental:
+            digests[image_path] = file_digest(image_path, cache_db)
+            hit = lookup(digests[image_path], params, "pipeline", cache_db)
+            if hit is not None and hit[1] and (annotated_path is None or os.path.exists(annotated_path)):
+                if csv_path and not (hit[0] == os.path.abspath(csv_path) and os.path.exists(csv_path)):
+                    save_answers_to_csv(hit[1], csv_path)
+                restored.append((digests[image_path], os.path.abspath(csv_path) if csv_path else None, hit[1]))
+                restored_paths.append(image_path)
+                skipped.append(image_path)
+                continue
+        version = os.path.basename(os.path.dirname(image_path)) if use_layouts else None
+        tasks.append((image_path, csv_path, annotated_path, version, layout_dir, profile, detector))
+
+    if use_layouts:
+        # Register layouts up front so pool workers only ever load them from disk
+        for version in sorted({task[3] for task in tasks}):
+            ensure_layout(version, [task[0] for task in tasks if task[3] == version], layout_dir)
+    summary = run_tasks(_process_sheet_task, tasks, workers, MemoryBudget(memory_mb))
+    summary["skipped"] = skipped
+    summary["review"] = [(path, result[3]) for path, result in zip(summary["processed"], summary["results"])
+                         if result[3]]
+    if incremental:
+        csv_paths = {task[0]: os.path.abspath(task[1]) if task[1] else None for task in tasks}
+        store_many(restored + [(digests[path], csv_paths[path], answers)
+                               for path, (answers, *_) in zip(summary["processed"], summary["results"])],
+                   params, "pipeline", cache_db)
+    if response_db:
+        store_responses([(None, *_batch_sheet(path, input_dir), marks, fill)
+                         for path, (_, marks, fill, _, _) in zip(summary["processed"], summary["results"])],
+                        response_db)
+        # Skipped sheets only need their cached answers where an earlier run didn't store them
+        stored = batch_sheets(response_db)
+        store_answers([(None, *_batch_sheet(path, input_dir), answers)
+                       for path, (_, _, answers) in zip(restored_paths, restored)
+                       if _batch_sheet(path, input_dir) not in stored], response_db)
+    if profile:
+        summary["profile"] = BatchProfile()
+        for *_, records in summary["results"]:
+            summary["profile"].add_records(records)
+    return summary
+
+def run_pdf(pdf_path, csv_dir=None, annotated_dir=None, dpi=PDF_DPI, layout=None, prefetch_depth=2,
+            detector="contours", response_db=None):
+    """
+    Stream a multi-page scan through the pipeline: pages are rasterized on a
+    background thread (at most prefetch_depth ahead) while earlier pages are
+    evaluated. With response_db, each page's marks and fill ratios go to the
+    response store there as "<file>#page=<n>" under the PDF's folder name, like
+    a set folder in run_pipeline; with csv_dir its answers are written to
+    csv_dir/<stem>_p<page>.csv. Returns a run_tasks-style summary, with pages whose
+    bubbles did not fit the question grid under "review" as in run_pipeline.
+    """
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    version = os.path.basename(os.path.dirname(os.path.abspath(pdf_path)))
+    processed, failed, review, responses = [], [], [], []
+    start = time.perf_counter()
+    for page_number, image in prefetch(iter_pdf_pages(pdf_path, dpi), prefetch_depth):
+        name = f"{stem}_p{page_number:03d}"
+        annotated_path = os.path.join(annotated_dir, name + ".png") if annotated_dir else None
+        try:
+            result = read_sheet(image, annotated_path, layout, detector=detector)
+            if result is None:
+                raise ValueError("no bubbles detected")
+            marks, fill, _, grid = result
+            problem = grid_misfit(grid)
+            if problem:
+                review.append((page_ref(pdf_path, page_number), problem))
+            if csv_dir:
+                save_answers_to_csv(answers_from_marks(marks), os.path.join(csv_dir, name + ".csv"))
+            responses.append((None, page_ref(os.path.basename(pdf_path), page_number), version, marks, fill))
+            processed.append(page_ref(pdf_path, page_number))
+        except Exception as e:
+            failed.append((page_ref(pdf_path, page_number), f"{type(e).__name__}: {e}"))
+    if response_db:
+        store_responses(responses, response_db)
+    elapsed = time.perf_counter() - start
+    total = len(processed) + len(failed)
+    return {"processed": processed, "failed": failed, "review": review, "results": [], "elapsed": elapsed,
+            "sheets_per_sec": total / elapsed if elapsed > 0 else 0.0}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate OMR sheets in a single in-process pass.")
+    parser.add_argument("--input-dir", default="data/input")
+    parser.add_argument("--csv-dir", default="csv_output", help="write one answers CSV per sheet here")
+    parser.add_argument("--no-csv", action="store_true", help="don't write the per-sheet CSVs")
+    parser.add_argument("--annotated-dir", default=None,
+                        help="also write annotated images here")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (0 = one per CPU core)")
+    parser.add_argument("--layouts", action="store_true",
+                        help="register one bubble layout per set folder and sample it instead of contour search")
+    parser.add_argument("--layout-dir", default=LAYOUT_DIR)
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="record per-stage timings and write them to REPORT (.json summary or .csv records)")
+    parser.add_argument("--pdf", default=None,
+                        help="evaluate every page of this multi-page scan instead of --input-dir")
+    parser.add_argument("--dpi", type=int, default=PDF_DPI, help="rasterization DPI for --pdf")
+    parser.add_argument("--force", action="store_true", help="re-evaluate sheets even if the same code evaluated them before")
+    parser.add_argument("--response-db", default=None,
+                        help="also save every sheet's marks and fill ratios to the response store in this database")
+    parser.add_argument("--memory-mb", type=int, default=MEMORY_BUDGET_MB,
+                        help="memory budget for sheets evaluated at once (0 = half of physical memory)")
+    parser.add_argument("--detector", choices=BUBBLE_DETECTORS, default="contours",
+                        help="bubble search: contour shape tests, or connected-component statistics")
+    args = parser.parse_args()
+    if args.no_csv:
+        args.csv_dir = None
+    if args.pdf:
+        print_batch_summary(run_pdf(args.pdf, args.csv_dir, args.annotated_dir, args.dpi, detector=args.detector,
+                                    response_db=args.response_db))
+        raise SystemExit
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+    summary = run_pipeline(args.input_dir, args.csv_dir, args.annotated_dir, workers,
+                           args.layouts, args.layout_dir, bool(args.profile), incremental=not args.force,
+                           response_db=args.response_db, memory_mb=args.memory_mb, detector=args.detector)
+    print_batch_summary(summary)
+    if args.profile:
+        write_profile_report(summary, args.profile)
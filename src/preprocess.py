@@ -0,0 +1,84 @@
+import threading
+import cv2
+import numpy as np
+
+# Sheets whose mean gray level is below DARK_MEAN are brightened with this gamma
+DARK_MEAN = 80
+DARK_GAMMA = 1.8
+CLAHE_CLIP_LIMIT = 3.0
+CLAHE_TILE_GRID = (8, 8)
+OPENING_KERNEL = 5
+
+_local = threading.local()
+
+def lightness_luts():
+    """
+    (gray -> L, L -> gray) lookup tables between 8-bit grayscale and 8-bit Lab
+    lightness for neutral colours. Lab L depends on luminance only, so on a
+    (nearly) black-and-white scan equalizing L and converting back to gray can be
+    done with two table lookups instead of a BGR -> Lab -> BGR round trip.
+    """
+    grays = np.repeat(np.arange(256, dtype=np.uint8)[None, :, None], 3, axis=2)
+    gray_to_l = cv2.cvtColor(grays, cv2.COLOR_BGR2LAB)[0, :, 0].copy()
+    neutral = np.full((1, 256, 3), 128, dtype=np.uint8)
+    neutral[..., 0] = np.arange(256)
+    l_to_gray = cv2.cvtColor(cv2.cvtColor(neutral, cv2.COLOR_LAB2BGR), cv2.COLOR_BGR2GRAY)[0].copy()
+    return gray_to_l, l_to_gray
+
+class Preprocessor:
+    """
+    Sheet preprocessing with everything that doesn't depend on the sheet built
+    once: the gamma table, the CLAHE instance, the opening kernel and the
+    gray <-> lightness tables. It works on the grayscale image only, since
+    detection and fill analysis never look at colour.
+
+    Intermediate images are written into buffers that are reused for the next
+    sheet of the same size, so arrays returned by one call are only valid until
+    the next call. Not thread-safe; use get_preprocessor() for one per thread.
+    """
+
+    def __init__(self, dark_mean=DARK_MEAN, gamma=DARK_GAMMA, clip_limit=CLAHE_CLIP_LIMIT,
+                 tile_grid=CLAHE_TILE_GRID, kernel_size=OPENING_KERNEL):
+        self.dark_mean = dark_mean
+        self.gamma_lut = (((np.arange(256) / 255.0) ** (1.0 / gamma)) * 255).astype(np.uint8)
+        self.clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid)
+        self.kernel = np.ones((kernel_size, kernel_size), np.uint8)
+        self.gray_to_l, self.l_to_gray = lightness_luts()
+        self._buffers = {}
+
+    def _buffer(self, name, shape):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self._buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buffer
+
+    def grayscale(self, image):
+        if image.ndim == 2:
+            return image
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._buffer("gray", image.shape[:2]))
+
+    def brighten(self, gray):
+        """Gamma-brighten a very dark sheet (mean below dark_mean); other sheets are returned as is."""
+        if cv2.mean(gray)[0] >= self.dark_mean:
+            return gray
+        return cv2.LUT(gray, self.gamma_lut, dst=self._buffer("bright", gray.shape))
+
+    def equalize(self, gray, name="equalized"):
+        """Local contrast equalization (CLAHE) of the sheet's lightness, returned as grayscale."""
+        lightness = cv2.LUT(gray, self.gray_to_l, dst=self._buffer("lightness", gray.shape))
+        lightness = self.clahe.apply(lightness, dst=self._buffer("clahe", gray.shape))
+        return cv2.LUT(lightness, self.l_to_gray, dst=self._buffer(name, gray.shape))
+
+    def enhance(self, image):
+        """grayscale -> brighten -> equalize: the enhanced gray sheet bubble detection runs on."""
+        return self.equalize(self.brighten(self.grayscale(image)))
+
+    def open(self, binary):
+        return cv2.morphologyEx(binary, cv2.MORPH_OPEN, self.kernel, dst=self._buffer("opening", binary.shape))
+
+def get_preprocessor():
+    """This thread's Preprocessor, created on first use."""
+    preprocessor = getattr(_local, "preprocessor", None)
+    if preprocessor is None:
+        preprocessor = _local.preprocessor = Preprocessor()
+    return preprocessor
@@ -0,0 +1,152 @@
+import os
+import csv
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss_mb():
+    """Resident set size of this process in MB (peak RSS where the current value isn't available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    return peak / 2**20 if peak > 2**32 else peak / 1024
+
+class SheetProfile:
+    """Wall time and RSS of each pipeline stage for one sheet."""
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.stages = []  # (stage, seconds, rss_mb, rss_delta_mb)
+
+    @contextmanager
+    def stage(self, name):
+        rss_before = current_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            rss_after = current_rss_mb()
+            self.stages.append((name, elapsed, rss_after, rss_after - rss_before))
+
+    def total_seconds(self):
+        return sum(seconds for _, seconds, _, _ in self.stages)
+
+    def to_records(self):
+        return [{"sheet": self.sheet, "stage": name, "seconds": seconds, "rss_mb": rss, "rss_delta_mb": delta}
+                for name, seconds, rss, delta in self.stages]
+
+@contextmanager
+def _no_stage():
+    yield
+
+def stage(profile, name):
+    """`with stage(profile, "otsu"):` times the block when profile is a SheetProfile, else does nothing."""
+    return profile.stage(name) if profile is not None else _no_stage()
+
+class BatchProfile:
+    """
+    Aggregates SheetProfiles across a batch (thread-safe). With max_sheets only
+    the most recent sheets are kept, which is how the app keeps a rolling window.
+    """
+
+    def __init__(self, max_sheets=None):
+        self._records = deque()
+        self._sheets = deque()
+        self._max_sheets = max_sheets
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        self.add_records(profile.to_records())
+
+    def add_records(self, records):
+        if not records:
+            return
+        with self._lock:
+            self._sheets.append(len(records))
+            self._records.extend(records)
+            while self._max_sheets and len(self._sheets) > self._max_sheets:
+                for _ in range(self._sheets.popleft()):
+                    self._records.popleft()
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def __len__(self):
+        return len(self._sheets)
+
+    def summary(self):
+        """
+        Per-stage percentiles: {stage: {"count", "mean_ms", "p50_ms", "p90_ms", "p99_ms",
+        "max_ms", "total_s", "share", "max_rss_mb", "max_rss_delta_mb"}}, ordered by first appearance.
+        """
+        by_stage = {}
+        for record in self.records():
+            by_stage.setdefault(record["stage"], []).append(record)
+        grand_total = sum(r["seconds"] for records in by_stage.values() for r in records) or 1.0
+        summary = {}
+        for name, records in by_stage.items():
+            seconds = np.array([r["seconds"] for r in records])
+            p50, p90, p99 = np.percentile(seconds, [50, 90, 99]) * 1000
+            summary[name] = {
+                "count": len(seconds),
+                "mean_ms": float(seconds.mean() * 1000),
+                "p50_ms": float(p50),
+                "p90_ms": float(p90),
+                "p99_ms": float(p99),
+                "max_ms": float(seconds.max() * 1000),
+                "total_s": float(seconds.sum()),
+                "share": float(seconds.sum() / grand_total),
+                "max_rss_mb": float(max(r["rss_mb"] for r in records)),
+                "max_rss_delta_mb": float(max(r["rss_delta_mb"] for r in records)),
+            }
+        return summary
+
+    def to_json(self, path, extra=None):
+        report = {"sheets": len(self), "peak_rss_mb": peak_rss_mb(), "stages": self.summary()}
+        report.update(extra or {})
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    def to_csv(self, path):
+        """Write the raw per-sheet, per-stage records."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["sheet", "stage", "seconds", "rss_mb", "rss_delta_mb"])
+            writer.writeheader()
+            writer.writerows(self.records())
+
+def print_profile(summary):
+    print(f"{'stage':<24}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'share':>8}{'rss MB':>9}")
+    for name, s in summary.items():
+        print(f"{name:<24}{s['count']:>7}{s['p50_ms']:>10.1f}{s['p90_ms']:>10.1f}{s['p99_ms']:>10.1f}"
+              f"{s['max_ms']:>10.1f}{s['share']:>8.1%}{s['max_rss_mb']:>9.0f}")
+
+def write_profile_report(summary, path):
+    """Print the stage table and save it as JSON (summary) or CSV (raw records) depending on path."""
+    print_profile(summary["profile"].summary())
+    if path.endswith(".csv"):
+        summary["profile"].to_csv(path)
+    else:
+        summary["profile"].to_json(path, extra={"sheets_per_sec": summary["sheets_per_sec"]})
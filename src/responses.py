@@ -0,0 +1,166 @@
+import datetime
+import numpy as np
+from db import DB_PATH, get_connection
+from omr_to_csv import options, answers_to_marks
+
+_initialized = set()
+# Ids bound per "IN (...)" query, below SQLite's historical limit of 999 host parameters
+IN_BATCH = 900
+
+def init_responses(db_path=DB_PATH):
+    """
+    Create the sheet_responses store if it doesn't exist.
+
+    Each row holds one sheet's (questions, options) marks bit-packed into a BLOB
+    (50 bytes for 100 questions) and the fill ratio of every bubble as one byte
+    (0-255), next to the result it belongs to or, for batch runs, the sheet name.
+    Results rows written with the old text "responses" column are moved over.
+    """
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS sheet_responses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            result_id INTEGER UNIQUE,
+            sheet TEXT,
+            version TEXT,
+            questions INTEGER,
+            marks BLOB,
+            fill BLOB,
+            created_at TEXT
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sheet_responses_version ON sheet_responses(version)")
+        # Batch runs store by sheet name; re-running a batch replaces its rows
+        conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_sheet_responses_sheet
+        ON sheet_responses(sheet, version) WHERE result_id IS NULL
+        """)
+    _migrate_text_responses(conn)
+    _initialized.add(db_path)
+    return conn
+
+def _migrate_text_responses(conn):
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    if "results" not in tables:
+        return
+    if "responses" not in {row[1] for row in conn.execute("PRAGMA table_info(results)")}:
+        return
+    rows = conn.execute("SELECT id, file_name, version, responses FROM results WHERE responses IS NOT NULL").fetchall()
+    if not rows:
+        return
+    entries = []
+    for result_id, file_name, version, text in rows:
+        marks = np.array([[opt in field.split(",") for opt in options] for field in text.split("|")], dtype=bool)
+        entries.append((result_id, file_name, version, marks, None))
+    with conn:
+        _insert(conn, entries)
+        conn.execute("UPDATE results SET responses = NULL WHERE responses IS NOT NULL")
+
+def _conn(db_path):
+    return get_connection(db_path) if db_path in _initialized else init_responses(db_path)
+
+def pack_marks(marks):
+    return np.packbits(np.asarray(marks, dtype=bool).ravel()).tobytes()
+
+def unpack_marks(blob, questions):
+    bits = np.unpackbits(np.frombuffer(blob, dtype=np.uint8))[:questions * len(options)]
+    return bits.astype(bool).reshape(questions, len(options))
+
+def pack_fill(fill):
+    return np.round(np.clip(fill, 0, 1) * 255).astype(np.uint8).tobytes()
+
+def unpack_fill(blob, questions):
+    return np.frombuffer(blob, dtype=np.uint8).reshape(questions, len(options)) / np.float32(255)
+
+def _insert(conn, entries):
+    now = datetime.datetime.now().isoformat()
+    conn.executemany("""
+        INSERT OR REPLACE INTO sheet_responses (result_id, sheet, version, questions, marks, fill, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(result_id, sheet, None if version is None else str(version), len(marks), pack_marks(marks),
+           None if fill is None else pack_fill(fill), now)
+          for result_id, sheet, version, marks, fill in entries])
+
+def store_responses(entries, db_path=DB_PATH):
+    """
+    Save (result_id or None, sheet, version, marks, fill or None) entries in one
+    transaction; marks is a (questions, options) bool array, fill the matching
+    fill ratios in [0, 1].
+    """
+    conn = _conn(db_path)
+    with conn:
+        _insert(conn, entries)
+
+def store_answers(entries, db_path=DB_PATH):
+    """store_responses for (result_id, sheet, version, answers_data) entries, with no fill data."""
+    store_responses([(result_id, sheet, version, answers_to_marks(answers), None)
+                     for result_id, sheet, version, answers in entries], db_path)
+
+def batch_sheets(db_path=DB_PATH):
+    """{(sheet, version)} of the responses stored by batch runs."""
+    return set(_conn(db_path).execute("SELECT sheet, version FROM sheet_responses WHERE result_id IS NULL").fetchall())
+
+def count_responses(version=None, db_path=DB_PATH):
+    if version is None:
+        return _conn(db_path).execute("SELECT COUNT(*) FROM sheet_responses").fetchone()[0]
+    return _conn(db_path).execute("SELECT COUNT(*) FROM sheet_responses WHERE version = ?",
+                                  (str(version),)).fetchone()[0]
+
+def load_responses(version=None, result_ids=None, with_fill=False, after_id=None, db_path=DB_PATH):
+    """
+    Read stored responses as arrays for item analysis and regrading.
+
+    Filters by answer-key version and/or a list of result ids; after_id only
+    returns rows stored after the one with that id, for incremental readers. Returns
+    {"id": (N,) store row ids, "result_id": (N,) array (-1 for batch rows), "sheet": [N names],
+     "marks": (N, questions, options) bool, "fill": (N, questions, options) float32
+     with NaN where no fill data was stored (only when with_fill)}.
+    Sheets with fewer questions than the longest are padded with unmarked rows.
+    """
+    clauses, params = [], []
+    if version is not None:
+        clauses.append("version = ?")
+        params.append(str(version))
+    if after_id is not None:
+        clauses.append("id > ?")
+        params.append(int(after_id))
+    columns = "result_id, sheet, questions, marks, id" + (", fill" if with_fill else "")
+    conn = _conn(db_path)
+    if result_ids is None:
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = conn.execute(f"SELECT {columns} FROM sheet_responses {where} ORDER BY id", params).fetchall()
+    else:
+        # Only the requested ids, looked up on the result_id index a batch at a time
+        result_ids = sorted({int(i) for i in result_ids})
+        rows = []
+        for start in range(0, len(result_ids), IN_BATCH):
+            batch = result_ids[start:start + IN_BATCH]
+            where = " AND ".join(clauses + [f"result_id IN ({', '.join('?' * len(batch))})"])
+            rows += conn.execute(f"SELECT {columns} FROM sheet_responses WHERE {where}", params + batch).fetchall()
+        rows.sort(key=lambda row: row[4])
+
+    n_questions = max((row[2] for row in rows), default=0)
+    marks = np.zeros((len(rows), n_questions, len(options)), dtype=bool)
+    fill = np.full(marks.shape, np.nan, dtype=np.float32) if with_fill else None
+    if rows and all(row[2] == n_questions for row in rows):
+        # Usual case, one sheet layout: unpack every sheet's bits in a single call
+        packed = np.frombuffer(b"".join(row[3] for row in rows), dtype=np.uint8).reshape(len(rows), -1)
+        bits = np.unpackbits(packed, axis=1)[:, :n_questions * len(options)]
+        marks[:] = bits.astype(bool).reshape(marks.shape)
+    else:
+        for i, row in enumerate(rows):
+            marks[i, :row[2]] = unpack_marks(row[3], row[2])
+    if with_fill:
+        for i, row in enumerate(rows):
+            if row[5] is not None:
+                fill[i, :row[2]] = unpack_fill(row[5], row[2])
+    data = {
+        "id": np.array([row[4] for row in rows], dtype=np.int64),
+        "result_id": np.array([-1 if row[0] is None else row[0] for row in rows], dtype=np.int64),
+        "sheet": [row[1] for row in rows],
+        "marks": marks,
+    }
+    if with_fill:
+        data["fill"] = fill
+    return data
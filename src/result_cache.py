@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import datetime
+from functools import lru_cache
+from db import get_connection
+
+# The cache lives in its own untracked database (override with OMR_CACHE_DB), apart from the results
+CACHE_DB_PATH = os.environ.get("OMR_CACHE_DB", "omr_cache.db")
+
+_initialized = set()
+
+def init_cache(db_path=CACHE_DB_PATH):
+    """
+    Create the sheet_cache manifest and the file_hashes memo if they don't exist.
+
+    sheet_cache maps (content hash, parameter hash, stage) to the output written
+    for it and the extracted answers; file_hashes remembers the content hash of a
+    path for as long as its size and mtime are unchanged, so unchanged archives
+    are not re-read on every run.
+    """
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS sheet_cache (
+            content_hash TEXT,
+            params_hash TEXT,
+            stage TEXT,
+            output_path TEXT,
+            answers TEXT,
+            created_at TEXT,
+            PRIMARY KEY (content_hash, params_hash, stage)
+        )
+        """)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS file_hashes (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            content_hash TEXT
+        )
+        """)
+    _initialized.add(db_path)
+    return conn
+
+def _conn(db_path):
+    return get_connection(db_path) if db_path in _initialized else init_cache(db_path)
+
+def content_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_digest(path, db_path=CACHE_DB_PATH):
+    """SHA-256 of a file's bytes, reused from file_hashes while size and mtime are unchanged."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    conn = _conn(db_path)
+    row = conn.execute("SELECT size, mtime_ns, content_hash FROM file_hashes WHERE path=?", (path,)).fetchone()
+    if row is not None and (row[0], row[1]) == (stat.st_size, stat.st_mtime_ns):
+        return row[2]
+    content_hash = content_digest(path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+                     (path, stat.st_size, stat.st_mtime_ns, content_hash))
+    return content_hash
+
+@lru_cache(maxsize=None)
+def params_digest(module_names, **params):
+    """
+    Hash of everything that determines a stage's output: the source of the modules
+    that produce it (a tuple of names) plus explicit parameters (DPI, layout use,
+    ...). Editing a threshold in any of those modules therefore invalidates the
+    cached results. Memoized: the source read is what this process runs.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(module_names):
+        module = sys.modules.get(name) or __import__(name)
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def lookup(content_hash, params_hash, stage, db_path=CACHE_DB_PATH):
+    """Return (output_path, answers_data or None) cached for this sheet and stage, or None."""
+    row = _conn(db_path).execute(
+        "SELECT output_path, answers FROM sheet_cache WHERE content_hash=? AND params_hash=? AND stage=?",
+        (content_hash, params_hash, stage)).fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1]) if row[1] else None
+
+def store(content_hash, params_hash, stage, output_path=None, answers=None, db_path=CACHE_DB_PATH):
+    store_many([(content_hash, output_path, answers)], params_hash, stage, db_path)
+
+def store_many(entries, params_hash, stage, db_path=CACHE_DB_PATH):
+    """Record (content_hash, output_path, answers_data) entries for a stage in one transaction."""
+    now = datetime.datetime.now().isoformat()
+    conn = _conn(db_path)
+    with conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO sheet_cache (content_hash, params_hash, stage, output_path, answers, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(content_hash, params_hash, stage, output_path, json.dumps(answers) if answers else None, now)
+              for content_hash, output_path, answers in entries])
+
+def restore_output(hit, output_path):
+    """
+    True when a cached output can stand in for output_path: it is output_path
+    itself, or an identical sheet's output elsewhere, which is copied over.
+    """
+    if hit is None or not hit[0] or not os.path.exists(hit[0]):
+        return False
+    if os.path.abspath(output_path) != os.path.abspath(hit[0]):
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        shutil.copyfile(hit[0], output_path)
+    return True
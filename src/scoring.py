@@ -0,0 +1,93 @@
+import os
+import glob
+import time
+import argparse
+import numpy as np
+from omr_to_csv import subjects, options, answers_to_marks, load_answers_csv
+from answer_key import AnswerKey, parse_answer_key
+from responses import load_responses
+from db import DB_PATH
+
+def stack_marks(marks_list, n_questions):
+    """Stack per-sheet (questions, options) bool arrays into one (N, n_questions, options) array."""
+    batch = np.zeros((len(marks_list), n_questions, len(options)), dtype=bool)
+    for i, marks in enumerate(marks_list):
+        q = min(n_questions, marks.shape[0])
+        batch[i, :q] = marks[:q]
+    return batch
+
+def score_batch(marks, answer_key):
+    """
+    Score a whole batch at once.
+
+    marks: (N sheets, Q questions, options) bool array of marked bubbles.
+    answer_key: AnswerKey; a question is correct when the marked options exactly
+    match the key's option set. Returns arrays:
+      correct (N, Q) bool, subject_scores (N, subjects), total (N,),
+      multi_marked (N,) questions with more than one option marked,
+      blank (N,) keyed questions left empty.
+    """
+    n_questions = answer_key.mask.shape[0]
+    if marks.shape[1] != n_questions:
+        marks = stack_marks(list(marks), n_questions)
+
+    correct = answer_key.keyed & (marks == answer_key.mask).all(axis=2)
+    starts = [start for start, _ in answer_key.subject_ranges]
+    subject_scores = np.add.reduceat(correct, starts, axis=1) if len(correct) else \
+        np.zeros((0, len(starts)), dtype=int)
+    n_marked = marks.sum(axis=2)
+    return {
+        "correct": correct,
+        "subject_scores": subject_scores,
+        "total": correct.sum(axis=1),
+        "multi_marked": (n_marked > 1).sum(axis=1),
+        "blank": ((n_marked == 0) & answer_key.keyed).sum(axis=1),
+    }
+
+def score_sheet(marks, answer_key):
+    """score_batch for one sheet, shaped like the app's result columns."""
+    scores = score_batch(marks[None], answer_key)
+    result = {f"Subject {i + 1}": int(score) for i, score in enumerate(scores["subject_scores"][0])}
+    result.update({
+        "Total Score": int(scores["total"][0]),
+        "Multi Marked": int(scores["multi_marked"][0]),
+        "Blank": int(scores["blank"][0]),
+    })
+    return result
+
+def regrade_csv_folder(key_path, csv_dir):
+    """Re-score every answers CSV in csv_dir against key_path; returns (file names, scores, seconds)."""
+    answer_key = AnswerKey(parse_answer_key(key_path))
+    csv_files = sorted(glob.glob(os.path.join(csv_dir, '*.csv')))
+    marks = stack_marks([answers_to_marks(load_answers_csv(f)) for f in csv_files], answer_key.mask.shape[0])
+    start = time.perf_counter()
+    scores = score_batch(marks, answer_key)
+    return [os.path.basename(f) for f in csv_files], scores, time.perf_counter() - start
+
+def regrade_response_store(key_path, version, db_path=DB_PATH):
+    """Re-score every sheet of `version` in the response store against key_path; like regrade_csv_folder."""
+    answer_key = AnswerKey(parse_answer_key(key_path))
+    stored = load_responses(version, db_path=db_path)
+    start = time.perf_counter()
+    scores = score_batch(stored["marks"], answer_key)
+    return stored["sheet"], scores, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-grade extracted answer CSVs against an answer key.")
+    parser.add_argument("key", help="answer key file, e.g. data/input/keys/setA.csv")
+    parser.add_argument("csv_dir", nargs="?", help="folder of answer CSVs, e.g. csv_output/setA")
+    parser.add_argument("--version", help="re-grade this version from the response store instead of CSVs")
+    parser.add_argument("--db", default=DB_PATH, help="database holding the response store")
+    args = parser.parse_args()
+    if args.version:
+        names, scores, elapsed = regrade_response_store(args.key, args.version, args.db)
+    elif args.csv_dir:
+        names, scores, elapsed = regrade_csv_folder(args.key, args.csv_dir)
+    else:
+        parser.error("give a CSV folder or --version")
+    print("sheet," + ",".join(subjects) + ",total,multi_marked,blank")
+    for i, name in enumerate(names):
+        print(",".join([name] + [str(v) for v in scores["subject_scores"][i]] +
+                       [str(scores["total"][i]), str(scores["multi_marked"][i]), str(scores["blank"][i])]))
+    rate = len(names) / elapsed if elapsed > 0 else float('inf')
+    print(f"Scored {len(names)} sheets in {elapsed * 1000:.2f} ms ({rate:.0f} sheets/sec)")
@@ -0,0 +1,93 @@
+import os
+import hashlib
+import threading
+import cv2
+from pdf_ingest import is_pdf, render_pdf_page
+from pipeline import process_sheet_file
+
+THUMB_DIR = os.path.join("uploads", "previews")
+THUMB_WIDTH = 480
+# Total size of cached previews; least recently viewed files are removed past it
+PREVIEW_CACHE_MB = int(os.environ.get("OMR_PREVIEW_CACHE_MB", "512"))
+
+_evict_lock = threading.Lock()
+
+def _preview_path(file_path, page, kind, cache_dir):
+    # The source's mtime is part of the key so a replaced upload never shows a stale preview
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}|{page or 1}|{kind}|{stat.st_mtime_ns}|{stat.st_size}"
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".jpg")
+
+def _hit(path):
+    if os.path.exists(path):
+        os.utime(path)  # mtime doubles as last-access time for LRU eviction
+        return True
+    return False
+
+def _load(file_path, page, width):
+    if is_pdf(file_path):
+        # 72 dpi is roughly 600 px across an A4 page; plenty for a thumbnail
+        return render_pdf_page(file_path, page or 1, dpi=72 if width <= 600 else 200)
+    image = cv2.imread(file_path)
+    if image is None:
+        raise IOError(f"Failed to load {file_path}")
+    return image
+
+def _save(path, image, width):
+    if image.shape[1] > width:
+        image = cv2.resize(image, (width, round(image.shape[0] * width / image.shape[1])),
+                           interpolation=cv2.INTER_AREA)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ok, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    if not ok:
+        raise IOError(f"Failed to encode preview {path}")
+    # ".tmp", not ".jpg": eviction only scans finished previews
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data.tobytes())
+    os.replace(tmp_path, path)
+    evict_previews(os.path.dirname(path))
+
+def get_thumbnail(file_path, page=None, width=THUMB_WIDTH, cache_dir=THUMB_DIR):
+    """Path of a small JPEG preview of the sheet (one PDF page), generated on first use."""
+    path = _preview_path(file_path, page, f"thumb{width}", cache_dir)
+    if not _hit(path):
+        _save(path, _load(file_path, page, width), width)
+    return path
+
+def get_overlay(file_path, page=None, width=1400, cache_dir=THUMB_DIR):
+    """
+    Path of a larger preview with the detected marks outlined, produced by
+    re-running the pipeline on demand (only when a reviewer asks for it).
+    """
+    path = _preview_path(file_path, page, f"overlay{width}", cache_dir)
+    if not _hit(path):
+        annotated_path = path + ".full.png"
+        try:
+            process_sheet_file(file_path, annotated_path=annotated_path, page=page)
+            image = cv2.imread(annotated_path)
+        finally:
+            if os.path.exists(annotated_path):
+                os.remove(annotated_path)
+        if image is None:
+            raise ValueError("No bubbles detected on sheet.")
+        _save(path, image, width)
+    return path
+
+def evict_previews(cache_dir=THUMB_DIR, max_mb=PREVIEW_CACHE_MB):
+    """Delete the least recently used previews until the cache fits in max_mb."""
+    with _evict_lock:
+        try:
+            entries = [e for e in os.scandir(cache_dir) if e.is_file() and e.name.endswith(".jpg")]
+        except FileNotFoundError:
+            return
+        stats = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= max_mb * 2**20:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,4 +1,15 @@
 import cv2
+import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+# Bubble detection thresholds (contour areas 120-2500 px, 5x5 opening, ...) are tuned
+# for sheets about this wide; larger or smaller scans are resized to it first.
+WORK_WIDTH = 1000
+# Sheets already within this factor of WORK_WIDTH are processed at native size
+WORK_SCALE_TOLERANCE = 1.4
 
 def sort_contours(cnts, method="left-to-right"):
     reverse = False
@@ -12,3 +23,206 @@ def sort_contours(cnts, method="left-to-right"):
     cnts, bounding_boxes = zip(*sorted(zip(cnts, bounding_boxes),
                                        key=lambda b: b[1][axis], reverse=reverse))
     return list(cnts)
+
+def label_contours(shape, contours):
+    """
+    Paint every contour (filled) into one int32 label image: bubble i gets label i + 1,
+    background stays 0.
+    """
+    labels = np.zeros(shape[:2], dtype=np.int32)
+    for i, c in enumerate(contours):
+        cv2.drawContours(labels, [c], -1, i + 1, -1)
+    return labels
+
+def label_fill_stats(gray, labels, count, dark_threshold):
+    """
+    Mean intensity and fill ratio (share of pixels <= dark_threshold) of labels 1..count,
+    computed for all bubbles at once from a single pass over the labelled pixels.
+    Returns two float arrays of length count.
+    """
+    flat_labels = labels.ravel()
+    idx = np.flatnonzero(flat_labels != 0)
+    lab = flat_labels[idx]
+    values = gray.ravel()[idx]
+    totals = np.bincount(lab, minlength=count + 1)[1:count + 1]
+    sums = np.bincount(lab, weights=values, minlength=count + 1)[1:count + 1]
+    dark = np.bincount(lab, weights=values <= dark_threshold, minlength=count + 1)[1:count + 1]
+    safe_totals = np.maximum(totals, 1)
+    return sums / safe_totals, np.where(totals > 0, dark / safe_totals, 0.0)
+
+def component_shapes(labels, stats, components):
+    """
+    Shape of the given components of a cv2.connectedComponentsWithStats label image,
+    each measured within its own bounding box. Returns (ellipse_fill, elongation):
+    each component's area over that of the ellipse with the same second moments (near
+    1 for discs and ellipses, lower for ragged or concave shapes) and the ratio of
+    that ellipse's axes (1 for a disc).
+    """
+    ellipse_fill = np.zeros(len(components))
+    elongation = np.zeros(len(components))
+    for i, label in enumerate(components):
+        x, y, w, h = stats[label, :4]
+        m = cv2.moments((labels[y:y + h, x:x + w] == label).view(np.uint8), binaryImage=True)
+        # Second central moments, plus 1/12 for the spread of each unit pixel
+        var_x = m["mu20"] / m["m00"] + 1 / 12
+        var_y = m["mu02"] / m["m00"] + 1 / 12
+        cov = m["mu11"] / m["m00"]
+        det = max(var_x * var_y - cov ** 2, 1e-12)
+        half_trace = (var_x + var_y) / 2
+        spread = np.sqrt(max(half_trace ** 2 - det, 0))
+        elongation[i] = np.sqrt((half_trace + spread) / max(half_trace - spread, 1e-12))
+        ellipse_fill[i] = m["m00"] / (4 * np.pi * np.sqrt(det))
+    return ellipse_fill, elongation
+
+def relabel_components(labels, stats, components):
+    """
+    A label image holding only the given components of a cv2.connectedComponentsWithStats
+    label image, numbered 1..n in order; painted within their bounding boxes.
+    """
+    relabelled = np.zeros(labels.shape, dtype=np.int32)
+    for i, label in enumerate(components):
+        x, y, w, h = stats[label, :4]
+        box = relabelled[y:y + h, x:x + w]
+        box[labels[y:y + h, x:x + w] == label] = i + 1
+    return relabelled
+
+def bubble_fill_stats(gray, contours, dark_threshold):
+    """label_fill_stats for a list of bubble contours; see label_contours."""
+    labels = label_contours(gray.shape, contours)
+    return label_fill_stats(gray, labels, len(contours), dark_threshold)
+
+def fill_holes(binary):
+    """
+    The binary image with every hole filled in: what drawing each
+    findContours(RETR_EXTERNAL) contour filled would give, in one flood fill
+    of the background from the image border.
+    """
+    outside = cv2.copyMakeBorder(binary, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    cv2.floodFill(outside, None, (0, 0), 255)
+    return cv2.bitwise_or(binary, cv2.bitwise_not(outside[1:-1, 1:-1]))
+
+def detect_page_width(gray):
+    """
+    Width in pixels of the paper in the photo: the bounding box of the largest
+    bright region when it covers a good part of the frame, else the image width.
+    """
+    h, w = gray.shape[:2]
+    step = max(1, w // 500)
+    small = gray[::step, ::step]
+    _, paper = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(paper, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if contours:
+        largest = max(contours, key=cv2.contourArea)
+        if cv2.contourArea(largest) > 0.3 * small.shape[0] * small.shape[1]:
+            return min(w, cv2.boundingRect(largest)[2] * step)
+    return w
+
+def working_scale(image):
+    """Resize factor that brings the sheet's page width to WORK_WIDTH (1.0 when already close)."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    scale = WORK_WIDTH / detect_page_width(gray)
+    if 1 / WORK_SCALE_TOLERANCE <= scale <= WORK_SCALE_TOLERANCE:
+        return 1.0
+    return scale
+
+def to_working_resolution(image):
+    """Return (image at working resolution, scale); full-size coordinates = working / scale."""
+    scale = working_scale(image)
+    if scale == 1.0:
+        return image, scale
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=interpolation), scale
+
+def scale_contours(contours, factor):
+    """Map contours between working and full resolution (factor = 1 / scale to go back to full size)."""
+    if factor == 1.0:
+        return list(contours)
+    return [np.round(c * factor).astype(np.int32) for c in contours]
+
+def _init_worker():
+    # Each process already owns a core; stop OpenCV from spawning its own threads on top.
+    cv2.setNumThreads(1)
+
+def _run_task(func, task):
+    try:
+        value = func(task)
+    except Exception as e:
+        return task[0], f"{type(e).__name__}: {e}", None
+    return task[0], None, value
+
+def _run_budgeted(executor, runner, tasks, workers, budget):
+    # Submit one sheet at a time, each once its estimated memory fits in the budget
+    # and a worker is free; finished sheets hand their share back from the done callback.
+    # A worker that dies (e.g. killed for running out of memory) breaks the pool: its
+    # sheet, and every sheet that can no longer be submitted, is recorded as failed.
+    outcomes = [None] * len(tasks)
+    pending = {}
+
+    def collect(futures):
+        for future in futures:
+            i = pending.pop(future)
+            try:
+                outcomes[i] = future.result()
+            except Exception as e:
+                outcomes[i] = (tasks[i][0], f"{type(e).__name__}: {e}", None)
+
+    for i, task in enumerate(tasks):
+        cost = budget.cost(task[0])
+        while len(pending) >= workers:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        budget.acquire(cost)
+        try:
+            future = executor.submit(runner, task)
+        except BrokenProcessPool as e:
+            budget.release(cost)
+            outcomes[i] = (task[0], f"{type(e).__name__}: {e}", None)
+            continue
+        future.add_done_callback(lambda _, cost=cost: budget.release(cost))
+        pending[future] = i
+    collect(wait(pending).done)
+    return outcomes
+
+def run_tasks(func, tasks, workers=1, budget=None):
+    """
+    Run func(task) for every task, optionally over a process pool, and summarise.
+
+    `func` must be a module-level function and each task a tuple whose first
+    element identifies the sheet. Results keep the order of `tasks` and
+    exceptions are collected rather than printed:
+    {"processed": [...], "failed": [(sheet, error), ...], "results": [return values of processed],
+     "elapsed": s, "sheets_per_sec": x}
+    With a memory_budget.MemoryBudget, the first element must be the sheet's path and
+    sheets only start while their estimated memory fits in the budget.
+    """
+    runner = partial(_run_task, func)
+    start = time.perf_counter()
+    if workers > 1 and len(tasks) > 1:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            if budget is not None:
+                outcomes = _run_budgeted(executor, runner, tasks, workers, budget)
+            else:
+                outcomes = list(executor.map(runner, tasks, chunksize=chunksize))
+    else:
+        outcomes = [runner(task) for task in tasks]
+    elapsed = time.perf_counter() - start
+
+    return {
+        "processed": [sheet for sheet, error, _ in outcomes if error is None],
+        "failed": [(sheet, error) for sheet, error, _ in outcomes if error is not None],
+        "results": [value for _, error, value in outcomes if error is None],
+        "elapsed": elapsed,
+        "sheets_per_sec": len(outcomes) / elapsed if elapsed > 0 else 0.0,
+    }
+
+def print_batch_summary(summary):
+    total = len(summary["processed"]) + len(summary["failed"])
+    print(f"Processed {len(summary['processed'])}/{total} sheets in {summary['elapsed']:.2f}s "
+          f"({summary['sheets_per_sec']:.1f} sheets/sec)")
+    if summary.get("skipped"):
+        print(f"Skipped {len(summary['skipped'])} sheets that were already up to date")
+    for sheet, error in summary["failed"]:
+        print(f"  FAILED {sheet}: {error}")
+    for sheet, reason in summary.get("review", []):
+        print(f"  REVIEW {sheet}: {reason}")
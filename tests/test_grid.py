@@ -0,0 +1,107 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from omr_to_csv import subjects, questions_per_subject, options, locate_bubbles, grid_misfit
+from pipeline import read_sheet, read_sheet_file
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INPUT_DIR = os.path.join(ROOT, "data", "input")
+
+# Spacing of the printed sheet at working size, in pixels
+PITCH = 26                 # between options and between question rows
+BLOCK_PITCH = 6 * PITCH    # between subject blocks
+GROUP_GAP = PITCH          # extra space after every block of 5 rows
+ORIGIN = (100, 220)
+WIDTH = 1000
+
+def sheet_centers(angle=0.0):
+    """
+    Centers of every bubble on an ideal sheet, turned `angle` degrees about the
+    grid's middle; returns (centers, question, option) in question-major order.
+    """
+    question, option = np.divmod(np.arange(len(subjects) * questions_per_subject * len(options)), len(options))
+    block, row = np.divmod(question, questions_per_subject)
+    x = ORIGIN[0] + block * BLOCK_PITCH + option * PITCH
+    y = ORIGIN[1] + row * PITCH + (row // 5) * GROUP_GAP
+    centers = np.column_stack([x, y]).astype(float)
+    middle = centers.mean(axis=0)
+    t = np.radians(angle)
+    rotation = np.array([[np.cos(t), -np.sin(t)], [np.sin(t), np.cos(t)]])
+    return (centers - middle) @ rotation.T + middle, question, option
+
+def grid_of(centers):
+    question, option, unassigned, duplicates, cells, fit = locate_bubbles(centers, WIDTH)
+    return {"off_grid": len(unassigned), "duplicates": len(duplicates), "fit": fit}
+
+def test_full_sheet_fits():
+    centers, question, option = sheet_centers()
+    found_question, found_option, unassigned, duplicates, _, fit = locate_bubbles(centers, WIDTH)
+    assert np.array_equal(found_question, question)
+    assert np.array_equal(found_option, option)
+    assert len(unassigned) == 0 and len(duplicates) == 0
+    assert fit == 1.0
+    assert grid_misfit(grid_of(centers)) is None
+
+def test_rotated_sheet_fits():
+    centers, question, option = sheet_centers(angle=3)
+    found_question, found_option, unassigned, _, _, fit = locate_bubbles(centers, WIDTH)
+    assert np.array_equal(found_question, question)
+    assert np.array_equal(found_option, option)
+    assert len(unassigned) == 0
+    assert fit >= 0.75
+
+def test_missing_bubble_is_placed_from_the_grid():
+    centers, question, option = sheet_centers()
+    missing = 37 * len(options) + 2
+    kept = np.delete(np.arange(len(centers)), missing)
+    found_question, found_option, unassigned, _, cells, fit = locate_bubbles(centers[kept], WIDTH)
+    assert np.array_equal(found_question, question[kept])
+    assert np.array_equal(found_option, option[kept])
+    assert len(unassigned) == 0
+    assert fit == 1.0
+    # The empty cell still gets the position it is printed at
+    assert np.allclose(cells[37, 2], centers[missing], atol=PITCH * 0.2)
+
+def test_quarter_turned_sheet_misfits():
+    centers, _, _ = sheet_centers(angle=90)
+    grid = grid_of(centers)
+    assert grid["fit"] < 0.75
+    assert grid_misfit(grid).startswith("Bubble grid did not fit")
+
+@pytest.mark.parametrize("grid", [
+    {"off_grid": 0, "duplicates": 0, "fit": 0.75},
+    {"off_grid": 10, "duplicates": 0, "fit": 1.0},
+    {"off_grid": 0, "duplicates": 2, "fit": 1.0},
+    {"off_grid": 0, "duplicates": 0, "fit": 1.0, "residual": 0.5},
+    None,
+])
+def test_grid_misfit_passes_at_thresholds(grid):
+    assert grid_misfit(grid) is None
+
+@pytest.mark.parametrize("grid, reason", [
+    ({"off_grid": 0, "duplicates": 0, "fit": 0.74}, "Bubble grid did not fit: 74%"),
+    ({"off_grid": 11, "duplicates": 0, "fit": 1.0}, "11 off-grid"),
+    ({"off_grid": 0, "duplicates": 3, "fit": 1.0}, "3 duplicate"),
+    ({"off_grid": 0, "duplicates": 0, "fit": 1.0, "residual": 0.6}, "did not align to its layout"),
+])
+def test_grid_misfit_flags_past_thresholds(grid, reason):
+    assert reason in grid_misfit(grid)
+
+def test_sample_sheet_fits():
+    _, _, _, grid = read_sheet_file(os.path.join(INPUT_DIR, "setA", "Img2.jpeg"))
+    assert grid_misfit(grid) is None
+
+def test_rotated_sample_sheet_fits():
+    image = cv2.imread(os.path.join(INPUT_DIR, "setA", "Img2.jpeg"))
+    h, w = image.shape[:2]
+    rotated = cv2.warpAffine(image, cv2.getRotationMatrix2D((w / 2, h / 2), 3, 1.0), (w, h),
+                             borderMode=cv2.BORDER_REPLICATE)
+    _, _, _, grid = read_sheet(rotated)
+    assert grid_misfit(grid) is None
+
+def test_sideways_sample_sheet_is_sent_to_review():
+    # Img23 was photographed a quarter turn round: its bubbles can't be placed on the grid
+    _, _, _, grid = read_sheet_file(os.path.join(INPUT_DIR, "setB", "Img23.jpeg"))
+    assert grid["fit"] < 0.75
+    assert grid_misfit(grid).startswith("Bubble grid did not fit")